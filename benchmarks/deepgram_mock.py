@@ -0,0 +1,186 @@
+'''
+Local stand-in for Deepgram's streaming /v1/listen websocket.
+
+Speaks the subset of the protocol Ear_deepgram uses, with the same message schema:
+linear16 audio in, Results messages out (interim results with interim_results=true),
+UtteranceEnd with utterance_end_ms, KeepAlive / Finalize / CloseStream control
+messages, server side endpointing (speech_final), and the idle timeout that closes
+a connection after 10s without audio or KeepAlive. Speech is detected by frame energy and the
+transcripts are scripted. Responses are delayed by --latency to mimic the network
+and the model, --drop-after closes connections to exercise reconnects.
+
+    python benchmarks/deepgram_mock.py --port 8765 --latency 0.15
+    ear = Ear_deepgram(api_key='mock', url='ws://localhost:8765/v1/listen')
+'''
+import argparse
+import asyncio
+import json
+import uuid
+from time import monotonic
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import websockets
+
+FRAME_SECONDS = 0.02
+IDLE_TIMEOUT = 10.0
+WORDS_PER_SECOND = 2.5  # words of the script revealed per second of speech
+
+SCRIPT = ['how much is the new model and when does it ship',
+          'can I pay for it in installments',
+          'okay thanks that is all I needed']
+
+
+def results(request_id, transcript, start, duration, is_final, speech_final=False, from_finalize=False):
+    words = transcript.split()
+    return {
+        'type': 'Results',
+        'channel_index': [0, 1],
+        'duration': duration,
+        'start': start,
+        'is_final': is_final,
+        'speech_final': speech_final,
+        'from_finalize': from_finalize,
+        'channel': {'alternatives': [{
+            'transcript': transcript,
+            'confidence': 0.98 if transcript else 0.0,
+            'words': [{'word': w, 'start': start + i * duration / max(len(words), 1),
+                       'end': start + (i + 1) * duration / max(len(words), 1),
+                       'confidence': 0.98, 'punctuated_word': w} for i, w in enumerate(words)],
+        }]},
+        'metadata': {'request_id': request_id, 'model_info': {'name': 'mock', 'version': '0', 'arch': 'mock'}},
+    }
+
+
+class Stream:
+    '''
+    State of one connection.
+    '''
+    def __init__(self, params, args, send):
+        self.request_id = str(uuid.uuid4())
+        self.rate = int(params.get('sample_rate', 16000))
+        self.endpointing = float(params.get('endpointing', 10)) / 1000
+        self.interim_results = params.get('interim_results') == 'true'
+        self.utterance_end = float(params['utterance_end_ms']) / 1000 if 'utterance_end_ms' in params else None
+        self.interim_every = 0.5  # seconds of audio between interim results
+        self.last_interim = 0.0
+        self.last_word_end = None  # for UtteranceEnd
+        self.threshold = args.threshold
+        self.send = send
+        self.cursor = 0.0  # seconds of audio received
+        self.segment_start = 0.0
+        self.speech_seconds = 0.0
+        self.last_voice = None
+        self.utterance = 0
+        self.words_sent = 0  # words of the current utterance already in final results
+        self.pending = b''
+
+    def words(self):
+        script = SCRIPT[self.utterance % len(SCRIPT)].split()
+        n = min(len(script), int(self.speech_seconds * WORDS_PER_SECOND) + 1)
+        return script[:n]
+
+    def final(self, speech_final=False, from_finalize=False):
+        words = self.words() if self.last_voice is not None else []
+        transcript = ' '.join(words[self.words_sent:])
+        self.words_sent = len(words)
+        if transcript:
+            self.last_word_end = self.last_voice
+        self.send(results(self.request_id, transcript, self.segment_start, self.cursor - self.segment_start,
+                          True, speech_final, from_finalize))
+        self.segment_start = self.cursor
+        if speech_final:
+            self.utterance += 1
+            self.words_sent = 0
+            self.speech_seconds = 0.0
+            self.last_voice = None
+
+    def interim(self):
+        transcript = ' '.join(self.words()[self.words_sent:])
+        self.send(results(self.request_id, transcript, self.segment_start, self.cursor - self.segment_start, False))
+        self.last_interim = self.cursor
+
+    def audio(self, data):
+        data = self.pending + data
+        frame_bytes = int(self.rate * FRAME_SECONDS) * 2
+        n = len(data) // frame_bytes * frame_bytes
+        self.pending = data[n:]
+        frames = np.frombuffer(data[:n], dtype=np.int16).reshape(-1, frame_bytes // 2).astype(np.float32)
+        for rms in np.sqrt(np.mean(frames ** 2, axis=1)):
+            self.cursor += FRAME_SECONDS
+            if rms > self.threshold:
+                self.last_voice = self.cursor
+                self.speech_seconds += FRAME_SECONDS
+                if self.interim_results and self.cursor - self.last_interim >= self.interim_every:
+                    self.interim()
+            elif self.last_voice is not None and self.cursor - self.last_voice >= self.endpointing:
+                self.final(speech_final=True)
+            if self.utterance_end is not None and self.last_word_end is not None \
+                    and self.cursor - max(self.last_word_end, self.last_voice or 0) >= self.utterance_end:
+                self.send({'type': 'UtteranceEnd', 'channel': [0, 1], 'last_word_end': self.last_word_end})
+                self.last_word_end = None
+
+
+async def handler(ws, args):
+    request = getattr(ws, 'request', None)
+    path = request.path if request is not None else ws.path
+    params = {k: v[0] for k, v in parse_qs(urlparse(path).query).items()}
+    outbox = asyncio.Queue()
+
+    def send(msg):
+        # responses arrive args.latency after the audio that produced them
+        outbox.put_nowait((monotonic() + args.latency, json.dumps(msg)))
+
+    async def sender():
+        while True:
+            due, msg = await outbox.get()
+            await asyncio.sleep(max(0.0, due - monotonic()))
+            await ws.send(msg)
+
+    stream = Stream(params, args, send)
+    sending = asyncio.create_task(sender())
+    opened = monotonic()
+    try:
+        while True:
+            if args.drop_after and monotonic() - opened > args.drop_after:
+                await ws.close(code=1011, reason='mock connection drop')
+                break
+            try:
+                msg = await asyncio.wait_for(ws.recv(), IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                # like Deepgram's NET-0001
+                await ws.close(code=1011, reason='Deepgram did not receive audio data or a text message '
+                                                 'within the timeout window')
+                break
+            if isinstance(msg, bytes):
+                stream.audio(msg)
+                continue
+            kind = json.loads(msg).get('type')
+            if kind == 'Finalize':
+                stream.final(from_finalize=True)
+            elif kind == 'CloseStream':
+                stream.final()
+                send({'type': 'Metadata', 'request_id': stream.request_id, 'duration': stream.cursor,
+                      'channels': 1})
+                await asyncio.sleep(args.latency + 0.05)
+                await ws.close()
+                break
+    except websockets.ConnectionClosed:
+        pass
+    finally:
+        sending.cancel()
+
+
+async def main(args):
+    async with websockets.serve(lambda ws: handler(ws, args), args.host, args.port, max_size=None):
+        print(f'mock Deepgram listening on ws://{args.host}:{args.port}/v1/listen')
+        await asyncio.Future()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.15, help='seconds added to every response')
+    parser.add_argument('--threshold', type=float, default=500.0, help='int16 frame RMS counted as speech')
+    parser.add_argument('--drop-after', type=float, default=0.0, help='close connections after this many seconds')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,155 @@
+'''
+Offline end-to-end latency benchmark of the run_chat pipeline.
+
+WAV files are replayed through Listener_file as the user's turns. The LLM and TTS
+(and optionally STT) are local stand-ins with configurable timing, so runs are
+reproducible and need no microphone or paid APIs. For every Ear/Mouth/Chatbot
+combination it reports time to first audio, per-stage latency percentiles and
+CPU time per turn, and stores the results for regression comparison.
+
+    python benchmarks/e2e_latency.py --wav media/abs.wav media/my_voice.wav --turns 6
+    python benchmarks/e2e_latency.py --combo hf:openai/whisper-tiny.en,synthetic,scripted
+    python benchmarks/e2e_latency.py --compare benchmarks/results/baseline.json
+'''
+import argparse
+import json
+import os
+import sys
+from time import process_time, monotonic, strftime
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openvoicechat.utils import run_chat, Listener_file
+from openvoicechat.tracing import tracer
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def make_ear(spec, listener, silence_seconds):
+    kind, _, arg = spec.partition(':')
+    if kind == 'scripted':
+        from openvoicechat.stt.stt_mock import Ear_scripted
+        return Ear_scripted(silence_seconds=silence_seconds, listener=listener)
+    if kind == 'hf':
+        from openvoicechat.stt.stt_hf import Ear_hf
+        return Ear_hf(model_id=arg or 'openai/whisper-tiny.en', silence_seconds=silence_seconds, listener=listener)
+    raise ValueError(f'unknown ear {spec}')
+
+
+def make_mouth(spec):
+    kind, _, arg = spec.partition(':')
+    from openvoicechat.tts.tts_mock import Mouth_synthetic, Player_null
+    if kind == 'synthetic':
+        return Mouth_synthetic()
+    if kind == 'piper':
+        from openvoicechat.tts.tts_piper import Mouth_piper
+        return Mouth_piper(model_path=arg, config_path=arg + '.json', player=Player_null())
+    if kind == 'hf':
+        from openvoicechat.tts.tts_hf import Mouth_hf
+        return Mouth_hf(model_id=arg or 'kakao-enterprise/vits-vctk', player=Player_null())
+    raise ValueError(f'unknown mouth {spec}')
+
+
+def make_chatbot(spec):
+    kind, _, arg = spec.partition(':')
+    if kind == 'scripted':
+        from openvoicechat.llm.llm_mock import Chatbot_scripted
+        return Chatbot_scripted()
+    if kind == 'llama':
+        from openvoicechat.llm.llm_llama import Chatbot_llama
+        return Chatbot_llama(model_path=arg, device='cpu')
+    raise ValueError(f'unknown chatbot {spec}')
+
+
+def run_combo(combo, wavs, turns, speed, silence_seconds, speculate=None):
+    ear_spec, mouth_spec, chatbot_spec = combo.split(',')
+    listener = Listener_file(wavs * ((turns + len(wavs) - 1) // len(wavs)), speed=speed)
+    ear = make_ear(ear_spec, listener, silence_seconds)
+    ear.use_speculation(speculate)
+    mouth = make_mouth(mouth_spec)
+    chatbot = make_chatbot(chatbot_spec)
+
+    done = [0]
+
+    def stop(_):
+        done[0] += 1
+        return done[0] >= turns
+
+    session = f'bench-{combo}'
+    cpu_start, wall_start = process_time(), monotonic()
+    run_chat(mouth, ear, chatbot, verbose=False, enable_interruptions=False,
+             stopping_criteria=stop, session_id=session)
+    cpu, wall = process_time() - cpu_start, monotonic() - wall_start
+    summary = tracer.summary(session)
+    return {'combo': combo, 'turns': done[0], 'speed': speed,
+            'time_to_first_audio': summary.get('playback_start'),
+            'latency': summary,
+            'cpu_per_turn': cpu / done[0], 'wall': wall,
+            'trim': {'stt': dict(ear.trimmer.stats), 'tts': dict(mouth.trimmer.stats)},
+            'speculation': dict(ear.speculator.stats) if ear.speculator else None}
+
+
+def print_result(result):
+    print(f"== {result['combo']} ({result['turns']} turns, cpu/turn {result['cpu_per_turn'] * 1000:.0f}ms)")
+    for name, stats in result['latency'].items():
+        parts = '  '.join(f'{k}={v * 1000:.0f}ms' for k, v in stats.items() if k != 'count')
+        print(f'   {name:<16} {parts}')
+    for stage, stats in result.get('trim', {}).items():
+        print(f"   trim {stage:<11} {stats['trimmed_seconds']:.1f}s of {stats['input_seconds']:.1f}s "
+              f"in {stats['clips']} clips")
+    speculation = result.get('speculation')
+    if speculation:
+        print(f"   speculative stt  used={speculation['used']} discarded={speculation['discarded']}  "
+              f"saved={speculation['saved_seconds'] * 1000:.0f}ms wasted={speculation['wasted_seconds'] * 1000:.0f}ms")
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = {r['combo']: r for r in json.load(f)['results']}
+    regressions = 0
+    for result in results:
+        old = baseline.get(result['combo'])
+        if old is None:
+            continue
+        for name, stats in result['latency'].items():
+            if name not in old['latency']:
+                continue
+            before, after = old['latency'][name]['p50'], stats['p50']
+            if before > 0 and after > before * (1 + tolerance):
+                regressions += 1
+                print(f"REGRESSION {result['combo']} {name} p50 {before * 1000:.0f}ms -> {after * 1000:.0f}ms")
+        before, after = old['cpu_per_turn'], result['cpu_per_turn']
+        if after > before * (1 + tolerance):
+            regressions += 1
+            print(f"REGRESSION {result['combo']} cpu/turn {before * 1000:.0f}ms -> {after * 1000:.0f}ms")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--wav', nargs='+', default=['media/abs.wav', 'media/my_voice.wav'])
+    parser.add_argument('--combo', action='append', help='ear,mouth,chatbot e.g. scripted,synthetic,scripted')
+    parser.add_argument('--turns', type=int, default=6)
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 1 for accurate latencies')
+    parser.add_argument('--silence-seconds', type=float, default=1.0)
+    parser.add_argument('--speculate', type=float, default=None,
+                        help='transcribe speculatively after this many seconds of silence')
+    parser.add_argument('--out', default=None, help='results file, defaults to benchmarks/results/<time>.json')
+    parser.add_argument('--compare', default=None, help='results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    results = []
+    for combo in args.combo or ['scripted,synthetic,scripted']:
+        result = run_combo(combo, args.wav, args.turns, args.speed, args.silence_seconds, args.speculate)
+        print_result(result)
+        results.append(result)
+
+    out = args.out or os.path.join(RESULTS_DIR, strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump({'time': strftime('%Y-%m-%d %H:%M:%S'), 'results': results}, f, indent=2)
+    print(f'saved {out}')
+
+    if args.compare:
+        sys.exit(1 if compare(results, args.compare, args.tolerance) else 0)
@@ -0,0 +1,101 @@
+'''
+Compares the built-in hybrid retriever against the LangChain/Chroma path used before.
+
+Queries are spans taken from random chunks, the chunk they came from is the relevant one.
+Reports recall@k and p50/p99 latency per retriever.
+
+    python benchmarks/rag_retriever.py --pdf uploads/data.pdf --queries 200
+'''
+import argparse
+import random
+import re
+import sys
+import os
+from time import perf_counter
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openvoicechat.rag.retriever import HybridRetriever
+
+
+def load_chunks(pdf_path, chunk_size=500, chunk_overlap=50):
+    import pypdf
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    reader = pypdf.PdfReader(pdf_path)
+    text = ' '.join(page.extract_text().strip() for page in reader.pages)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return splitter.split_text(text)
+
+
+def make_queries(chunks, n, words=8, seed=0):
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(n):
+        target = rng.randrange(len(chunks))
+        tokens = re.findall(r'\S+', chunks[target])
+        if len(tokens) <= words:
+            span = tokens
+        else:
+            start = rng.randrange(len(tokens) - words)
+            span = tokens[start:start + words]
+        queries.append((' '.join(span), target))
+    return queries
+
+
+def evaluate(name, search, chunks, queries, k):
+    index_of = {text: i for i, text in enumerate(chunks)}
+    hits = 0
+    latencies = []
+    for query, target in queries:
+        start = perf_counter()
+        results = search(query, k)
+        latencies.append(perf_counter() - start)
+        if target in [index_of.get(text) for text in results]:
+            hits += 1
+    latencies = np.array(latencies) * 1000
+    print(f'{name:<20} recall@{k}: {hits / len(queries):.3f}  '
+          f'p50: {np.percentile(latencies, 50):.2f} ms  p99: {np.percentile(latencies, 99):.2f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pdf', default='uploads/data.pdf')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=4)
+    parser.add_argument('--no-chroma', action='store_true')
+    args = parser.parse_args()
+
+    from langchain_community.embeddings.sentence_transformer import SentenceTransformerEmbeddings
+    embedding_function = SentenceTransformerEmbeddings(model_name='all-MiniLM-L6-v2')
+
+    chunks = load_chunks(args.pdf)
+    queries = make_queries(chunks, args.queries)
+    print(f'{len(chunks)} chunks, {len(queries)} queries')
+
+    vectors = np.asarray(embedding_function.embed_documents(chunks), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    def embed_query(query):
+        vector = np.asarray(embedding_function.embed_query(query), dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    # warm the embedding model so the first query does not dominate p99
+    embed_query('warmup')
+
+    if not args.no_chroma:
+        from langchain_chroma import Chroma
+        db = Chroma.from_texts(texts=chunks, embedding=embedding_function)
+        chroma_retriever = db.as_retriever(search_kwargs={'k': args.k})
+        evaluate('chroma', lambda q, k: [d.page_content for d in chroma_retriever.invoke(q)],
+                 chunks, queries, args.k)
+
+    for name, kwargs in [('dense float32', {'dtype': 'float32', 'alpha': 1.0}),
+                         ('hybrid float16', {'dtype': 'float16'}),
+                         ('hybrid int8', {'dtype': 'int8'}),
+                         ('hybrid int8 cached', {'dtype': 'int8'})]:
+        retriever = HybridRetriever(chunks, vectors, embed_query, **kwargs)
+        if name.endswith('cached'):
+            for query, _ in queries:
+                retriever.embed_query(query)
+        evaluate(name, lambda q, k: [text for text, _ in retriever.search(q, k)], chunks, queries, args.k)
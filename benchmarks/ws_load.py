@@ -0,0 +1,176 @@
+'''
+Concurrent websocket load test for web/fastapi_ws.py.
+
+Opens N clients against /ws. Each one streams a recorded utterance as int16 PCM at
+44.1 kHz in 16384 sample packets at the cadence of the browser client, then keeps
+sending silence until the bot's audio arrives. The response latency is the time from
+the end of the utterance to the first audio packet. N is ramped up step by step and
+the server's CPU, RSS and thread count are sampled for every step.
+
+Start the server with local stand-ins for STT/LLM/TTS:
+
+    OVC_MOCK=1 uvicorn web.fastapi_ws:app --port 8000
+
+and run:
+
+    python benchmarks/ws_load.py --url ws://localhost:8000/ws --ramp 1 2 4 8 16 --server-pid <pid>
+'''
+import argparse
+import asyncio
+import json
+import ssl
+import sys
+import os
+from time import monotonic
+import numpy as np
+
+PACKET_SAMPLES = 16384  # createScriptProcessor(16384, 1, 1) in web/static/streaming_audio.js
+CLIENT_RATE = 44100
+
+
+def load_utterance(path, silence_seconds):
+    import librosa
+    y, _ = librosa.load(path, sr=CLIENT_RATE, mono=True)
+    y = np.concatenate([y, np.zeros(int(silence_seconds * CLIENT_RATE), dtype=np.float32)])
+    pcm = (np.clip(y, -1, 1) * 32767).astype(np.int16)
+    n = len(pcm) // PACKET_SAMPLES
+    return [pcm[i * PACKET_SAMPLES:(i + 1) * PACKET_SAMPLES].tobytes() for i in range(n)]
+
+
+async def client(url, packets, turns, timeout, ssl_context, results):
+    import websockets
+    silence = np.zeros(PACKET_SAMPLES, dtype=np.int16).tobytes()
+    interval = PACKET_SAMPLES / CLIENT_RATE
+    latencies = []
+    bytes_in = 0
+    errors = 0
+    rejected = 0
+    try:
+        async with websockets.connect(url, ssl=ssl_context, max_size=None) as ws:
+            next_send = monotonic()
+            for _ in range(turns):
+                speech_end = None
+                got_audio = None
+                quiet_packets = 0
+                i = 0
+                while True:
+                    packet = packets[i] if i < len(packets) else silence
+                    if i == len(packets):
+                        speech_end = monotonic()
+                    i += 1
+                    await asyncio.sleep(max(0.0, next_send - monotonic()))
+                    next_send += interval
+                    await ws.send(packet)
+                    reply = await ws.recv()
+                    if reply in (b'none', b'stop'):
+                        if got_audio is not None:
+                            quiet_packets += 1
+                            # the bot finished answering, start the next turn
+                            if quiet_packets >= 2:
+                                break
+                    else:
+                        bytes_in += len(reply)
+                        quiet_packets = 0
+                        if got_audio is None and speech_end is not None:
+                            got_audio = monotonic()
+                            latencies.append(got_audio - speech_end)
+                    if speech_end is not None and got_audio is None and monotonic() - speech_end > timeout:
+                        errors += 1
+                        break
+    except Exception as e:
+        rcvd = getattr(e, 'rcvd', None)
+        if rcvd is not None and rcvd.code == 1013:
+            # the server is at capacity (see openvoicechat/capacity.py)
+            rejected += 1
+        else:
+            print(f'client error: {e}', file=sys.stderr)
+            errors += 1
+    results.append({'latencies': latencies, 'bytes_in': bytes_in, 'errors': errors, 'rejected': rejected})
+
+
+async def sample_server(pid, stop, samples):
+    if pid is None:
+        return
+    import psutil
+    process = psutil.Process(pid)
+    process.cpu_percent()
+    while not stop.is_set():
+        await asyncio.sleep(1.0)
+        with process.oneshot():
+            samples.append({'cpu': process.cpu_percent(), 'rss': process.memory_info().rss,
+                            'threads': process.num_threads()})
+
+
+async def run_step(n, args, packets, ssl_context):
+    results = []
+    samples = []
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_server(args.server_pid, stop, samples))
+    clients = []
+    for _ in range(n):
+        clients.append(asyncio.create_task(client(args.url, packets, args.turns, args.timeout, ssl_context, results)))
+        # stagger the connections so the sessions are not in lock step
+        await asyncio.sleep(args.stagger)
+    await asyncio.gather(*clients)
+    stop.set()
+    await sampler
+
+    latencies = np.array([lat for r in results for lat in r['latencies']])
+    step = {'clients': n, 'responses': len(latencies), 'errors': sum(r['errors'] for r in results),
+            'rejected': sum(r['rejected'] for r in results),
+            'bytes_in_per_client': float(np.mean([r['bytes_in'] for r in results]))}
+    if len(latencies):
+        for p in (50, 90, 99):
+            step[f'p{p}'] = float(np.percentile(latencies, p))
+    if samples:
+        step['cpu_mean'] = float(np.mean([s['cpu'] for s in samples]))
+        step['cpu_max'] = float(np.max([s['cpu'] for s in samples]))
+        step['rss_max_mb'] = max(s['rss'] for s in samples) / 2 ** 20
+        step['threads_max'] = max(s['threads'] for s in samples)
+    return step
+
+
+def print_step(step):
+    parts = [f"clients={step['clients']:<4}", f"responses={step['responses']:<4}", f"errors={step['errors']:<3}",
+             f"rejected={step['rejected']:<3}"]
+    for p in (50, 90, 99):
+        if f'p{p}' in step:
+            parts.append(f"p{p}={step[f'p{p}'] * 1000:.0f}ms")
+    if 'cpu_mean' in step:
+        parts.append(f"cpu={step['cpu_mean']:.0f}%/{step['cpu_max']:.0f}%")
+        parts.append(f"rss={step['rss_max_mb']:.0f}MB")
+        parts.append(f"threads={step['threads_max']}")
+    print('  '.join(parts))
+
+
+async def main(args):
+    packets = load_utterance(args.wav, args.trailing_silence)
+    ssl_context = None
+    if args.url.startswith('wss://'):
+        ssl_context = ssl.create_default_context()
+        if args.insecure:
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+    steps = []
+    for n in args.ramp:
+        step = await run_step(n, args, packets, ssl_context)
+        print_step(step)
+        steps.append(step)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(steps, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='ws://localhost:8000/ws')
+    parser.add_argument('--wav', default=os.path.join('media', 'my_voice.wav'))
+    parser.add_argument('--ramp', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--turns', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=20.0)
+    parser.add_argument('--trailing-silence', type=float, default=0.0)
+    parser.add_argument('--stagger', type=float, default=0.1)
+    parser.add_argument('--server-pid', type=int, default=None, help='sample CPU/RSS/threads of this process')
+    parser.add_argument('--insecure', action='store_true', help='do not verify the certificate for wss://')
+    parser.add_argument('--out', default=None)
+    asyncio.run(main(parser.parse_args()))
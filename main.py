@@ -35,5 +35,9 @@ if __name__ == "__main__":
         aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
         region_name=os.getenv("REGION_NAME")
     )
+    # from openvoicechat.llm.cache import SemanticCache
+    # cache = SemanticCache(threshold=0.9, ttl=3600)
+    # chatbot.use_cache(cache)
+    # mouth.use_cache(cache)
 
     run_chat(mouth, ear, chatbot, verbose=True, enable_interruptions=False,stopping_criteria=lambda x: '[END]' in x)
@@ -1,10 +1,8 @@
 from openvoicechat.llm.base import BaseChatbot
 import os
-from langchain_chroma import Chroma
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 import langchain
 from langchain.prompts import PromptTemplate
-from langchain.chains import RetrievalQA
 from langchain_openai import OpenAIEmbeddings
 from langchain_openai.chat_models import ChatOpenAI
 from langchain_community.embeddings.sentence_transformer import (
@@ -15,49 +13,109 @@ from openvoicechat.tts.tts_piper import Mouth_piper as Mouth
 from openvoicechat.stt.stt_hf import Ear_hf as Ear
 from openvoicechat.utils import run_chat
 from openvoicechat.llm.prompts import llama_sales
+from openvoicechat.rag.index import VectorIndex, file_hash
+from openvoicechat.rag.retriever import HybridRetriever
+from openvoicechat.rag.ingest import IngestPipeline
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from collections import OrderedDict
+from time import monotonic
+import threading
+import logging
 from dotenv import load_dotenv
 import os
 
+logger = logging.getLogger(__name__)
+
+
 class Chatbot_rag(BaseChatbot):
     def __init__(self, sys_prompt='',
                  Model='gpt-3.5-turbo',
-                 api_key=''):
+                 api_key='',
+                 index_path='uploads/index',
+                 documents=('uploads/data.pdf',),
+                 read_only=False,
+                 retriever='hybrid',
+                 k=4):
+        '''
+        :param index_path: directory of the persistent vector index
+        :param documents: pdf files to index, only new or changed files are parsed and embedded
+        :param read_only: open an index built by another process without updating it (memory mapped, shared)
+        :param retriever: 'hybrid' for BM25 + int8 dense (see rag/retriever.py, saved with the index version
+                          and memory mapped like the vectors) or 'dense' for the plain index
+        :param k: number of chunks put in the prompt
+        '''
+        self.retriever_type = retriever
+        self.k = k
         self.text_splitter = RecursiveCharacterTextSplitter(
         chunk_size = 500,
         chunk_overlap = 50
         )
         self.sys_prompt = sys_prompt
         self.embedding_function = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
-        self.db = Chroma.from_texts(texts=[''],embedding=self.embedding_function)
+        self.db = VectorIndex(index_path, embedding_function=self.embedding_function, read_only=read_only)
         self.llm = ChatOpenAI(model=Model,openai_api_key=api_key)
-        self.use_pdf('uploads/data.pdf')
+        if not read_only:
+            for file_name in documents:
+                self.use_pdf(file_name)
         self.start_llm()
 
     def load_pdf(self,file_path):
         with open(file_path, 'rb') as f:
             t=""
             pdf_reader = pypdf.PdfReader(f)
-            num_pages = pdf_reader._get_num_pages()
-            # You can access each page like this:
-            for page_num in range(num_pages):
-                page = pdf_reader._get_page(page_num)
-                # Do something with the page
+            for page in pdf_reader.pages:
                 text = page.extract_text()
                 t=t+text.strip()
         return t
     
     def use_pdf(self,file_name: str):
+        doc_hash = file_hash(file_name)
+        if not self.db.document_changed(file_name, doc_hash):
+            return
         text = self.load_pdf(file_name)
-        self.add_to_vectordb(text)
+        self.add_to_vectordb(text, source=file_name, doc_hash=doc_hash)
         return 
 
-    def add_to_vectordb(self,text):
+    def add_to_vectordb(self,text, source='text', doc_hash=None):
         splits = self.text_splitter.split_text(text)  
-        self.db.add_texts(splits)
+        self.db.add_document(source, splits, doc_hash)
+        self.db.commit()
+        if hasattr(self, 'mretriever'):
+            self.build_retriever()
         return
+
+    def ingest(self, paths, workers=None, block=False):
+        '''
+        :param paths: pdf files or directories
+        :param workers: number of extraction processes
+        :param block: if False the ingestion runs in the background and the index is reloaded when it is done
+        Ingests many documents with the parallel pipeline in rag/ingest.py.
+        '''
+        writer = VectorIndex(self.db.path, embedding_function=self.embedding_function)
+        pipeline = IngestPipeline(writer, split_fn=self.text_splitter.split_text, workers=workers)
+
+        def reload(progress):
+            self.db.load()
+            self.build_retriever()
+
+        if block:
+            reload(pipeline.run(paths))
+            return pipeline.progress
+        pipeline.start(paths, on_done=reload)
+        return pipeline
+
+    def build_retriever(self):
+        if self.retriever_type == 'hybrid':
+            self.mretriever = HybridRetriever.from_index(self.db)
+        else:
+            self.mretriever = self.db
+        with self.retrieval_lock:
+            self.retrieval_cache.clear()
     
     def start_llm(self):
-        self.mretriever = self.db.as_retriever()
+        self.retrieval_lock = threading.Lock()
+        self.retrieval_cache = OrderedDict()
+        self.build_retriever()
 
   
         template = """You are a helpful assistant Give answers using following pieces of context given inside ``` to answer the question at the end. If you don't know the answer , don't try to make up an answer, but be nice in conversation.
@@ -70,18 +128,89 @@ class Chatbot_rag(BaseChatbot):
         
 
         
-        QA_CHAIN_PROMPT = PromptTemplate.from_template(template) 
-        self.qa_chain= RetrievalQA.from_chain_type(
-            self.llm,
-            retriever=self.mretriever,
-            chain_type="stuff",
-            chain_type_kwargs={"prompt": QA_CHAIN_PROMPT}
-        )
+        self.qa_prompt = PromptTemplate.from_template(template) 
+        self.retrieval_executor = ThreadPoolExecutor(max_workers=1)
+        self.retrieval_cache_size = 128
+        self._partial_future = None
+        self.timings = {}
         return
 
+    def _retrieve(self, query):
+        start = monotonic()
+        results = self.mretriever.search(query, self.k)
+        context = "\n\n".join(text for text, _ in results)
+        return context, monotonic() - start
+
+    def prefetch(self, query):
+        '''
+        :param query: the user input
+        :return: a future with (context, retrieval seconds)
+        Starts the retrieval on the worker thread. Results are cached per query so
+        calling this early (see on_partial) makes run start generating sooner.
+        A retrieval that failed or was cancelled is dropped from the cache, the next call retries it.
+        '''
+        key = query.strip().lower()
+        with self.retrieval_lock:
+            future = self.retrieval_cache.get(key)
+            if future is None:
+                future = self.retrieval_executor.submit(self._retrieve, query)
+                self.retrieval_cache[key] = future
+                if len(self.retrieval_cache) > self.retrieval_cache_size:
+                    self.retrieval_cache.popitem(last=False)
+                future.add_done_callback(lambda f: self._drop_failed(key, f))
+            else:
+                self.retrieval_cache.move_to_end(key)
+        return future
+
+    def _drop_failed(self, key, future):
+        if not future.cancelled() and future.exception() is None:
+            return
+        with self.retrieval_lock:
+            if self.retrieval_cache.get(key) is future:
+                del self.retrieval_cache[key]
+
+    def on_partial(self, text):
+        '''
+        :param text: transcript of the user's turn so far
+        Pass as on_partial of Ear_deepgram. Retrieves for the latest partial transcript while
+        the user is still talking, the final transcript usually equals the last partial one and
+        run finds its context in the cache. Does not block, a pending retrieval for an older
+        partial is cancelled so the worker does not fall behind, unless run waits for it.
+        '''
+        if not text.strip():
+            return
+        previous = self._partial_future
+        if previous is not None and not previous.done() and not getattr(previous, 'claimed', False):
+            previous.cancel()
+        self._partial_future = self.prefetch(text)
+
     def run(self, input_text):
-        result = self.qa_chain({"query": input_text})
-        yield result['result']
+        start = monotonic()
+        future = self.prefetch(input_text)
+        cached = future.done()
+        while True:
+            # on_partial does not cancel a claimed retrieval, but may have done so just before
+            future.claimed = True
+            try:
+                context, retrieval_time = future.result()
+                break
+            except CancelledError:
+                # _drop_failed removed it from the cache already
+                future = self.prefetch(input_text)
+                cached = False
+        prompt = self.qa_prompt.format(context=context, question=input_text)
+        generation_start = monotonic()
+        self.timings = {'retrieval': 0.0 if cached else retrieval_time,
+                        'retrieval_wait': generation_start - start,
+                        'prompt_chars': len(prompt),
+                        'first_token': None}
+        for chunk in self.llm.stream(prompt):
+            if self.timings['first_token'] is None:
+                self.timings['first_token'] = monotonic() - generation_start
+            if chunk.content:
+                yield chunk.content
+        logger.info(f"RAG timings: {self.timings}")
+        self.trace.set('rag', self.timings)
 
     def post_process(self, response):
         return response
@@ -91,13 +220,18 @@ if __name__ == "__main__":
 
     print('loading models... ', device)
 
-    ear = Ear(silence_seconds=2, device=device)
-
     load_dotenv()
     api_key = os.getenv('OPENAI_API_KEY')
 
     chatbot = Chatbot_rag(sys_prompt=llama_sales,
                       api_key=api_key)
+
+    if os.getenv('DEEPGRAM_API_KEY'):
+        # streaming transcripts let the retrieval run while the user is talking
+        from openvoicechat.stt.stt_deepgram import Ear_deepgram
+        ear = Ear_deepgram(silence_seconds=2, on_partial=chatbot.on_partial)
+    else:
+        ear = Ear(silence_seconds=2, device=device)
     mouth = Mouth(device=device)
     mouth.say_text('Good morning!')
     run_chat(mouth, ear, chatbot, verbose=True)
@@ -0,0 +1,98 @@
+'''
+Cooperative cancellation of a turn.
+
+run_chat creates a CancelToken for every turn and hands it to the chatbot and the
+mouth, like the trace of the turn. When the user interrupts, the mouth cancels it:
+the llm closes its HTTP stream or stops generating, the tts skips the sentences that
+were not rendered yet and aborts the ones in flight where the backend can, the player
+drops the queued audio. Every stage reports when it stopped, the time from cancel
+until then (time to idle) is measured per stage.
+'''
+import threading
+from time import monotonic
+from . import metrics
+
+
+class Cancelled(Exception):
+    '''
+    Raised by CancelToken.check, e.g. inside run_tts, once the turn was cancelled.
+    '''
+
+
+class CancelToken:
+    def __init__(self):
+        self.reason = None
+        self.cancelled_at = None
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason='interruption'):
+        '''
+        :param reason: why the turn was cancelled, the label of the metrics
+        Runs the callbacks registered with on_cancel, in the calling thread. Only the first call counts.
+        '''
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self.cancelled_at = monotonic()
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        metrics.cancellations.inc(reason=reason)
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback):
+        '''
+        :param callback: called without arguments on cancel, right away if the token is cancelled already,
+                         e.g. the close method of a stream to unblock a thread reading from it
+        :return: callback, to pass to remove
+        '''
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return callback
+        callback()
+        return callback
+
+    def remove(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def check(self):
+        '''
+        Raises Cancelled if the token was cancelled, for loops that cannot return partial results.
+        '''
+        if self._event.is_set():
+            raise Cancelled(self.reason)
+
+    def wait(self, timeout=None) -> bool:
+        return self._event.wait(timeout)
+
+    def stopped(self, stage):
+        '''
+        :param stage: e.g. 'llm', 'tts', 'playback' or 'turn'
+        Called by a stage when it stopped working on the turn, measures its time to idle if the turn was cancelled.
+        '''
+        if self._event.is_set():
+            metrics.time_to_idle.observe(monotonic() - self.cancelled_at, stage=stage)
+
+
+class _NullToken(CancelToken):
+    '''
+    Stand-in used outside of run_chat, never cancelled.
+    '''
+    def cancel(self, reason='interruption'):
+        pass
+
+    def on_cancel(self, callback):
+        return callback
+
+
+NULL_TOKEN = _NullToken()
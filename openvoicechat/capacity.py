@@ -0,0 +1,177 @@
+'''
+Capacity limits of a node.
+
+Every queue of the pipeline is a BoundedQueue with an explicit overflow policy:
+'block' makes the producer wait for the consumer (text, synthesized audio) and
+'drop_oldest' keeps the newest items (microphone audio, where stale packets are
+worthless). CPU bound work (STT, TTS) runs in a limited number of work slots, so
+an overloaded node queues work instead of thrashing, and SessionManager rejects
+new sessions once max_sessions are running or the slots are backed up.
+
+    OVC_MAX_SESSIONS=8     concurrent sessions, 0 for no limit
+    OVC_STT_SLOTS=2        STT calls in flight, 0 for no limit
+    OVC_TTS_SLOTS=2        TTS calls in flight, 0 for no limit
+'''
+import os
+import queue
+import threading
+from time import monotonic
+from . import metrics
+
+MAX_SESSIONS = int(os.environ.get('OVC_MAX_SESSIONS', 0))
+STT_SLOTS = int(os.environ.get('OVC_STT_SLOTS', 0))
+TTS_SLOTS = int(os.environ.get('OVC_TTS_SLOTS', 0))
+
+# default sizes of the pipeline queues
+INPUT_QUEUE_SIZE = int(os.environ.get('OVC_INPUT_QUEUE', 64))  # websocket packets, 20 ms to 0.37s each
+OUTPUT_QUEUE_SIZE = int(os.environ.get('OVC_OUTPUT_QUEUE', 32))  # synthesized sentences for the client
+TEXT_QUEUE_SIZE = 256  # llm tokens waiting for the tts
+AUDIO_QUEUE_SIZE = 8  # synthesized sentences waiting for playback
+CHUNK_QUEUE_SIZE = 256  # microphone chunks waiting for streaming stt
+
+
+class AtCapacity(Exception):
+    '''
+    Raised when a node cannot take another session.
+    '''
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class BoundedQueue(queue.Queue):
+    def __init__(self, maxsize, overflow='block', name=None):
+        '''
+        :param maxsize: number of items the queue holds
+        :param overflow: 'block' to make put wait for space, 'drop_oldest' to discard the oldest item instead
+        :param name: label of the dropped items counter
+        '''
+        if overflow not in ('block', 'drop_oldest'):
+            raise ValueError(f'unknown overflow policy {overflow}')
+        super().__init__(maxsize)
+        self.overflow = overflow
+        self.name = name
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, item, block=True, timeout=None):
+        if self.closed:
+            return
+        if self.overflow == 'block':
+            return super().put(item, block, timeout)
+        with self.not_full:
+            if 0 < self.maxsize <= self._qsize():
+                self._get()
+                self._task_done_locked()
+                self.dropped += 1
+                metrics.queue_dropped.inc(queue=self.name)
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _task_done_locked(self):
+        # like task_done, for an item removed while holding the mutex
+        self.unfinished_tasks -= 1
+        if self.unfinished_tasks <= 0:
+            self.all_tasks_done.notify_all()
+
+    def clear(self):
+        '''
+        Discards the queued items and wakes up producers blocked on a full queue.
+        '''
+        with self.mutex:
+            n = self._qsize()
+            self.queue.clear()
+            self.unfinished_tasks = max(0, self.unfinished_tasks - n)
+            if self.unfinished_tasks == 0:
+                self.all_tasks_done.notify_all()
+            self.not_full.notify_all()
+
+    def close(self):
+        '''
+        Clears the queue and makes later puts no-ops, so no producer stays blocked on it.
+        '''
+        with self.mutex:
+            self.closed = True
+        self.clear()
+
+
+def clear_queue(q):
+    '''
+    :param q: a BoundedQueue or a plain queue.Queue
+    '''
+    if isinstance(q, BoundedQueue):
+        q.clear()
+    else:
+        q.queue.clear()
+
+
+class Slots:
+    def __init__(self, name, size):
+        '''
+        :param name: label of the slot metrics, e.g. 'stt'
+        :param size: calls allowed in flight, 0 for no limit
+
+        with slots:
+            ...  # at most size threads run this at a time
+        '''
+        self.name = name
+        self.size = size
+        self._semaphore = threading.BoundedSemaphore(size) if size > 0 else None
+        self._lock = threading.Lock()
+        self.busy = 0
+        self.waiting = 0
+
+    def __enter__(self):
+        if self._semaphore is None:
+            return self
+        with self._lock:
+            self.waiting += 1
+        start = monotonic()
+        self._semaphore.acquire()
+        metrics.slot_wait_seconds.observe(monotonic() - start, stage=self.name)
+        with self._lock:
+            self.waiting -= 1
+            self.busy += 1
+        return self
+
+    def __exit__(self, *exc):
+        if self._semaphore is None:
+            return
+        with self._lock:
+            self.busy -= 1
+        self._semaphore.release()
+
+    @property
+    def backed_up(self) -> bool:
+        '''
+        True when more calls wait for a slot than there are slots.
+        '''
+        return self._semaphore is not None and self.waiting > self.size
+
+
+stt_slots = Slots('stt', STT_SLOTS)
+tts_slots = Slots('tts', TTS_SLOTS)
+
+
+def _slot_usage():
+    return {(('stage', s.name), ('state', state)): getattr(s, state)
+            for s in (stt_slots, tts_slots) for state in ('busy', 'waiting')}
+
+
+metrics.work_slots.fn = _slot_usage
+
+
+def check_admission(active, max_sessions=MAX_SESSIONS, retry_after=5):
+    '''
+    :param active: sessions running or being set up on this node
+    :param max_sessions: limit, 0 for no limit
+    :param retry_after: seconds the client is told to wait before retrying
+    Raises AtCapacity if the node should not take another session.
+    '''
+    if max_sessions and active >= max_sessions:
+        raise AtCapacity(f'{active} sessions running', retry_after)
+    for slots in (stt_slots, tts_slots):
+        if slots.backed_up:
+            raise AtCapacity(f'{slots.waiting} {slots.name} calls waiting for a slot', retry_after)
@@ -0,0 +1,99 @@
+'''
+Audio codecs of the websocket transport.
+
+The browser and the server agree on a codec with a hello message when the socket
+opens (see Session.configure). 'pcm' is raw int16 from the client and float32 to
+the client. 'opus' needs opuslib (and libopus) on the server and WebCodecs in the
+browser: it is about 3 kB/s per direction instead of 32-64 kB/s, in 20 ms frames.
+
+Opus messages are one or more packets, each prefixed with its length as a big
+endian uint16. Encoder and decoder live as long as the session, Opus keeps state
+between packets.
+'''
+import struct
+import numpy as np
+
+
+def available_codecs() -> list:
+    '''
+    :return: codecs this server can speak, preferred first
+    '''
+    try:
+        import opuslib  # noqa: F401
+        return ['opus', 'pcm']
+    except (ImportError, OSError):  # OSError: opuslib is installed but libopus is not
+        return ['pcm']
+
+
+def negotiate(offered) -> str:
+    '''
+    :param offered: codecs the client can speak
+    :return: the first codec of available_codecs the client offered, 'pcm' otherwise
+    '''
+    for codec in available_codecs():
+        if codec in offered:
+            return codec
+    return 'pcm'
+
+
+def pack(packets) -> bytes:
+    return b''.join(struct.pack('>H', len(p)) + p for p in packets)
+
+
+def unpack(message: bytes):
+    i = 0
+    while i + 2 <= len(message):
+        (n,) = struct.unpack_from('>H', message, i)
+        yield message[i + 2:i + 2 + n]
+        i += 2 + n
+
+
+class OpusEncoder:
+    def __init__(self, sample_rate=16000, frame_ms=20, bitrate=24000):
+        '''
+        :param sample_rate: rate of the audio passed to encode
+        :param frame_ms: duration of an Opus frame
+        :param bitrate: target bits per second
+        '''
+        import opuslib
+        self.sample_rate = sample_rate
+        self.bitrate = bitrate
+        self.frame = sample_rate * frame_ms // 1000
+        self._opuslib = opuslib
+        self.reset()
+
+    def reset(self):
+        '''
+        Starts a new stream, e.g. after the playback was stopped.
+        '''
+        self.encoder = self._opuslib.Encoder(self.sample_rate, 1, self._opuslib.APPLICATION_VOIP)
+        self.encoder.bitrate = self.bitrate
+
+    def encode(self, audio: np.ndarray) -> bytes:
+        '''
+        :param audio: float32 audio in [-1, 1]
+        :return: a message of Opus packets, the last frame padded with silence
+        '''
+        pcm = (np.clip(audio, -1, 1) * 32767).astype(np.int16)
+        pad = -len(pcm) % self.frame
+        if pad:
+            pcm = np.concatenate([pcm, np.zeros(pad, dtype=np.int16)])
+        frames = pcm.reshape(-1, self.frame)
+        return pack(self.encoder.encode(frame.tobytes(), self.frame) for frame in frames)
+
+
+class OpusDecoder:
+    def __init__(self, sample_rate=16000):
+        '''
+        :param sample_rate: rate of the decoded audio
+        '''
+        import opuslib
+        self.decoder = opuslib.Decoder(sample_rate, 1)
+        self.max_frame = sample_rate * 120 // 1000  # longest Opus packet
+
+    def decode(self, message: bytes) -> bytes:
+        '''
+        :param message: one or more length prefixed Opus packets
+        :return: int16 pcm
+        '''
+        return b''.join(self.decoder.decode(packet, self.max_frame) for packet in unpack(message))
@@ -0,0 +1,106 @@
+'''
+Jitter buffer between the websocket and the recording loops.
+
+Clients send packets of any size (20 ms from worklet_audio.html, ~370 ms from
+simple_audio.html) at irregular times. The recording loops and the VAD expect fixed
+frames at a steady pace. JitterBuffer turns the packets into fixed frames (512
+samples, what silero works on) and keeps a playout clock that starts when the first
+packet arrives. A frame that is late by less than delay_ms is waited for. A frame
+later than that is concealed by repeating the previous one with a fade-out, for up to
+conceal_ms. If audio is still missing after that, the stream counts as paused, e.g.
+the client stopped sending while the bot speaks. The clock restarts with the next
+packet.
+'''
+import queue
+from time import monotonic
+import numpy as np
+from . import metrics
+
+FRAME = 512  # samples per frame, silero vad's window at 16 kHz
+
+
+class JitterBuffer:
+    def __init__(self, get, frame=FRAME, rate=16000, delay_ms=60, conceal_ms=100, max_ms=2000):
+        '''
+        :param get: callable(timeout) returning the next packet of int16 pcm at rate, raising queue.Empty
+                    when none arrived within timeout seconds (None waits forever)
+        :param frame: samples per frame
+        :param rate: sample rate of the packets
+        :param delay_ms: how late a frame may be before it is concealed
+        :param conceal_ms: longest gap that is concealed, longer gaps pause the stream
+        :param max_ms: audio kept at most, the oldest is dropped beyond that
+        '''
+        self.get = get
+        self.frame = frame
+        self.rate = rate
+        self.frame_seconds = frame / rate
+        self.delay = delay_ms / 1000
+        self.conceal_frames = max(1, int(conceal_ms / 1000 / self.frame_seconds))
+        self.max_bytes = 2 * int(max_ms / 1000 * rate)
+        self.stats = {'frames': 0, 'concealed': 0, 'underruns': 0, 'dropped': 0}
+        self.reset()
+
+    def reset(self):
+        '''
+        Forgets buffered audio and stops the clock, e.g. at the start of a recording.
+        '''
+        self._buffer = b''
+        self._due = None  # when the next frame is due, None while the stream is paused
+        self._last = None
+        self._concealed = 0  # frames concealed in a row
+
+    def _fill(self, timeout):
+        self._buffer += self.get(timeout)
+        excess = len(self._buffer) - self.max_bytes
+        if excess > 0:
+            excess += excess % 2
+            self._buffer = self._buffer[excess:]
+            self.stats['dropped'] += excess // 2
+            metrics.jitter_events.inc(excess // 2, event='dropped_samples')
+
+    def _conceal(self) -> bytes:
+        if self._concealed == 0:
+            self.stats['underruns'] += 1
+            metrics.jitter_events.inc(event='underrun')
+        self._concealed += 1
+        self.stats['concealed'] += 1
+        metrics.jitter_events.inc(event='concealed')
+        self._due += self.frame_seconds
+        if self._last is None:
+            return bytes(2 * self.frame)
+        # fades out over conceal_frames, the gap stays audible as a gap to the vad
+        n = self.conceal_frames
+        fade = np.linspace(1 - (self._concealed - 1) / n, 1 - self._concealed / n, self.frame, dtype=np.float32)
+        return (np.frombuffer(self._last, dtype=np.int16) * fade).astype(np.int16).tobytes()
+
+    def read(self) -> bytes:
+        '''
+        :return: the next frame, int16 pcm of exactly frame samples
+        '''
+        frame_bytes = 2 * self.frame
+        while len(self._buffer) < frame_bytes:
+            if self._due is None:
+                # paused, wait for the client without a deadline
+                self._fill(None)
+                self._due = monotonic() + self.delay
+                self._concealed = 0
+                continue
+            timeout = self._due - monotonic()
+            if timeout > 0:
+                try:
+                    self._fill(timeout)
+                    continue
+                except queue.Empty:
+                    pass
+            if self._concealed >= self.conceal_frames:
+                self._due = None
+                self._last = None
+                continue
+            return self._conceal()
+        data, self._buffer = self._buffer[:frame_bytes], self._buffer[frame_bytes:]
+        self._last = data
+        self._concealed = 0
+        # frames fall due at the pace of the client's clock, a slow reader only lets audio pile up
+        self._due += self.frame_seconds
+        self.stats['frames'] += 1
+        return data
@@ -1,4 +1,6 @@
 from .base import BaseChatbot as BaseChatbot
 from .llm_gpt import Chatbot_gpt as Chatbot_gpt
 from .llm_llama import Chatbot_llama as Chatbot_llama
-from .llm_hf import Chatbot as Chatbot_hf
\ No newline at end of file
+from .llm_hf import Chatbot as Chatbot_hf
+from .cache import SemanticCache as SemanticCache
+from .llm_mock import Chatbot_scripted as Chatbot_scripted
\ No newline at end of file
@@ -1,6 +1,15 @@
 import queue
+import re
+from time import monotonic
+from ..tracing import NULL_TURN
+from ..cancel import NULL_TOKEN
+from .. import metrics
 
 class BaseChatbot:
+    cache = None
+    trace = NULL_TURN
+    cancel_token = NULL_TOKEN
+
     def __init__(self):
         '''
         Initialize the model and other things here
@@ -19,6 +28,42 @@ class BaseChatbot:
         '''
         return response
 
+    def use_cache(self, cache):
+        '''
+        :param cache: a SemanticCache (see llm/cache.py) or None to disable caching
+        Cached answers are streamed instead of calling self.run for similar utterances.
+        '''
+        self.cache = cache
+
+    def amend_last_response(self, response: str):
+        '''
+        :param response: replaces the last assistant message, e.g. with the part the user heard before interrupting
+        '''
+        messages = getattr(self, 'messages', None)
+        if messages and messages[-1].get('role') == 'assistant':
+            messages[-1]['content'] = response
+
+    def _history_len(self) -> int:
+        return len(getattr(self, 'messages', []))
+
+    def _cached_run(self, input_text: str):
+        '''
+        :param input_text: The user input
+        :return: (generator, cached) where cached is True if the answer comes from self.cache
+        '''
+        if self.cache is not None:
+            answer = self.cache.get(input_text, self._history_len())
+            if answer is not None:
+                if hasattr(self, 'messages'):
+                    self.messages.append({'role': 'user', 'content': input_text})
+                self.trace.set('cache_hit', True)
+                return iter(re.findall(r'\S+\s*', answer)), True
+        return self.run(input_text), False
+
+    def _cache_store(self, input_text: str, response: str, history_len: int):
+        if self.cache is not None:
+            self.cache.put(input_text, response, history_len)
+
     def generate_response(self, input_text: str) -> str:
         '''
         :param input_text: The user input
@@ -26,12 +71,15 @@ class BaseChatbot:
         Runs the self.run function and loops through the generator to get a response and
         then runs the self.post_process function before returning the response.
         '''
-        out = self.run(input_text)
+        history_len = self._history_len()
+        out, cached = self._cached_run(input_text)
         response_text = ''
         for o in out:
             text = o
             response_text += text
         response = self.post_process(response_text)
+        if not cached:
+            self._cache_store(input_text, response, history_len)
         return response
 
     def generate_response_stream(self, input_text: str, output_queue: queue.Queue,
@@ -41,15 +89,29 @@ class BaseChatbot:
         :param output_queue: The text output queue where the result is accumulated.
         :param interrupt_queue: The interrupt queue which stores the transcription if interruption occurred. Used to stop generating.
         :return: The chatbot's response after running self.post_process
+        Stops early once self.cancel_token is cancelled, the backend's run closes its stream then.
         '''
-        out = self.run(input_text)
+        start = monotonic()
+        history_len = self._history_len()
+        out, cached = self._cached_run(input_text)
         response_text = ''
+        interrupted = False
         for o in out:
-            if not interrupt_queue.empty():
+            if not interrupt_queue.empty() or self.cancel_token.cancelled:
                 break
             text = o
+            if not response_text:
+                metrics.stage_latency.observe(monotonic() - start, stage='llm')
+            self.trace.mark('llm_first_token')
             output_queue.put(text)
             response_text += text
+        interrupted = not interrupt_queue.empty() or self.cancel_token.cancelled
+        if interrupted and hasattr(out, 'close'):
+            # runs the finally blocks of the backend's generator, which stop the generation
+            out.close()
         output_queue.put(None)
+        self.cancel_token.stopped('llm')
         response = self.post_process(response_text)
+        if not cached and not interrupted:
+            self._cache_store(input_text, response, history_len)
         return response
@@ -0,0 +1,155 @@
+import re
+import threading
+from collections import OrderedDict
+from time import monotonic
+import numpy as np
+
+
+# words that make an utterance depend on what was said before it
+CONTEXT_WORDS = ['it', 'its', 'that', 'this', 'these', 'those', 'they', 'them', 'their',
+                 'he', 'she', 'him', 'her', 'one', 'ones', 'again', 'else', 'more', 'also',
+                 'instead', 'too', 'same', 'other', 'another']
+
+
+class SemanticCache:
+    def __init__(self, model_name='all-MiniLM-L6-v2', threshold=0.9, max_entries=256,
+                 ttl=3600, max_history=None, context_words=None, cache_audio=True,
+                 max_audio=512, embed_fn=None, device='cpu'):
+        '''
+        :param model_name: sentence-transformers model used to embed the utterances
+        :param threshold: minimum cosine similarity for a cached answer to be served
+        :param max_entries: maximum number of cached answers, least recently used are evicted
+        :param ttl: seconds after which a cached answer expires
+        :param max_history: do not use the cache once the conversation has more messages than this (None to disable)
+        :param context_words: utterances containing any of these words are neither served nor stored
+        :param cache_audio: if True the rendered audio of the spoken sentences is kept as well
+        :param max_audio: maximum number of cached audio clips
+        :param embed_fn: optional callable (str) -> 1d np.ndarray used instead of sentence-transformers
+        :param device: device for the embedding model
+
+        An in-process nearest neighbour cache of chatbot answers keyed by the embedding
+        of the user's utterance. Attach it with chatbot.use_cache(cache) and
+        mouth.use_cache(cache).
+        '''
+        if embed_fn is None:
+            from sentence_transformers import SentenceTransformer
+            model = SentenceTransformer(model_name, device=device)
+
+            def embed_fn(text):
+                return model.encode(text, normalize_embeddings=True)
+
+        self.embed_fn = embed_fn
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_history = max_history
+        self.context_words = set(CONTEXT_WORDS if context_words is None else context_words)
+        self.cache_audio = cache_audio
+        self.max_audio = max_audio
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # slot -> (question, answer, created)
+        self._vectors = None  # (max_entries, dim) matrix, row i holds the embedding of slot i
+        self._valid = np.zeros(max_entries, dtype=bool)
+        self._audio = OrderedDict()  # sentence -> (audio, sample_rate)
+        self.stats = {'hits': 0, 'misses': 0, 'skipped': 0, 'audio_hits': 0, 'audio_misses': 0}
+
+    def _embed(self, text):
+        vector = np.asarray(self.embed_fn(text), dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def cacheable(self, text, history_len=0):
+        '''
+        :param text: the user utterance
+        :param history_len: number of messages already in the conversation
+        :return: False if the utterance looks like it depends on the conversation state
+        '''
+        if self.max_history is not None and history_len > self.max_history:
+            return False
+        words = re.findall(r"[a-z']+", text.lower())
+        if not words:
+            return False
+        return not any(w in self.context_words for w in words)
+
+    def _expire(self, now):
+        expired = [slot for slot, (_, _, created) in self._entries.items() if now - created > self.ttl]
+        for slot in expired:
+            del self._entries[slot]
+            self._valid[slot] = False
+
+    def get(self, text, history_len=0):
+        '''
+        :param text: the user utterance
+        :param history_len: number of messages already in the conversation
+        :return: the cached answer or None
+        '''
+        if not self.cacheable(text, history_len):
+            self.stats['skipped'] += 1
+            return None
+        vector = self._embed(text)
+        with self._lock:
+            self._expire(monotonic())
+            if self._vectors is None or not self._valid.any():
+                self.stats['misses'] += 1
+                return None
+            scores = self._vectors @ vector
+            scores[~self._valid] = -np.inf
+            slot = int(np.argmax(scores))
+            if scores[slot] < self.threshold:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(slot)
+            self.stats['hits'] += 1
+            return self._entries[slot][1]
+
+    def put(self, text, answer, history_len=0):
+        '''
+        :param text: the user utterance
+        :param answer: the full chatbot answer to it
+        :param history_len: number of messages in the conversation before the utterance
+        '''
+        if not answer.strip() or not self.cacheable(text, history_len):
+            return
+        vector = self._embed(text)
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+            if self._valid.all():
+                slot, _ = self._entries.popitem(last=False)
+            else:
+                slot = int(np.argmin(self._valid))
+            self._vectors[slot] = vector
+            self._valid[slot] = True
+            self._entries[slot] = (text, answer, monotonic())
+
+    def get_audio(self, sentence):
+        '''
+        :param sentence: the sentence to be spoken
+        :return: (audio, sample_rate) if it was rendered before, else None
+        '''
+        if not self.cache_audio:
+            return None
+        with self._lock:
+            item = self._audio.get(sentence)
+            if item is None:
+                self.stats['audio_misses'] += 1
+                return None
+            self._audio.move_to_end(sentence)
+            self.stats['audio_hits'] += 1
+            return item
+
+    def put_audio(self, sentence, audio, sample_rate):
+        if not self.cache_audio:
+            return
+        with self._lock:
+            self._audio[sentence] = (audio, sample_rate)
+            self._audio.move_to_end(sentence)
+            while len(self._audio) > self.max_audio:
+                self._audio.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._valid[:] = False
+            self._audio.clear()
@@ -41,9 +41,18 @@ class Chatbot_gpt(BaseChatbot):
             # max
             stream=True,
         )
-        for chunk in stream:
-            if chunk.choices[0].delta.content is not None:
-                yield chunk.choices[0].delta.content
+        # closing the response from the cancelling thread unblocks the read of the next chunk
+        close = self.cancel_token.on_cancel(stream.close)
+        try:
+            for chunk in stream:
+                if chunk.choices[0].delta.content is not None:
+                    yield chunk.choices[0].delta.content
+        except Exception:
+            if not self.cancel_token.cancelled:
+                raise
+        finally:
+            self.cancel_token.remove(close)
+            stream.close()
 
     def post_process(self, response):
         self.messages.append({"role": "assistant", "content": response})
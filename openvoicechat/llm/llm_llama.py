@@ -21,13 +21,19 @@ class Chatbot_llama(BaseChatbot):
                                                 stream=True,
                                                 temperature=self.temperature)
         response_text = ''
-        for o in out:
-            if 'content' in o['choices'][0]['delta'].keys():
-                text = o['choices'][0]['delta']['content']
-                response_text += text
-                yield text
-            if o['choices'][0]['finish_reason'] is not None:
-                break
+        try:
+            for o in out:
+                if self.cancel_token.cancelled:
+                    break
+                if 'content' in o['choices'][0]['delta'].keys():
+                    text = o['choices'][0]['delta']['content']
+                    response_text += text
+                    yield text
+                if o['choices'][0]['finish_reason'] is not None:
+                    break
+        finally:
+            # llama.cpp evaluates tokens while the generator is iterated, closing it stops the generation
+            out.close()
 
     def post_process(self, response):
         self.messages.append({'role': 'assistant', 'content': response})
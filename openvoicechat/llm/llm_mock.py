@@ -0,0 +1,41 @@
+from time import sleep
+import re
+if __name__ == '__main__':
+    from base import BaseChatbot
+else:
+    from .base import BaseChatbot
+
+
+class Chatbot_scripted(BaseChatbot):
+    def __init__(self, responses=None, first_token_latency=0.4, token_interval=0.02):
+        '''
+        :param responses: answers returned in turn (cycled), defaults to a fixed two sentence answer
+        :param first_token_latency: seconds before the first token is yielded
+        :param token_interval: seconds between the following tokens
+
+        Local stand-in for an LLM with scripted token timing, for benchmarks and load tests.
+        '''
+        if responses is None:
+            responses = ["Sure, I can help with that. The new model ships next week and starts at 999 dollars."]
+        self.responses = responses
+        self.first_token_latency = first_token_latency
+        self.token_interval = token_interval
+        self.messages = []
+
+    def run(self, input_text):
+        self.messages.append({'role': 'user', 'content': input_text})
+        response = self.responses[(len(self.messages) // 2) % len(self.responses)]
+        sleep(self.first_token_latency)
+        for i, token in enumerate(re.findall(r'\S+\s*', response)):
+            if i:
+                sleep(self.token_interval)
+            yield token
+
+    def post_process(self, response):
+        self.messages.append({'role': 'assistant', 'content': response})
+        return response
+
+
+if __name__ == '__main__':
+    chatbot = Chatbot_scripted()
+    print(chatbot.generate_response('hello'))
@@ -0,0 +1,218 @@
+'''
+Prometheus style metrics for the pipeline.
+
+Counters and histograms aggregate per thread: every thread writes only to its own
+shard (no lock on the hot path) and the shards are summed when /metrics is scraped.
+Gauges that describe state (e.g. queue depths) are computed at scrape time.
+'''
+import threading
+import weakref
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+
+class _Sharded:
+    def __init__(self, name, help, registry):
+        self.name = name
+        self.help = help
+        self._local = threading.local()
+        self._shards = []  # (thread, shard) pairs
+        self._retired = {}  # shards of finished threads folded together
+        self._shards_lock = threading.Lock()
+        registry.register(self)
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = {}
+            self._local.shard = shard
+            with self._shards_lock:
+                self._retire()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _retire(self):
+        # sessions start threads per turn, fold the shards of finished ones so the list stays short
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._fold(self._retired, shard)
+        self._shards = alive
+
+    def _fold(self, into, shard):
+        raise NotImplementedError
+
+    def _snapshot(self):
+        with self._shards_lock:
+            self._retire()
+            return [dict(self._retired)] + [dict(shard) for _, shard in self._shards]
+
+
+class Counter(_Sharded):
+    type = 'counter'
+
+    def _fold(self, into, shard):
+        for key, value in shard.items():
+            into[key] = into.get(key, 0) + value
+
+    def inc(self, value=1, **labels):
+        shard = self._shard()
+        key = _key(labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def values(self) -> dict:
+        total = {}
+        for shard in self._snapshot():
+            self._fold(total, shard)
+        return total
+
+    def render(self):
+        return [f'{self.name}{_format_labels(key)} {value}' for key, value in sorted(self.values().items())]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def __init__(self, name, help, registry, fn=None):
+        '''
+        :param fn: optional callable () -> {labels dict as tuple: value} or a number, evaluated at scrape time
+        '''
+        super().__init__(name, help, registry)
+        self.fn = fn
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+    def values(self) -> dict:
+        if self.fn is None:
+            return super().values()
+        value = self.fn()
+        return value if isinstance(value, dict) else {(): value}
+
+
+class Histogram(_Sharded):
+    type = 'histogram'
+
+    def __init__(self, name, help, registry, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = _key(labels)
+        state = shard.get(key)
+        if state is None:
+            state = shard[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def _fold(self, into, shard):
+        for key, (counts, s, n) in shard.items():
+            if key not in into:
+                into[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            t = into[key]
+            t[0] = [a + b for a, b in zip(t[0], counts)]
+            t[1] += s
+            t[2] += n
+
+    def values(self) -> dict:
+        total = {}
+        for shard in self._snapshot():
+            self._fold(total, shard)
+        return total
+
+    def render(self):
+        lines = []
+        for key, (counts, s, n) in sorted(self.values().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(key, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(key, [("le", "+Inf")])} {n}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {s}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {n}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# queues registered by the websocket server and the pipelines, depth is read at scrape time
+_queues = {'input': weakref.WeakSet(), 'output': weakref.WeakSet()}
+
+
+def track_queue(kind, q):
+    '''
+    :param kind: 'input', 'output' or the name of a pipeline channel, e.g. 'tts'
+    :param q: a queue.Queue whose depth is exported while it is alive
+    '''
+    _queues.setdefault(kind, weakref.WeakSet()).add(q)
+
+
+def _queue_depths():
+    return {(('queue', kind),): sum(q.qsize() for q in list(queues)) for kind, queues in list(_queues.items())}
+
+
+active_sessions = Gauge('ovc_active_sessions', 'Websocket sessions currently running', REGISTRY)
+queue_depth = Gauge('ovc_queue_depth', 'Items waiting in the session queues and pipeline channels', REGISTRY, fn=_queue_depths)
+stage_latency = Histogram('ovc_stage_latency_seconds', 'Latency of the STT, LLM (first token) and TTS stages',
+                          REGISTRY)
+tts_cache = Counter('ovc_tts_cache_requests_total', 'TTS audio cache lookups by result', REGISTRY)
+resample_seconds = Histogram('ovc_resample_seconds', 'Time spent resampling websocket audio', REGISTRY,
+                             buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+audio_bytes = Counter('ovc_audio_bytes_total', 'Audio bytes received from and sent to clients', REGISTRY)
+interruptions = Counter('ovc_interruptions_total', 'Times the bot was interrupted by the user', REGISTRY)
+queue_dropped = Counter('ovc_queue_dropped_total', 'Items dropped by full drop_oldest queues', REGISTRY)
+sessions_rejected = Counter('ovc_sessions_rejected_total', 'Connections rejected because the node was at capacity',
+                            REGISTRY)
+work_slots = Gauge('ovc_work_slots', 'STT/TTS calls holding or waiting for a work slot', REGISTRY, fn=lambda: {})
+slot_wait_seconds = Histogram('ovc_slot_wait_seconds', 'Time STT/TTS calls waited for a work slot', REGISTRY)
+interruption_stop_seconds = Histogram('ovc_interruption_stop_seconds',
+                                      'Time from the start of an interrupting utterance to silence', REGISTRY)
+trimmed_seconds = Counter('ovc_trimmed_audio_seconds_total', 'Leading and trailing silence trimmed, by stage',
+                          REGISTRY)
+trim_saved_seconds = Counter('ovc_trim_saved_seconds_total',
+                             'Seconds saved by trimming: estimated STT compute, TTS dead air', REGISTRY)
+speculative_stt = Counter('ovc_speculative_stt_total', 'Speculative transcriptions by result: used, discarded',
+                          REGISTRY)
+speculative_stt_seconds = Counter('ovc_speculative_stt_seconds_total',
+                                  'STT seconds saved by used and wasted by discarded speculative transcriptions',
+                                  REGISTRY)
+cancellations = Counter('ovc_cancellations_total', 'Turns cancelled, by reason', REGISTRY)
+time_to_idle = Histogram('ovc_time_to_idle_seconds', 'Time from cancelling a turn until each stage stopped', REGISTRY)
+jitter_events = Counter('ovc_jitter_events_total', 'Websocket audio underruns, concealed frames and dropped samples',
+                        REGISTRY)
+
+
+def render() -> str:
+    return REGISTRY.render()
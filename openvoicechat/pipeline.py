@@ -0,0 +1,490 @@
+'''
+Long-lived pipeline of a chat session.
+
+run_chat used to start an llm and a tts thread for every turn, the mouth a playback
+and an interruption thread for every response, and every listen opened a new stream.
+Pipeline starts one thread per stage when the session starts and connects them with
+bounded channels that live as long as the session:
+
+    capture -> endpoint -> stt -> llm -> segment -> tts -> playback
+
+capture reads the microphone (or the listener) from a single stream. endpoint runs the
+VAD on every chunk: while the bot is idle it cuts utterances at silence_seconds of
+silence, while a response is active it looks for barge-ins. An ear with ends_turns
+(e.g. Ear_deepgram, whose server detects the end of speech) cuts its utterances itself,
+the VAD then only falls back after its fallback_seconds. Turn boundaries are items
+on the channels, not threads: every item carries its _Turn and the llm, segment and
+tts stages end a turn with (turn, None). A confirmed barge-in cancels the turn's
+CancelToken (see cancel.py), the stages then skip the rest of its items.
+'''
+import queue
+import threading
+from functools import partial
+from time import monotonic
+import re
+import numpy as np
+from . import metrics
+from .cancel import CancelToken
+from .tracing import tracer
+from .capacity import BoundedQueue, CHUNK_QUEUE_SIZE, TEXT_QUEUE_SIZE, AUDIO_QUEUE_SIZE, stt_slots
+from .utils import SessionClosed, ReadCancelled
+from .stt.utils import make_stream, DEFAULT_CHUNK, DEFAULT_RATE
+from .tts.base import remove_words_in_brackets_and_spaces, Playhead
+
+BARGE_IN_SECONDS = 2  # window of the barge-in VAD, like record_interruption
+
+
+class _Turn:
+    '''
+    One user utterance and the response to it, passed along the channels.
+    '''
+    def __init__(self, trace):
+        self.trace = trace
+        self.token = CancelToken()
+        self.user_input = ''
+        self.response = ''
+        self.sentences = []  # rendered sentences, in order
+        self.heard = None  # (sentence, its words the user heard) when interrupted
+        self.interruption = None  # transcription of the barge-in
+        self.started = None  # when the llm started on the turn
+        self.ended = threading.Event()  # an ear with ends_turns decided that the user stopped talking
+        self.played = threading.Event()  # the playback reached the end of the turn
+        self.done = threading.Event()  # every stage is done with the turn
+
+
+def _to_float32(frames):
+    return (np.frombuffer(b''.join(frames), dtype=np.int16) / (1 << 15)).astype(np.float32)
+
+
+class _UtteranceAudio:
+    '''
+    audio_queue for transcribe_stream, reads the chunks of one utterance off the stt channel.
+    '''
+    def __init__(self, channel, first):
+        self.channel = channel
+        self.first = first
+        self.closed = False
+
+    def get(self):
+        if self.first is not None:
+            data, self.first = self.first, None
+            return data
+        item = self.channel.get()
+        if item is None:
+            self.closed = True
+            return None
+        kind, _, payload = item
+        if kind == 'chunk':
+            return payload
+        return None
+
+
+class _Tagged:
+    '''
+    output_queue for generate_response_stream, puts (turn, token) on a channel.
+    '''
+    def __init__(self, channel, turn):
+        self.channel = channel
+        self.turn = turn
+
+    def put(self, item):
+        self.channel.put((self.turn, item))
+
+
+class Pipeline:
+    def __init__(self, mouth, ear, chatbot, session_id=None, enable_interruptions=True, verbose=True):
+        '''
+        :param mouth: BaseMouth, renders with _run_tts_cached and plays with its player
+        :param ear: BaseEar, its vad endpoints and its transcribe (transcribe_stream for stream ears) transcribes
+        :param chatbot: BaseChatbot, responds with generate_response_stream
+        :param session_id: id under which the turns are traced
+        :param enable_interruptions: if False nothing is captured while a response is active
+        :param verbose: prints the user's input
+        '''
+        self.mouth = mouth
+        self.ear = ear
+        self.chatbot = chatbot
+        self.session_id = tracer.new_session() if session_id is None else session_id
+        self.enable_interruptions = enable_interruptions
+        self.verbose = verbose
+        self.stopping = threading.Event()
+        self.error = None
+        self._active = None  # turn whose response is generated or played
+        self._idle = threading.Event()  # no response is active
+        self._idle.set()
+        self._pre_interruption = ''
+        self._checking = threading.Event()  # a barge-in is being transcribed
+        self._playhead = Playhead()  # of the turn being played
+        self._no_interrupt = BoundedQueue(1)  # interruptions reach the llm through the token
+        self._transcriptions = BoundedQueue(CHUNK_QUEUE_SIZE)
+        # stale microphone audio is worthless, the other channels make their producer wait
+        self.channels = {
+            'capture': BoundedQueue(CHUNK_QUEUE_SIZE, overflow='drop_oldest', name='capture'),
+            'stt': BoundedQueue(CHUNK_QUEUE_SIZE),
+            'llm': BoundedQueue(4),
+            'segment': BoundedQueue(TEXT_QUEUE_SIZE),
+            'tts': BoundedQueue(TEXT_QUEUE_SIZE),
+            'playback': BoundedQueue(AUDIO_QUEUE_SIZE),
+            'done': BoundedQueue(4),
+        }
+        for name, channel in self.channels.items():
+            metrics.track_queue(name, channel)
+        self.threads = []
+
+    def start(self):
+        for stage in (self._capture, self._endpoint, self._stt, self._llm, self._segment, self._tts, self._playback):
+            name = stage.__name__.strip('_')
+            thread = threading.Thread(target=self._run_stage, args=(stage,), name=f'{name}-{self.session_id}',
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def _run_stage(self, stage):
+        try:
+            stage()
+        except (SessionClosed, ReadCancelled) as e:
+            if not self.stopping.is_set():
+                self.error = self.error or e
+        except Exception as e:
+            self.error = self.error or e
+        finally:
+            # a stage that is gone stops the others, run_chat raises the error
+            if not self.stopping.is_set():
+                self.stopping.set()
+                self.channels['done'].put(None)
+
+    def stop(self, timeout=5.0):
+        '''
+        Cancels the active turn and stops every stage, waiting at most timeout seconds for them.
+        '''
+        self.stopping.set()
+        turn = self._active
+        if turn is not None:
+            turn.token.cancel('session_closed')
+            turn.played.set()
+            self.mouth.player.stop()
+        for channel in self.channels.values():
+            while True:
+                # wakes up producers blocked on the full channel, then ends the consumer
+                channel.clear()
+                try:
+                    channel.put_nowait(None)
+                    break
+                except queue.Full:
+                    continue
+        deadline = monotonic() + timeout
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(max(0, deadline - monotonic()))
+
+    def turns(self, stop_event=None):
+        '''
+        :param stop_event: stops yielding once set
+        Yields the finished turns, raises the error of a stage that failed.
+        '''
+        done = self.channels['done']
+        while stop_event is None or not stop_event.is_set():
+            try:
+                turn = done.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if turn is None:
+                break
+            yield turn
+        if self.error is not None:
+            raise self.error
+
+    # capture: one stream for the whole session
+
+    def _open(self):
+        listener = self.ear.listener
+        if listener is None:
+            stream = make_stream()
+            # the stage may pause while the bot speaks, the device buffer overflows meanwhile
+            return partial(stream.read, exception_on_overflow=False), DEFAULT_CHUNK
+        listener.make_stream(stop_event=self.stopping)
+        return listener.read, listener.CHUNK
+
+    def _capture(self):
+        read, chunk_size = self._open()
+        capture = self.channels['capture']
+        while not self.stopping.is_set():
+            if not self.enable_interruptions and not self._idle.is_set():
+                # nobody listens while the bot speaks, the listener's clock and queue restart afterwards
+                self._idle.wait(0.1)
+                if self._idle.is_set() and self.ear.listener is not None:
+                    read, chunk_size = self._open()
+                continue
+            data = read(chunk_size)
+            assert len(data) == chunk_size * 2, 'chunk size does not match 2 bytes per sample'
+            capture.put(data)
+
+    # endpoint: the VAD on every chunk
+
+    def _endpoint(self):
+        ear = self.ear
+        capture, stt = self.channels['capture'], self.channels['stt']
+        chunk_size, rate = (DEFAULT_CHUNK, DEFAULT_RATE) if ear.listener is None else (ear.listener.CHUNK,
+                                                                                        ear.listener.RATE)
+        chunk_seconds = chunk_size / rate
+        silence_seconds = ear.silence_seconds
+        if ear.ends_turns:
+            # the ear ends the utterances, the vad only falls back, e.g. when its connection is down
+            silence_seconds = getattr(ear, 'fallback_seconds', silence_seconds)
+        window = max(1, int(rate / chunk_size * silence_seconds))
+        barge_in_window = int(rate / chunk_size) * BARGE_IN_SECONDS
+        frames = []
+        utterance = None  # turn of the utterance being recorded, from the onset of speech
+        responding = None
+        while True:
+            data = capture.get()
+            if data is None:
+                return
+            if self._active is not responding:
+                # a response began or ended, the frames of the other mode are stale
+                responding = self._active
+                frames, utterance = [], None
+            frames.append(data)
+            if responding is not None:
+                if not self.enable_interruptions or responding.token.cancelled:
+                    frames = []
+                elif not self._checking.is_set() and ear.vad.contains_speech(frames[-barge_in_window:]):
+                    # the vad heard no speech up to the chunk before, so the speech started within the last chunk
+                    self._checking.set()
+                    stt.put(('barge_in', responding, (_to_float32(frames), monotonic() - chunk_seconds)))
+                    frames = []
+                else:
+                    frames = frames[-barge_in_window:]
+                continue
+            if utterance is not None and utterance.ended.is_set():
+                # the ear ended the utterance, the chunk already belongs to what follows it
+                self._end(utterance, None)
+                responding, utterance = utterance, None
+                frames = [data]
+                continue
+            contains_speech = ear.vad.contains_speech(frames[-window:])
+            if utterance is None:
+                if contains_speech:
+                    utterance = self._begin()
+                    if ear.speculator is not None:
+                        ear.speculator.reset()
+                    if ear.stream:
+                        for chunk in frames:
+                            stt.put(('chunk', utterance, chunk))
+                else:
+                    # keep what the vad looks at, the trimmer would cut the rest
+                    frames = frames[-window:]
+                continue
+            if ear.stream:
+                stt.put(('chunk', utterance, data))
+            if contains_speech:
+                if ear.speculator is not None:
+                    ear.speculator.on_chunk(frames, True)
+                continue
+            # the turn ends once silence_seconds of silence were heard, so speech ended that long ago
+            vad_decision = monotonic()
+            utterance.trace.mark('user_speech_end', vad_decision - silence_seconds)
+            utterance.trace.mark('vad_decision', vad_decision)
+            self._end(utterance, None if ear.stream else _to_float32(frames))
+            responding, utterance = utterance, None
+            frames = []
+
+    def _begin(self):
+        # no response is active, so every component is done with the previous turn:
+        # from here on their marks (the ear's while the user speaks too) land on the new one
+        turn = _Turn(tracer.begin_turn(self.session_id))
+        self.ear.trace = self.mouth.trace = self.chatbot.trace = turn.trace
+        self.mouth.cancel_token = self.chatbot.cancel_token = turn.token
+        return turn
+
+    def _end(self, turn, audio):
+        self._active = turn
+        self._idle.clear()
+        self.channels['stt'].put(('end', turn, audio))
+
+    # stt
+
+    def _transcribe(self, audio):
+        if not self.ear.stream:
+            with stt_slots:
+                return self.ear._transcribe_trimmed(audio)
+        audio_queue = queue.Queue()
+        pcm = (np.clip(audio, -1, 1) * 32767).astype(np.int16).tobytes()
+        audio_queue.put(pcm)
+        audio_queue.put(None)
+        self.ear.transcribe_stream(audio_queue, self._transcriptions)
+        return self._collect()
+
+    def _collect(self):
+        text = ''
+        while True:
+            part = self._transcriptions.get()
+            if part is None:
+                return text
+            text += part + ' '
+
+    def _stt(self):
+        ear = self.ear
+        stt, llm = self.channels['stt'], self.channels['llm']
+        while True:
+            item = stt.get()
+            if item is None:
+                return
+            kind, turn, payload = item
+            if kind == 'barge_in':
+                try:
+                    self._barge_in(turn, *payload)
+                finally:
+                    self._checking.clear()
+                continue
+            start = monotonic()
+            if kind == 'chunk':
+                # a stream ear transcribes while the user speaks
+                utterance = _UtteranceAudio(stt, payload)
+                if ear.ends_turns:
+                    # the endpoint stage ends the utterance once the ear set turn.ended
+                    ear.transcribe_stream(utterance, self._transcriptions, ended=turn.ended)
+                else:
+                    ear.transcribe_stream(utterance, self._transcriptions)
+                if utterance.closed:
+                    return
+                start = monotonic()
+                text = self._collect()
+            else:
+                text = None if ear.speculator is None else ear.speculator.result()
+                if text is None:
+                    text = self._transcribe(payload)
+            metrics.stage_latency.observe(monotonic() - start, stage='stt')
+            turn.trace.mark('stt_final')
+            turn.user_input = self._pre_interruption + ' ' + text
+            self._pre_interruption = ''
+            llm.put(turn)
+
+    def _barge_in(self, turn, audio, onset):
+        if turn.token.cancelled or turn.done.is_set():
+            return
+        text = self.ear.interruption(self._transcribe(audio))
+        if not text or turn.token.cancelled or turn.played.is_set():
+            return
+        turn.trace.mark('barge_in', onset)
+        turn.heard = self.mouth.interrupt(self._playhead, onset)
+        turn.interruption = text
+        self._pre_interruption = text
+        turn.token.cancel('interruption')
+
+    # llm
+
+    def _llm(self):
+        mouth, chatbot = self.mouth, self.chatbot
+        llm, segment, tts = self.channels['llm'], self.channels['segment'], self.channels['tts']
+        while True:
+            turn = llm.get()
+            if turn is None:
+                return
+            if self.verbose:
+                print('USER: ', turn.user_input)
+            turn.started = monotonic()
+            filler = mouth.fillers.pick(mouth.sample_rate) if mouth.fillers is not None else None
+            if filler is not None:
+                tts.put((turn, filler))
+            turn.response = chatbot.generate_response_stream(turn.user_input, _Tagged(segment, turn),
+                                                             self._no_interrupt)
+            # the history keeps what the user heard, not everything the llm generated
+            turn.played.wait()
+            if turn.heard is not None:
+                turn.response = '. '.join(mouth.heard_response(turn.sentences, *turn.heard))
+                chatbot.amend_last_response(turn.response)
+            if turn.token.cancelled:
+                turn.trace.mark('idle')
+            turn.token.stopped('turn')
+            turn.done.set()
+            self._active = None
+            self._idle.set()
+            if not self.stopping.is_set():
+                self.channels['done'].put(turn)
+
+    # segment: tokens to sentences
+
+    def _segment(self):
+        pattern = self.mouth.sentence_stop_pattern
+        segment, tts = self.channels['segment'], self.channels['tts']
+        response = ''
+        while True:
+            item = segment.get()
+            if item is None:
+                return
+            turn, text = item
+            if text is not None:
+                if turn.token.cancelled:
+                    continue
+                response += text
+                while re.search(pattern, response):
+                    sentence, response = re.split(pattern, response, maxsplit=1)
+                    self._put_sentence(tts, turn, sentence)
+                continue
+            if not turn.token.cancelled:
+                self._put_sentence(tts, turn, response)
+            response = ''
+            tts.put((turn, None))
+
+    @staticmethod
+    def _put_sentence(tts, turn, sentence):
+        clean_sentence = remove_words_in_brackets_and_spaces(sentence).strip()
+        if clean_sentence:
+            turn.trace.mark('first_sentence')
+            tts.put((turn, clean_sentence))
+
+    # tts
+
+    def _tts(self):
+        mouth = self.mouth
+        tts, playback = self.channels['tts'], self.channels['playback']
+        while True:
+            item = tts.get()
+            if item is None:
+                return
+            turn, sentence = item
+            if sentence is None:
+                turn.token.stopped('tts')
+                playback.put((turn, None))
+                continue
+            if turn.token.cancelled:
+                continue
+            if not isinstance(sentence, str):
+                # a filler, rendered already
+                playback.put((turn, sentence))
+                continue
+            output = mouth._run_tts_cached(sentence)
+            if output is None:
+                continue
+            turn.trace.mark('first_tts_chunk')
+            if mouth.fillers is not None and not turn.sentences:
+                mouth.fillers.observe(monotonic() - turn.started)
+            turn.sentences.append(sentence)
+            playback.put((turn, (output, sentence)))
+
+    # playback
+
+    def _playback(self):
+        mouth, player = self.mouth, self.mouth.player
+        playback = self.channels['playback']
+        while True:
+            item = playback.get()
+            if item is None:
+                return
+            turn, audio = item
+            if audio is None:
+                if turn.token.cancelled:
+                    player.stop()
+                    turn.token.stopped('playback')
+                else:
+                    player.wait()
+                self._playhead = Playhead()
+                turn.played.set()
+                continue
+            if turn.token.cancelled:
+                continue
+            output, text = audio
+            mouth.play_chunks(output, text, self._playhead, lambda: turn.token.cancelled,
+                              lambda: playback.qsize() > 0)
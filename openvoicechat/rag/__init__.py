@@ -0,0 +1,2 @@
+from .index import VectorIndex as VectorIndex
+from .retriever import HybridRetriever as HybridRetriever
\ No newline at end of file
@@ -0,0 +1,289 @@
+import os
+import re
+import json
+import hashlib
+from itertools import islice
+import numpy as np
+
+
+# name-<version>.ext, also the temporary files of a version
+VERSION_FILE = re.compile(r'-(\d+)\.[\w.]+$')
+
+
+def chunk_id(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def file_hash(file_path: str) -> str:
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class SentenceTransformerEmbedding:
+    def __init__(self, model_name='all-MiniLM-L6-v2', device='cpu', batch_size=64):
+        '''
+        Minimal embedding function with the langchain interface, for use without langchain.
+        '''
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device=device)
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts):
+        return self.model.encode(texts, batch_size=self.batch_size, normalize_embeddings=True)
+
+    def embed_query(self, text):
+        return self.model.encode(text, normalize_embeddings=True)
+
+
+class VectorIndex:
+    def __init__(self, path, embedding_function=None, read_only=False):
+        '''
+        :param path: directory where the index is stored
+        :param embedding_function: object with embed_documents(list) and embed_query(str), e.g. a langchain embedding
+        :param read_only: open the vectors memory mapped and never write. Use this in worker processes so that
+                          startup does not embed anything and the index pages are shared between processes.
+
+        A persistent on-disk vector index. Chunks are keyed by the hash of their content and
+        documents by the hash of their file, so only new or changed documents are embedded.
+        The vectors and texts are append only files. A commit appends the chunks added since
+        the last one and then atomically swaps the manifest, which holds the number of committed
+        rows, so readers never see a half written index. Only a commit that drops chunks (of a
+        changed or removed document) rewrites them, as a new generation of the files.
+        '''
+        self.path = path
+        self.embedding_function = embedding_function
+        self.read_only = read_only
+        self.documents = {}  # source -> {'hash': file hash, 'chunks': [chunk ids]}
+        self.ids = []
+        self.texts = []
+        self.version = 0
+        self._rows = {}
+        # rows beyond len(ids) are preallocated, see _reserve
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._generation = None  # version that started the files commits append to
+        self._persisted = 0  # rows in those files
+        self._chunks_bytes = 0
+        if not read_only:
+            os.makedirs(path, exist_ok=True)
+        self.load()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.path, 'manifest.json')
+
+    def _file(self, name, version):
+        return os.path.join(self.path, f'{name}-{version}')
+
+    def version_file(self, name: str, ext: str = '') -> str:
+        '''
+        :return: path of a file that belongs to the loaded version, e.g. data derived from it
+                 (see HybridRetriever.from_index). The next commit removes it with the version.
+        '''
+        return self._file(name, self.version) + ext
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors[:len(self.ids)]
+
+    def load(self):
+        '''
+        (Re)loads the last committed version of the index from disk.
+        '''
+        for attempt in range(3):
+            if not os.path.exists(self.manifest_path):
+                return
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            try:
+                texts, vectors = self._read(manifest)
+                break
+            except FileNotFoundError:
+                # a writer committed a newer version while we were reading, try again
+                if attempt == 2:
+                    raise
+        self.version = manifest['version']
+        self.documents = manifest['documents']
+        self.ids = manifest['ids']
+        self.texts = texts
+        self._vectors = vectors
+        self._rows = {i: row for row, i in enumerate(self.ids)}
+        self._generation = manifest.get('generation')
+        self._persisted = len(self.ids)
+        self._chunks_bytes = manifest.get('chunks_bytes', 0)
+
+    def _read(self, manifest):
+        rows = len(manifest['ids'])
+        generation = manifest.get('generation')
+        if generation is None:
+            # written before the files were append only, the next commit writes a generation
+            with open(self._file('chunks', manifest['version']) + '.jsonl') as f:
+                texts = [json.loads(line) for line in f]
+            mmap_mode = 'r' if self.read_only else None
+            return texts, np.load(self._file('vectors', manifest['version']) + '.npy', mmap_mode=mmap_mode)
+        # the files may already hold rows of a newer commit, only the committed ones are read
+        with open(self._file('chunks', generation) + '.jsonl') as f:
+            texts = [json.loads(line) for line in islice(f, rows)]
+        shape = (rows, manifest['dim'])
+        path = self._file('vectors', generation) + '.f32'
+        if self.read_only and rows:
+            return texts, np.memmap(path, dtype=np.float32, mode='r', shape=shape)
+        return texts, np.fromfile(path, dtype=np.float32, count=rows * shape[1]).reshape(shape)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, chunk: str):
+        return chunk in self._rows
+
+    def document_changed(self, source: str, doc_hash: str) -> bool:
+        '''
+        :param source: name of the document (e.g. its path)
+        :param doc_hash: hash of the document, see file_hash
+        :return: True if the document is not indexed yet or its content changed
+        '''
+        document = self.documents.get(source)
+        return document is None or document['hash'] != doc_hash
+
+    def embed_documents(self, texts):
+        vectors = np.asarray(self.embedding_function.embed_documents(texts), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    def embed_query(self, query: str) -> np.ndarray:
+        vector = np.asarray(self.embedding_function.embed_query(query), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def add_chunks(self, texts, vectors=None) -> list:
+        '''
+        :param texts: chunk texts
+        :param vectors: optional precomputed embeddings for the texts
+        :return: the chunk ids
+        Adds the chunks that are not in the index yet. Only those are embedded.
+        '''
+        if self.read_only:
+            raise RuntimeError('The index was opened read only')
+        ids = [chunk_id(t) for t in texts]
+        seen = set(self._rows)
+        new = []
+        for n, i in enumerate(ids):
+            if i not in seen:
+                seen.add(i)
+                new.append(n)
+        if new:
+            if vectors is None:
+                new_vectors = self.embed_documents([texts[n] for n in new])
+            else:
+                new_vectors = np.asarray(vectors, dtype=np.float32)[new]
+            size = len(self.ids)
+            self._reserve(size + len(new), new_vectors.shape[1])
+            self._vectors[size:size + len(new)] = new_vectors
+            for n in new:
+                self._rows[ids[n]] = len(self.ids)
+                self.ids.append(ids[n])
+                self.texts.append(texts[n])
+        return ids
+
+    def _reserve(self, rows, dim):
+        # grows the matrix geometrically, so adding a batch only copies the batch
+        vectors = self._vectors
+        if len(vectors) >= rows and vectors.shape[1] == dim and vectors.flags.writeable:
+            return
+        size = len(self.ids)
+        self._vectors = np.empty((max(rows, 2 * len(vectors), 256), dim), dtype=np.float32)
+        if size:
+            self._vectors[:size] = vectors[:size]
+
+    def add_document(self, source: str, texts, doc_hash: str = None, vectors=None) -> int:
+        '''
+        :param source: name of the document (e.g. its path)
+        :param texts: the chunks of the document
+        :param doc_hash: hash of the document, defaults to the hash of its chunks
+        :param vectors: optional precomputed embeddings for the texts
+        :return: the number of chunks that had to be embedded
+        Replaces the chunks of the document. Call commit to write the changes.
+        '''
+        before = len(self.ids)
+        ids = self.add_chunks(texts, vectors)
+        if doc_hash is None:
+            doc_hash = chunk_id(''.join(ids))
+        self.documents[source] = {'hash': doc_hash, 'chunks': ids}
+        return len(self.ids) - before
+
+    def remove_document(self, source: str):
+        self.documents.pop(source, None)
+
+    def commit(self):
+        '''
+        Drops the chunks no longer referenced by any document and writes a new version of the index.
+        Only the chunks added since the last commit are written, unless chunks were dropped.
+        '''
+        if self.read_only:
+            raise RuntimeError('The index was opened read only')
+        referenced = set()
+        for document in self.documents.values():
+            referenced.update(document['chunks'])
+        keep = [row for row, i in enumerate(self.ids) if i in referenced]
+        if len(keep) != len(self.ids):
+            self._vectors = self.vectors[keep]
+            self.ids = [self.ids[row] for row in keep]
+            self.texts = [self.texts[row] for row in keep]
+            self._rows = {i: row for row, i in enumerate(self.ids)}
+            # the files still hold the dropped rows
+            self._generation = None
+
+        version = self.version + 1
+        if self._generation is None:
+            self._generation = version
+            self._persisted = 0
+            self._chunks_bytes = 0
+        self._append()
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': version, 'generation': self._generation, 'dim': self.vectors.shape[1],
+                       'chunks_bytes': self._chunks_bytes, 'documents': self.documents, 'ids': self.ids}, f)
+        os.replace(tmp, self.manifest_path)
+        self.version = version
+        # readers that still have an old version mapped keep it alive until they reload
+        live = {os.path.basename(self._file(name, self._generation)) + ext
+                for name, ext in (('vectors', '.f32'), ('chunks', '.jsonl'))}
+        for name in os.listdir(self.path):
+            match = VERSION_FILE.search(name)
+            if match is not None and int(match.group(1)) < version and name not in live:
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    pass
+
+    def _append(self):
+        # rows past the committed ones are left over from a commit that did not finish, cut them off
+        rows = len(self.ids)
+        vectors = self.vectors
+        with open(self._file('vectors', self._generation) + '.f32', 'ab') as f:
+            f.truncate(self._persisted * vectors.shape[1] * vectors.itemsize)
+            f.write(np.ascontiguousarray(vectors[self._persisted:], dtype=np.float32).tobytes())
+        with open(self._file('chunks', self._generation) + '.jsonl', 'ab') as f:
+            f.truncate(self._chunks_bytes)
+            for text in self.texts[self._persisted:rows]:
+                line = (json.dumps(text) + '\n').encode('utf-8')
+                f.write(line)
+                self._chunks_bytes += len(line)
+        self._persisted = rows
+
+    def search(self, query: str, k: int = 4):
+        '''
+        :param query: the query text
+        :param k: number of chunks to return
+        :return: list of (text, score) sorted by cosine similarity
+        '''
+        if len(self.ids) == 0:
+            return []
+        scores = self.vectors @ self.embed_query(query)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.texts[row], float(scores[row])) for row in top]
@@ -0,0 +1,262 @@
+'''
+Parallel document ingestion for the RAG index.
+
+Pages are extracted in a process pool, chunks are embedded in batches on a separate
+stage with a bounded queue in between, and the index is committed incrementally.
+
+    python -m openvoicechat.rag.ingest uploads/ --index uploads/index --workers 4
+'''
+import os
+import sys
+import argparse
+import threading
+import queue
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import monotonic
+
+if __name__ == '__main__':
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    from openvoicechat.rag.index import VectorIndex, SentenceTransformerEmbedding, file_hash, chunk_id
+else:
+    from .index import VectorIndex, SentenceTransformerEmbedding, file_hash, chunk_id
+
+
+def _lower_priority(niceness):
+    # runs in every pool worker so extraction does not starve live sessions
+    if hasattr(os, 'nice'):
+        try:
+            os.nice(niceness)
+        except OSError:
+            pass
+
+
+def page_count(file_path: str) -> int:
+    import pypdf
+    return len(pypdf.PdfReader(file_path).pages)
+
+
+def extract_pages(file_path: str, start: int, stop: int) -> list:
+    '''
+    :return: the text of pages [start, stop) of the pdf
+    '''
+    import pypdf
+    reader = pypdf.PdfReader(file_path)
+    return [(reader.pages[n].extract_text() or '').strip() for n in range(start, stop)]
+
+
+def split_text(text: str, chunk_size=500, chunk_overlap=50) -> list:
+    '''
+    Splits on whitespace into chunks of at most chunk_size characters overlapping by about chunk_overlap.
+    '''
+    words = text.split()
+    chunks = []
+    current = []
+    length = 0
+    for word in words:
+        if current and length + len(word) + 1 > chunk_size:
+            chunks.append(' '.join(current))
+            overlap = []
+            overlap_length = 0
+            for w in reversed(current):
+                if overlap_length + len(w) + 1 > chunk_overlap:
+                    break
+                overlap.insert(0, w)
+                overlap_length += len(w) + 1
+            current = overlap
+            length = overlap_length
+        current.append(word)
+        length += len(word) + 1
+    if current:
+        chunks.append(' '.join(current))
+    return chunks
+
+
+def find_documents(paths, extensions=('.pdf',)) -> list:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, n) for n in sorted(names) if n.lower().endswith(extensions))
+        else:
+            files.append(path)
+    return files
+
+
+class IngestPipeline:
+    def __init__(self, index: VectorIndex, split_fn=split_text, workers=None, pages_per_task=8,
+                 batch_size=64, max_pending=4, commit_every=16, niceness=10, progress=None):
+        '''
+        :param index: a writable VectorIndex
+        :param split_fn: callable (text) -> list of chunks
+        :param workers: number of extraction processes, defaults to half the cores
+        :param pages_per_task: pages extracted per process pool task
+        :param batch_size: chunks embedded per call
+        :param max_pending: documents allowed between the extraction and embedding stages, bounds memory
+        :param commit_every: commit the index after this many documents
+        :param niceness: priority decrease of the extraction processes
+        :param progress: callable (dict) called after every document, defaults to printing
+        '''
+        self.index = index
+        self.split_fn = split_fn
+        self.workers = workers or max(1, (os.cpu_count() or 2) // 2)
+        self.pages_per_task = pages_per_task
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.commit_every = commit_every
+        self.niceness = niceness
+        self.progress_fn = progress or (lambda p: print(
+            f"* ingested {p['documents_done']}/{p['documents_total']} documents, "
+            f"{p['chunks_embedded']} chunks embedded, {p['elapsed']:.1f}s"))
+        self.progress = {}
+        self.thread = None
+        self.error = None
+        self._lock = threading.Lock()
+
+    def _extract(self, pool, files, chunk_queue):
+        try:
+            self._extract_documents(pool, files, chunk_queue)
+        finally:
+            chunk_queue.put(None)
+
+    def _extract_documents(self, pool, files, chunk_queue):
+        # keeps a window of documents in flight so small documents still use every worker
+        in_flight = deque()
+        files = iter(files)
+        while self.error is None:
+            while len(in_flight) < self.workers * 2:
+                file_path = next(files, None)
+                if file_path is None:
+                    break
+                try:
+                    doc_hash = file_hash(file_path)
+                    if not self.index.document_changed(file_path, doc_hash):
+                        self._update(documents_skipped=1)
+                        continue
+                    n_pages = page_count(file_path)
+                except Exception as e:
+                    self._update(errors=1)
+                    print(f'* could not read {file_path}: {e}')
+                    continue
+                futures = [pool.submit(extract_pages, file_path, start, min(start + self.pages_per_task, n_pages))
+                           for start in range(0, n_pages, self.pages_per_task)]
+                in_flight.append((file_path, doc_hash, futures))
+            if not in_flight:
+                break
+            file_path, doc_hash, futures = in_flight.popleft()
+            try:
+                pages = [page for future in futures for page in future.result()]
+            except Exception as e:
+                self._update(errors=1)
+                print(f'* could not extract {file_path}: {e}')
+                continue
+            self._update(pages=len(pages))
+            chunk_queue.put((file_path, doc_hash, self.split_fn('\n'.join(pages))))
+        # the embedding stage failed, don't extract the rest
+        for _, _, futures in in_flight:
+            for future in futures:
+                future.cancel()
+
+    def _embed(self, chunk_queue):
+        documents = iter(chunk_queue.get, None)
+        try:
+            self._embed_documents(documents)
+        except BaseException as e:
+            self.error = e
+            # keep taking documents so that _extract never blocks on the full queue
+            for _ in documents:
+                pass
+
+    def _embed_documents(self, documents):
+        since_commit = 0
+        for file_path, doc_hash, chunks in documents:
+            seen = set()
+            todo = []
+            for chunk in chunks:
+                i = chunk_id(chunk)
+                if i not in self.index and i not in seen:
+                    seen.add(i)
+                    todo.append(chunk)
+            for start in range(0, len(todo), self.batch_size):
+                batch = todo[start:start + self.batch_size]
+                self.index.add_chunks(batch, self.index.embed_documents(batch))
+                self._update(chunks_embedded=len(batch))
+            self.index.add_document(file_path, chunks, doc_hash)
+            since_commit += 1
+            if since_commit >= self.commit_every:
+                self.index.commit()
+                since_commit = 0
+            self._update(documents_done=1)
+            self.progress_fn(dict(self.progress))
+        if since_commit:
+            self.index.commit()
+
+    def _update(self, **counts):
+        with self._lock:
+            for key, value in counts.items():
+                self.progress[key] = self.progress.get(key, 0) + value
+            self.progress['elapsed'] = monotonic() - self._start
+
+    def run(self, paths) -> dict:
+        '''
+        :param paths: files or directories to ingest
+        :return: the final progress counters
+        Blocks until every document is ingested. Raises the error of the embedding stage,
+        e.g. of the embedding model or of writing the index, once the extraction stopped.
+        '''
+        files = find_documents(paths)
+        self.error = None
+        self._start = monotonic()
+        self.progress = {'documents_total': len(files), 'documents_done': 0, 'documents_skipped': 0,
+                         'chunks_embedded': 0, 'pages': 0, 'errors': 0, 'elapsed': 0.0}
+        chunk_queue = queue.Queue(maxsize=self.max_pending)
+        embed_thread = threading.Thread(target=self._embed, args=(chunk_queue,), daemon=True)
+        embed_thread.start()
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_lower_priority,
+                                 initargs=(self.niceness,)) as pool:
+            self._extract(pool, files, chunk_queue)
+        embed_thread.join()
+        if self.error is not None:
+            self.progress['error'] = repr(self.error)
+            raise self.error
+        self.progress['done'] = True
+        return self.progress
+
+    def start(self, paths, on_done=None) -> threading.Thread:
+        '''
+        :param paths: files or directories to ingest
+        :param on_done: callable (progress) called when finished, e.g. to reload the index of a chatbot
+        Runs the ingestion on a background thread, so it can be used from the server.
+        If it fails on_done is not called, the error is kept in self.error and in the progress.
+        '''
+        def target():
+            try:
+                progress = self.run(paths)
+            except Exception as e:
+                print(f'* ingestion failed: {e!r}')
+                return
+            if on_done is not None:
+                on_done(progress)
+
+        self.thread = threading.Thread(target=target, daemon=True)
+        self.thread.start()
+        return self.thread
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest documents into the RAG index')
+    parser.add_argument('paths', nargs='+', help='pdf files or directories')
+    parser.add_argument('--index', default='uploads/index')
+    parser.add_argument('--model', default='all-MiniLM-L6-v2')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--chunk-overlap', type=int, default=50)
+    args = parser.parse_args()
+
+    embedding = SentenceTransformerEmbedding(args.model, device=args.device, batch_size=args.batch_size)
+    index = VectorIndex(args.index, embedding_function=embedding)
+    pipeline = IngestPipeline(index, workers=args.workers, batch_size=args.batch_size,
+                              split_fn=lambda text: split_text(text, args.chunk_size, args.chunk_overlap))
+    print(pipeline.run(args.paths))
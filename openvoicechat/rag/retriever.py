@@ -0,0 +1,228 @@
+import os
+import re
+import json
+import math
+import threading
+from collections import Counter, OrderedDict, defaultdict
+import numpy as np
+
+# keeps product names and SKUs like "a2-1234" or "v1.5" as single tokens
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+
+
+def tokenize(text: str) -> list:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def _write_atomic(path, write, mode='wb'):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, mode) as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+class BM25:
+    ARRAYS = ('norm', 'offsets', 'docs', 'tfs', 'idf')
+
+    def __init__(self, texts, k1=1.5, b=0.75):
+        '''
+        :param texts: the documents
+        Sparse inverted index. The postings of all terms are stored back to back in flat numpy
+        arrays of document ids and term frequencies, so that scoring a query is a handful of
+        vectorized scatter-adds and the arrays can be saved and memory mapped (see from_arrays).
+        '''
+        self.k1 = k1
+        self.size = len(texts)
+        doc_len = np.zeros(self.size, dtype=np.float32)
+        postings = defaultdict(lambda: ([], []))
+        for doc, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_len[doc] = sum(counts.values())
+            for term, tf in counts.items():
+                postings[term][0].append(doc)
+                postings[term][1].append(tf)
+        avg_len = doc_len.mean() if self.size else 1.0
+        self.norm = (k1 * (1 - b + b * doc_len / max(avg_len, 1e-6))).astype(np.float32)
+        self.terms = {}  # term -> row of offsets and idf
+        docs, tfs, offsets, idf = [], [], [0], []
+        for term, (term_docs, term_tfs) in postings.items():
+            self.terms[term] = len(idf)
+            docs.extend(term_docs)
+            tfs.extend(term_tfs)
+            offsets.append(len(docs))
+            idf.append(math.log(1 + (self.size - len(term_docs) + 0.5) / (len(term_docs) + 0.5)))
+        self.docs = np.array(docs, dtype=np.int32)
+        self.tfs = np.array(tfs, dtype=np.float32)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.idf = np.array(idf, dtype=np.float32)
+
+    @classmethod
+    def from_arrays(cls, terms, k1, **arrays):
+        '''
+        :param terms: the terms in the order of their rows
+        :param k1: the k1 the arrays were built with
+        :param arrays: the ARRAYS of a BM25, e.g. memory mapped
+        '''
+        bm25 = cls.__new__(cls)
+        bm25.k1 = k1
+        bm25.terms = {term: row for row, term in enumerate(terms)}
+        for name in cls.ARRAYS:
+            setattr(bm25, name, arrays[name])
+        bm25.size = len(bm25.norm)
+        return bm25
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(self.size, dtype=np.float32)
+        for term in set(tokenize(query)):
+            row = self.terms.get(term)
+            if row is None:
+                continue
+            start, end = self.offsets[row], self.offsets[row + 1]
+            docs, tfs = self.docs[start:end], self.tfs[start:end]
+            scores[docs] += self.idf[row] * tfs * (self.k1 + 1) / (tfs + self.norm[docs])
+        return scores
+
+
+class HybridRetriever:
+    def __init__(self, texts, vectors, embed_query, dtype='int8', alpha=0.6,
+                 cache_size=256, block_size=8192, scale=None, bm25=None):
+        '''
+        :param texts: the chunk texts
+        :param vectors: (n, dim) float embeddings of the chunks, rows L2 normalized,
+                        or the matrix already stored as dtype (e.g. memory mapped, int8 needs its scale)
+        :param embed_query: callable (str) -> 1d normalized query embedding
+        :param dtype: 'int8', 'float16' or 'float32' storage for the embedding matrix
+        :param alpha: weight of the dense score, (1 - alpha) goes to BM25
+        :param cache_size: number of query embeddings kept for repeated queries
+        :param block_size: rows scored at a time, bounds the temporary float32 copy
+        :param scale: per row scale of an int8 matrix passed as vectors
+        :param bm25: a BM25 of the texts built before, e.g. loaded with the matrix
+
+        Local retriever that fuses a quantized dense matrix with a BM25 inverted index.
+        Use HybridRetriever.from_index to build it from a VectorIndex.
+        '''
+        self.texts = list(texts)
+        self.embed_query_fn = embed_query
+        self.dtype = dtype
+        self.alpha = alpha
+        self.block_size = block_size
+        vectors = np.asarray(vectors)
+        if vectors.dtype == np.dtype(dtype) and (dtype != 'int8' or scale is not None):
+            # stored already, a memory map stays one
+            self.matrix = vectors
+            self.scale = scale
+        elif len(vectors) == 0:
+            # nothing indexed yet, e.g. a read only worker started before the first commit
+            self.matrix = np.zeros((0, vectors.shape[1] if vectors.ndim == 2 else 0), dtype=dtype)
+            self.scale = np.zeros(0, dtype=np.float32) if dtype == 'int8' else None
+        elif dtype == 'int8':
+            vectors = vectors.astype(np.float32, copy=False)
+            scale = np.abs(vectors).max(axis=1) / 127.0
+            scale[scale == 0] = 1.0
+            self.matrix = np.round(vectors / scale[:, None]).astype(np.int8)
+            self.scale = scale.astype(np.float32)
+        else:
+            self.matrix = vectors.astype(dtype)
+            self.scale = None
+        self.bm25 = BM25(self.texts) if bm25 is None else bm25
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_index(cls, index, dtype='int8', **kwargs):
+        '''
+        :param index: a VectorIndex
+        :param dtype: see __init__
+
+        The quantized matrix and the BM25 postings are stored next to the committed version of
+        the index and memory mapped, like its vectors. Worker processes opening the index read only
+        share their pages and start without quantizing or tokenizing anything. The first writable
+        index that opens a version builds and saves them, a read only one only builds them in memory.
+        '''
+        if index.version == 0:
+            return cls(index.texts, index.vectors, index.embed_query, dtype=dtype, **kwargs)
+        try:
+            return cls._load(index, dtype, **kwargs)
+        except FileNotFoundError:
+            # not built yet, or a writer committed a newer version meanwhile
+            pass
+        retriever = cls(index.texts, index.vectors, index.embed_query, dtype=dtype, **kwargs)
+        if not index.read_only:
+            retriever.save(index)
+        return retriever
+
+    @classmethod
+    def _load(cls, index, dtype, **kwargs):
+        with open(index.version_file(f'retriever-{dtype}', '.json')) as f:
+            meta = json.load(f)
+
+        def load(name):
+            return np.load(index.version_file(f'retriever-{dtype}-{name}', '.npy'), mmap_mode='r')
+
+        bm25 = BM25.from_arrays(meta['terms'], meta['k1'], **{name: load('bm25-' + name) for name in BM25.ARRAYS})
+        matrix = index.vectors if dtype == 'float32' else load('matrix')
+        scale = load('scale') if dtype == 'int8' else None
+        return cls(index.texts, matrix, index.embed_query, dtype=dtype, scale=scale, bm25=bm25, **kwargs)
+
+    def save(self, index):
+        '''
+        :param index: the VectorIndex the retriever was built from
+        Writes the matrix and the BM25 postings next to the loaded version of the index, see from_index.
+        A later commit of the index removes them with the version.
+        '''
+        arrays = {'bm25-' + name: getattr(self.bm25, name) for name in BM25.ARRAYS}
+        if self.dtype != 'float32':
+            # a float32 matrix is the vectors of the index
+            arrays['matrix'] = self.matrix
+        if self.scale is not None:
+            arrays['scale'] = self.scale
+        for name, array in arrays.items():
+            _write_atomic(index.version_file(f'retriever-{self.dtype}-{name}', '.npy'),
+                          lambda f: np.save(f, np.ascontiguousarray(array)))
+        meta = {'k1': self.bm25.k1, 'terms': list(self.bm25.terms)}
+        # written last, the other files are complete once it exists
+        _write_atomic(index.version_file(f'retriever-{self.dtype}', '.json'), lambda f: json.dump(meta, f), mode='w')
+
+    def embed_query(self, query: str) -> np.ndarray:
+        key = query.strip().lower()
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+                return vector
+        vector = np.asarray(self.embed_query_fn(query), dtype=np.float32)
+        with self._lock:
+            self._cache[key] = vector
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return vector
+
+    def dense_scores(self, query_vector: np.ndarray) -> np.ndarray:
+        n = len(self.matrix)
+        scores = np.empty(n, dtype=np.float32)
+        for start in range(0, n, self.block_size):
+            block = self.matrix[start:start + self.block_size].astype(np.float32)
+            scores[start:start + len(block)] = block @ query_vector
+        if self.scale is not None:
+            scores *= self.scale
+        return scores
+
+    def search(self, query: str, k: int = 4):
+        '''
+        :param query: the query text
+        :param k: number of chunks to return
+        :return: list of (text, score) sorted by the fused score
+        '''
+        if not self.texts:
+            return []
+        scores = self.alpha * self.dense_scores(self.embed_query(query))
+        if self.alpha < 1:
+            sparse = self.bm25.scores(query)
+            top_sparse = sparse.max()
+            if top_sparse > 0:
+                scores += (1 - self.alpha) * sparse / top_sparse
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.texts[i], float(scores[i])) for i in top]
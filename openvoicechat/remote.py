@@ -0,0 +1,262 @@
+'''
+STT/TTS models hosted in dedicated worker processes.
+
+Inference in the session threads competes with run_chat and BaseMouth.say for the
+GIL. A ModelPool starts worker processes that each load one model (e.g. Ear_hf or
+Mouth_piper) and serve one method of it (transcribe or run_tts). Requests are small
+control messages over a pipe; audio goes through shared memory ring buffers, one
+per direction per worker, instead of being pickled. Sessions share a pool through
+Ear_remote / Mouth_remote, and throughput scales with the number of workers.
+
+    pool = ModelPool('openvoicechat.stt.stt_hf:Ear_hf', 'transcribe', workers=2,
+                     model_kwargs={'model_id': 'openai/whisper-tiny.en'})
+    ear = Ear_remote(pool, silence_seconds=1.5, listener=listener)
+'''
+import importlib
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+from multiprocessing import shared_memory
+from time import monotonic
+import numpy as np
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+RING_BYTES = 16 * 2 ** 20  # ~4 minutes of 16kHz float32 audio
+
+
+class AudioRing:
+    def __init__(self, size=RING_BYTES, name=None):
+        '''
+        :param size: bytes of the buffer
+        :param name: name of an existing segment to attach to, None to create one
+
+        Shared memory ring written by one process and read by another. A block is written
+        at the head, or at the start when it does not fit at the end, and stays valid until
+        the writer wraps around to it. Blocks are read right after the control message that
+        points to them arrives, so the writer never overtakes the reader.
+        '''
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        if not self.owner:
+            # the creating process unlinks the segment, keep the resource tracker of this one out of it
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+            except Exception:
+                pass
+        self.name = self.shm.name
+        self.size = size
+        self.buf = np.ndarray((size,), dtype=np.uint8, buffer=self.shm.buf)
+        self.head = 0
+
+    def write(self, array: np.ndarray):
+        '''
+        :return: (offset, dtype, shape) locating the block, None if it does not fit
+        '''
+        array = np.ascontiguousarray(array)
+        nbytes = array.nbytes
+        if nbytes > self.size:
+            return None
+        if self.head + nbytes > self.size:
+            self.head = 0
+        self.buf[self.head:self.head + nbytes] = array.reshape(-1).view(np.uint8)
+        offset = self.head
+        self.head += nbytes
+        return offset, array.dtype.str, array.shape
+
+    def read(self, offset, dtype, shape) -> np.ndarray:
+        '''
+        :return: a copy of the block, the ring may be overwritten after the reply
+        '''
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        return self.buf[offset:offset + nbytes].view(dtype).reshape(shape).copy()
+
+    def close(self):
+        del self.buf
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _encode(ring, value):
+    # arrays go through the ring, everything else (text, small values) through the pipe
+    if isinstance(value, np.ndarray):
+        location = ring.write(value)
+        if location is not None:
+            return ('shm',) + location
+        logger.warning(f'{value.nbytes} bytes do not fit the {ring.size} byte ring, sending them through the pipe')
+    return ('inline', value)
+
+
+def _decode(ring, value):
+    if value[0] == 'shm':
+        return ring.read(*value[1:])
+    return value[1]
+
+
+def _serve(target, model_kwargs, method, conn, request_ring, reply_ring, ring_bytes):
+    '''
+    Main function of a worker process.
+    '''
+    module, name = target.split(':')
+    model = getattr(importlib.import_module(module), name)(**model_kwargs)
+    fn = getattr(model, method)
+    requests = AudioRing(ring_bytes, request_ring)
+    replies = AudioRing(ring_bytes, reply_ring)
+    conn.send(('ready', getattr(model, 'sample_rate', None)))
+    while True:
+        message = conn.recv()
+        if message[0] == 'close':
+            break
+        _, request_id, argument = message
+        try:
+            result = fn(_decode(requests, argument))
+            conn.send(('ok', request_id, _encode(replies, result), getattr(model, 'sample_rate', None)))
+        except Exception as e:
+            logger.exception(f'{target}.{method} failed')
+            conn.send(('error', request_id, repr(e), None))
+    requests.close()
+    replies.close()
+
+
+class _Channel:
+    def __init__(self, ctx, target, model_kwargs, method, ring_bytes, index):
+        self.requests = AudioRing(ring_bytes)
+        self.replies = AudioRing(ring_bytes)
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_serve, name=f'{method}-worker-{index}', daemon=True,
+                                   args=(target, model_kwargs, method, child_conn,
+                                         self.requests.name, self.replies.name, ring_bytes))
+        self.process.start()
+        child_conn.close()
+
+    def wait_ready(self, timeout):
+        if not self.conn.poll(timeout):
+            raise TimeoutError(f'{self.process.name} did not load its model within {timeout}s')
+        _, sample_rate = self.conn.recv()
+        return sample_rate
+
+    def call(self, request_id, argument):
+        self.conn.send(('call', request_id, _encode(self.requests, argument)))
+        status, reply_id, result, sample_rate = self.conn.recv()
+        if status != 'ok':
+            raise RuntimeError(f'{self.process.name}: {result}')
+        return _decode(self.replies, result), sample_rate
+
+    def close(self):
+        try:
+            self.conn.send(('close',))
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.requests.close()
+        self.replies.close()
+
+
+class ModelPool:
+    def __init__(self, target, method, workers=1, model_kwargs=None, ring_bytes=RING_BYTES,
+                 start_timeout=600):
+        '''
+        :param target: 'module:Class' of the model, e.g. 'openvoicechat.tts.tts_piper:Mouth_piper'
+        :param method: method served by the workers, 'transcribe' or 'run_tts'
+        :param workers: number of worker processes, each loads its own copy of the model
+        :param model_kwargs: keyword arguments for the model class
+        :param ring_bytes: size of each shared memory ring
+        :param start_timeout: seconds to wait for a worker to load its model
+        '''
+        self.target = target
+        self.method = method
+        self.model_kwargs = model_kwargs or {}
+        self.ring_bytes = ring_bytes
+        self.start_timeout = start_timeout
+        # spawn, forking a process that already runs torch or session threads is not safe
+        self._ctx = multiprocessing.get_context('spawn')
+        self._ids = itertools.count()
+        self._idle = queue.Queue()  # only live channels
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self.channels = []
+        self.sample_rate = None
+        for index in range(workers):
+            channel = self._start(index)
+            self.sample_rate = channel.sample_rate
+            self._idle.put(channel)
+
+    def _start(self, index):
+        channel = _Channel(self._ctx, self.target, self.model_kwargs, self.method, self.ring_bytes, index)
+        channel.index = index
+        try:
+            channel.sample_rate = channel.wait_ready(self.start_timeout)
+        except BaseException:
+            channel.close()
+            raise
+        with self._lock:
+            self.channels.append(channel)
+        return channel
+
+    def _restart(self, index, delay=1.0):
+        '''
+        Replaces the dead worker index in the background, so the pool keeps its size. Until then
+        the pool is one worker smaller, a failed start is retried with a growing delay.
+        '''
+        def target():
+            wait = delay
+            while not self._closed.is_set():
+                try:
+                    channel = self._start(index)
+                except Exception:
+                    logger.exception(f'Restarting {self.method} worker {index} failed, retrying in {wait:.0f}s')
+                    if self._closed.wait(wait):
+                        return
+                    wait = min(wait * 2, 60.0)
+                    continue
+                if self._closed.is_set():
+                    # the pool was closed while the worker loaded its model
+                    with self._lock:
+                        if channel in self.channels:
+                            self.channels.remove(channel)
+                    channel.close()
+                    return
+                self._idle.put(channel)
+                return
+
+        threading.Thread(target=target, name=f'{self.method}-restart-{index}', daemon=True).start()
+
+    def call(self, argument):
+        '''
+        :param argument: audio array for transcribe, text for run_tts
+        :return: (result, sample_rate of the model)
+        Runs on the next idle worker, waits for one if all are busy.
+        '''
+        start = monotonic()
+        channel = self._idle.get()
+        metrics.slot_wait_seconds.observe(monotonic() - start, stage=f'remote_{self.method}')
+        alive = True
+        try:
+            return channel.call(next(self._ids), argument)
+        except (EOFError, BrokenPipeError, ConnectionResetError):
+            alive = False
+            logger.error(f'{channel.process.name} died, restarting it')
+            with self._lock:
+                self.channels.remove(channel)
+            channel.close()
+            self._restart(channel.index)
+            raise RuntimeError(f'{self.method} worker died')
+        finally:
+            # a dead channel never goes back, its rings are unlinked
+            if alive:
+                self._idle.put(channel)
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            channels, self.channels = self.channels, []
+        for channel in channels:
+            channel.close()
@@ -0,0 +1,236 @@
+'''
+Lifecycle of websocket sessions.
+
+A Session owns the queues, the listener/player and the ear/chatbot/mouth of one
+caller and the thread running run_chat on them. Closing it unblocks every wait on
+the session's queues, joins the thread within a deadline and drops the models and
+the chat history. The SessionManager keeps a registry of live sessions, closes idle
+ones and lets operators list and force-close sessions. It also does admission control:
+create raises AtCapacity (see capacity.py) before any model is loaded when the node
+is full.
+'''
+import gc
+import threading
+import uuid
+import logging
+from time import monotonic, time
+from .utils import run_chat, Listener_ws, Player_ws, SessionClosed
+from . import metrics
+from .codec import negotiate
+from .capacity import BoundedQueue, AtCapacity, check_admission, MAX_SESSIONS, INPUT_QUEUE_SIZE, OUTPUT_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    def __init__(self, factory, client='', idle_timeout=300, run_kwargs=None):
+        '''
+        :param factory: callable (listener, player) -> (ear, chatbot, mouth)
+        :param client: description of the peer, for the registry
+        :param idle_timeout: seconds without client packets after which the manager closes the session
+        :param run_kwargs: extra keyword arguments for run_chat
+        '''
+        self.id = uuid.uuid4().hex[:8]
+        self.client = client
+        self.idle_timeout = idle_timeout
+        self.run_kwargs = run_kwargs or {}
+        self.closed = threading.Event()
+        self.created = time()
+        self.last_activity = monotonic()
+        # stale microphone audio is worthless, the synthesized audio must not be lost
+        self.input_queue = BoundedQueue(INPUT_QUEUE_SIZE, overflow='drop_oldest', name='input')
+        self.output_queue = BoundedQueue(OUTPUT_QUEUE_SIZE, overflow='block', name='output')
+        self.listener = Listener_ws(self.input_queue, closed=self.closed)
+        self.player = Player_ws(self.output_queue)
+        self.ear, self.chatbot, self.mouth = factory(self.listener, self.player)
+        self.thread = None
+        self.codec = 'pcm'
+        metrics.track_queue('input', self.input_queue)
+        metrics.track_queue('output', self.output_queue)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=f'session-{self.id}', daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self):
+        try:
+            run_chat(self.mouth, self.ear, self.chatbot, session_id=self.id, stop_event=self.closed,
+                     **self.run_kwargs)
+        except SessionClosed:
+            pass
+        except Exception:
+            logger.exception(f'Session {self.id} crashed')
+        finally:
+            self.closed.set()
+
+    def configure(self, hello: dict) -> dict:
+        '''
+        :param hello: the client's hello, e.g. {"type": "hello", "codecs": ["opus", "pcm"], "sample_rate": 16000,
+                      "frame_ms": 20}
+        :return: the server's hello with the chosen codec
+        Clients that send no hello get pcm at 44.1 kHz. Clients that send 16 kHz pcm
+        (web/static/worklet_audio.html) are not resampled.
+        '''
+        codec = negotiate(hello.get('codecs', ['pcm']))
+        sample_rate = int(hello.get('sample_rate', self.listener.client_rate))
+        self.listener.configure(codec, sample_rate)
+        self.player.configure(codec)
+        self.codec = codec
+        logger.info(f'Session {self.id} uses {codec} (client pcm rate {sample_rate}, '
+                    f'{hello.get("frame_ms", "unknown")} ms frames)')
+        return {'type': 'hello', 'codec': codec, 'sample_rate': 16000}
+
+    def touch(self):
+        self.last_activity = monotonic()
+
+    @property
+    def idle(self):
+        return monotonic() - self.last_activity
+
+    def cancel(self):
+        '''
+        Asks the pipeline to stop without waiting for it. Blocked reads raise SessionClosed,
+        producers blocked on a full queue are released.
+        '''
+        self.closed.set()
+        self.input_queue.close()
+        self.output_queue.close()
+
+    def close(self, timeout=5.0) -> bool:
+        '''
+        :param timeout: seconds to wait for the pipeline thread
+        :return: True if the thread stopped within the deadline
+        Cancels the session, joins its thread and releases the models and history.
+        '''
+        self.cancel()
+        # before joining: the ear may hold the thread, e.g. waiting for the transcript of a
+        # turn on the persistent Deepgram connection of Ear_deepgram
+        self._close_part(self.ear)
+        stopped = True
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+            stopped = not self.thread.is_alive()
+            if not stopped:
+                logger.warning(f'Session {self.id} did not stop within {timeout}s')
+        self._close_part(self.chatbot)
+        self._close_part(self.mouth)
+        self.ear = self.chatbot = self.mouth = None
+        gc.collect()
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
+        return stopped
+
+    def _close_part(self, part):
+        if hasattr(part, 'close'):
+            try:
+                part.close()
+            except Exception:
+                logger.exception(f'Session {self.id}: closing {type(part).__name__} failed')
+
+    def info(self) -> dict:
+        return {'id': self.id, 'client': self.client, 'age': time() - self.created, 'idle': self.idle,
+                'running': self.thread is not None and self.thread.is_alive(), 'closed': self.closed.is_set(),
+                'codec': self.codec, 'jitter': dict(self.listener.jitter.stats),
+                'trim': {stage: dict(part.trimmer.stats) for stage, part in (('stt', self.ear), ('tts', self.mouth))
+                         if getattr(part, 'trimmer', None) is not None},
+                'speculation': dict(self.ear.speculator.stats) if getattr(self.ear, 'speculator', None) else None}
+
+
+class SessionManager:
+    def __init__(self, factory, idle_timeout=300, close_timeout=5.0, reap_interval=5.0, run_kwargs=None,
+                 max_sessions=MAX_SESSIONS, retry_after=5):
+        '''
+        :param factory: callable (listener, player) -> (ear, chatbot, mouth)
+        :param idle_timeout: seconds without client packets after which a session is closed
+        :param close_timeout: seconds to wait for a session's thread when closing it
+        :param reap_interval: seconds between idle checks
+        :param run_kwargs: extra keyword arguments for run_chat
+        :param max_sessions: sessions allowed at the same time, 0 for no limit
+        :param retry_after: seconds rejected clients are told to wait
+        '''
+        self.factory = factory
+        self.idle_timeout = idle_timeout
+        self.close_timeout = close_timeout
+        self.reap_interval = reap_interval
+        self.run_kwargs = run_kwargs
+        self.max_sessions = max_sessions
+        self.retry_after = retry_after
+        self.sessions = {}
+        self._starting = 0  # admitted sessions still loading their models
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def _start_reaper(self):
+        # started lazily, the manager may be created before the process forks into workers
+        with self._lock:
+            if self._reaper is None or not self._reaper.is_alive():
+                self._reaper = threading.Thread(target=self._reap, name='session-reaper', daemon=True)
+                self._reaper.start()
+
+    def create(self, client='') -> Session:
+        '''
+        :param client: description of the peer
+        :return: the started session
+        Raises AtCapacity without loading anything if the node is full.
+        '''
+        self._start_reaper()
+        with self._lock:
+            try:
+                check_admission(len(self.sessions) + self._starting, self.max_sessions, self.retry_after)
+            except AtCapacity as e:
+                metrics.sessions_rejected.inc()
+                logger.warning(f'Rejected session for {client}: {e.reason}')
+                raise
+            self._starting += 1
+        try:
+            session = Session(self.factory, client=client, idle_timeout=self.idle_timeout,
+                              run_kwargs=self.run_kwargs)
+        finally:
+            with self._lock:
+                self._starting -= 1
+        with self._lock:
+            self.sessions[session.id] = session
+        metrics.active_sessions.inc()
+        logger.info(f'Session {session.id} started for {client}')
+        return session.start()
+
+    def get(self, session_id):
+        with self._lock:
+            return self.sessions.get(session_id)
+
+    def close(self, session_id, timeout=None) -> bool:
+        '''
+        :return: False if there is no such session
+        '''
+        with self._lock:
+            session = self.sessions.pop(session_id, None)
+        if session is None:
+            return False
+        metrics.active_sessions.dec()
+        session.close(self.close_timeout if timeout is None else timeout)
+        logger.info(f'Session {session_id} closed')
+        return True
+
+    def list(self) -> list:
+        with self._lock:
+            sessions = list(self.sessions.values())
+        return [s.info() for s in sessions]
+
+    def close_all(self, timeout=None):
+        for session_id in list(self.sessions):
+            self.close(session_id, timeout)
+
+    def _reap(self):
+        while True:
+            threading.Event().wait(self.reap_interval)
+            with self._lock:
+                sessions = list(self.sessions.values())
+            for session in sessions:
+                if session.idle > session.idle_timeout or (session.closed.is_set() and not session.thread.is_alive()):
+                    logger.info(f'Reaping session {session.id} (idle {session.idle:.0f}s)')
+                    self.close(session.id)
@@ -1,4 +1,6 @@
 from .base import BaseEar as BaseEar
 from .stt_deepgram import Ear_deepgram as Ear_deepgram
 from .stt_vosk import Ear_vosk as Ear_vosk
-from .stt_hf import Ear_hf as Ear_hf
\ No newline at end of file
+from .stt_hf import Ear_hf as Ear_hf
+from .stt_mock import Ear_scripted as Ear_scripted
+from .stt_remote import Ear_remote as Ear_remote
\ No newline at end of file
@@ -1,18 +1,23 @@
 import torch
-from .utils import record_user, record_interruption, record_user_stream
+from .utils import record_user, record_interruption, record_user_stream, DEFAULT_CHUNK
 from .vad import VoiceActivityDetection
 import re
 from time import monotonic
 import numpy as np
 from threading import Thread
 from queue import Queue
-import pandas as pd
-import os
-
-TIMING = int(os.environ.get('TIMING', 0))
+from ..tracing import NULL_TURN
+from .. import metrics
+from ..capacity import BoundedQueue, CHUNK_QUEUE_SIZE, stt_slots
+from ..trim import Trimmer
+from .speculative import Speculator
 
 
 class BaseEar:
+    trace = NULL_TURN
+    speculator = None
+    ends_turns = False  # transcribe_stream decides when the user stopped talking, see its ended parameter
+
     def __init__(self, silence_seconds=3,
                  not_interrupt_words=None,
                  listener=None,
@@ -24,11 +29,8 @@ class BaseEar:
         self.vad = VoiceActivityDetection()
         self.listener = listener
         self.stream = stream
-        if TIMING:
-            if not os.path.exists('times.csv'):
-                columns = ['Model', 'Time Taken']
-                df = pd.DataFrame(columns=columns)
-                df.to_csv('times.csv', index=False)
+        # the recording ends with silence_seconds of silence, none of it needs transcribing
+        self.trimmer = Trimmer('stt', pad_seconds=0.2)
 
     @torch.no_grad()
     def transcribe(self, input: np.ndarray) -> str:
@@ -38,10 +40,21 @@ class BaseEar:
         '''
         raise NotImplementedError("This method should be implemented by the subclass")
 
-    def transcribe_stream(self, audio_queue: Queue, transcription_queue: Queue):
+    def use_speculation(self, pause_seconds=0.3):
+        '''
+        :param pause_seconds: silence after which the utterance is transcribed in the background,
+                              None to transcribe only once the turn ended
+        See stt/speculative.py, applies to the non-streaming listen.
+        '''
+        self.speculator = None if pause_seconds is None else Speculator(self, pause_seconds)
+
+    def transcribe_stream(self, audio_queue: Queue, transcription_queue: Queue, ended=None):
         '''
         :param audio_queue: Queue containing audio chunks from pyaudio stream
         :param transcription_queue: Queue to put transcriptions
+        :param ended: threading.Event, only passed to ears with ends_turns. The ear sets it once it decided
+                      that the user stopped talking, the caller then ends audio_queue. Without it the
+                      utterance lasts until audio_queue ends.
         '''
         raise NotImplementedError("This method should be implemented by the subclass")
 
@@ -50,60 +63,67 @@ class BaseEar:
         :return: transcription
         records audio using record_user and returns its transcription
         '''
-        audio = record_user(self.silence_seconds, self.vad, self.listener)
-        if TIMING:
-            start_time = monotonic()
-
-            text = self.transcribe(audio)
-
-            stop_time = monotonic()
-            time_diff = stop_time - start_time
-            new_row_df = pd.DataFrame([{'Model': 'STT', 'Time Taken': time_diff}])
-            new_row_df.to_csv('times.csv', mode='a', header=False, index=False)
+        if self.speculator is None:
+            audio = record_user(self.silence_seconds, self.vad, self.listener)
         else:
-            text = self.transcribe(audio)
+            self.speculator.reset()
+            audio = record_user(self.silence_seconds, self.vad, self.listener, on_chunk=self.speculator.on_chunk)
+        self._mark_end_of_speech()
+        start = monotonic()
+        text = None if self.speculator is None else self.speculator.result()
+        if text is None:
+            with stt_slots:
+                text = self._transcribe_trimmed(audio)
+        metrics.stage_latency.observe(monotonic() - start, stage='stt')
+        self.trace.mark('stt_final')
         return text
 
+    def _transcribe_trimmed(self, audio: np.ndarray) -> str:
+        if self.trimmer is None:
+            return self.transcribe(audio)
+        trimmed = self.trimmer(audio, 16_000)
+        start = monotonic()
+        text = self.transcribe(trimmed)
+        if len(trimmed) < len(audio):
+            # transcription time grows with the audio, estimate what the silence would have cost
+            seconds_per_sample = (monotonic() - start) / max(len(trimmed), 1)
+            metrics.trim_saved_seconds.inc(seconds_per_sample * (len(audio) - len(trimmed)), stage='stt')
+        return text
+
+    def _mark_end_of_speech(self):
+        # the turn ends once silence_seconds of silence were heard, so speech ended that long ago
+        vad_decision = monotonic()
+        self.trace.mark('user_speech_end', vad_decision - self.silence_seconds)
+        self.trace.mark('vad_decision', vad_decision)
+
     def _listen_stream(self) -> str:
         '''
         :return: transcription
         records audio using record_user and returns its transcription
         '''
 
-        audio_queue = Queue()
-        transcription_queue = Queue()
+        audio_queue = BoundedQueue(CHUNK_QUEUE_SIZE)
+        transcription_queue = BoundedQueue(CHUNK_QUEUE_SIZE)
 
-        audio_thread = Thread(target=record_user_stream, args=(self.silence_seconds, self.vad, audio_queue))
+        audio_thread = Thread(target=record_user_stream, args=(self.silence_seconds, self.vad, audio_queue, self.listener))
         transcription_thread = Thread(target=self.transcribe_stream, args=(audio_queue, transcription_queue))
 
         audio_thread.start()
         transcription_thread.start()
 
         audio_thread.join()
-
-        if TIMING:
-            start_time = monotonic()
-
-            transcription_thread.join()
-            text = ''
-            while True:
-                _ = transcription_queue.get()
-                if _ is None:
-                    break
-                text += _ + ' '
-
-            stop_time = monotonic()
-            time_diff = stop_time - start_time
-            new_row_df = pd.DataFrame([{'Model': 'STT', 'Time Taken': time_diff}])
-            new_row_df.to_csv('times.csv', mode='a', header=False, index=False)
-        else:
-            transcription_thread.join()
-            text = ''
-            while True:
-                _ = transcription_queue.get()
-                if _ is None:
-                    break
-                text += _ + ' '
+        self._mark_end_of_speech()
+        start = monotonic()
+
+        text = ''
+        while True:
+            _ = transcription_queue.get()
+            if _ is None:
+                break
+            text += _ + ' '
+        transcription_thread.join()
+        metrics.stage_latency.observe(monotonic() - start, stage='stt')
+        self.trace.mark('stt_final')
         return text
 
     def listen(self) -> str:
@@ -116,27 +136,40 @@ class BaseEar:
         else:
             return self._listen()
 
-    def interrupt_listen(self, record_seconds=100) -> str:
+    def interrupt_listen(self, record_seconds=100, stop_event=None) -> str:
         '''
         :param record_seconds: Max seconds to record for
-        :return: boolean indicating the if an interruption occured
+        :param stop_event: stops listening once set, e.g. by the mouth when the playback ended
+        :return: transcription of the interruption, '' if there was none
         Records audio with interruption. Transcribes audio if
         voice activity detected and returns True if transcription indicates
         interruption.
         '''
+        chunk_seconds = (DEFAULT_CHUNK if self.listener is None else self.listener.CHUNK) / 16_000
         while record_seconds > 0:
-            interruption_audio = record_interruption(self.vad, record_seconds, streamer=self.listener)
+            interruption_audio = record_interruption(self.vad, record_seconds, streamer=self.listener,
+                                                     stop_event=stop_event)
             # duration of interruption audio
             if interruption_audio is None:
                 return ''
             else:
+                # the vad heard no speech up to the chunk before, so the speech started within the last chunk
+                onset = monotonic() - chunk_seconds
                 duration = len(interruption_audio) / 16_000
-                text = self.transcribe(interruption_audio)
-                # remove any punctuation using re
-                text = re.sub(r'[^\w\s]', '', text)
-                text = text.lower()
-                text = text.strip()
-                if text in self.not_interrupt_words:
+                with stt_slots:
+                    text = self.interruption(self._transcribe_trimmed(interruption_audio))
+                if not text:
                     record_seconds -= duration
                 else:
+                    self.trace.mark('barge_in', onset)
                     return text
+
+    def interruption(self, text: str) -> str:
+        '''
+        :param text: transcription of speech heard while the bot speaks
+        :return: the transcription without punctuation, lower case, '' if it does not interrupt
+                 (nothing, or one of not_interrupt_words like "yeah")
+        '''
+        # remove any punctuation using re
+        text = re.sub(r'[^\w\s]', '', text).lower().strip()
+        return '' if text in self.not_interrupt_words else text
@@ -0,0 +1,125 @@
+'''
+Speculative transcription during the end-of-turn silence.
+
+record_user ends the turn after silence_seconds without speech, and only then does
+_listen call transcribe, so the STT time adds to the turn latency. With a Speculator
+the ear starts transcribing the utterance in the background as soon as the VAD hears
+pause_seconds of silence. If the user goes on speaking the transcription is discarded
+(a transcribe call cannot be extended with more audio) and a new one starts at the
+next pause. If the silence lasts until the turn ends the transcript is ready or
+partly done. Works with any BaseEar.transcribe, the ear's transcribe calls still run
+one at a time.
+'''
+import threading
+from time import monotonic
+import numpy as np
+from .. import metrics
+from ..capacity import stt_slots
+
+
+class _Job:
+    def __init__(self):
+        self.text = None
+        self.start = None
+        self.end = None
+        self.discarded = False
+        self.done = threading.Event()
+        self.lock = threading.Lock()  # the wasted time is counted by whichever of discard and finish comes last
+
+
+class Speculator:
+    def __init__(self, ear, pause_seconds=0.3):
+        '''
+        :param ear: the BaseEar whose _transcribe_trimmed and vad are used
+        :param pause_seconds: silence after speech before the transcription starts,
+                              shorter pauses cost more discarded transcriptions
+        '''
+        self.ear = ear
+        self.pause_seconds = pause_seconds
+        self.stats = {'used': 0, 'discarded': 0, 'saved_seconds': 0.0, 'wasted_seconds': 0.0}
+        self._job = None
+        self._running = None  # thread of the latest job, discarded or not
+        self._lock = threading.Lock()  # one transcribe call at a time
+
+    def reset(self):
+        '''
+        Discards the job of an earlier recording, called before recording a turn.
+        '''
+        if self._job is not None:
+            self._discard()
+
+    def _discard(self):
+        job, self._job = self._job, None
+        with job.lock:
+            job.discarded = True
+            wasted = job.done.is_set() and job.start is not None
+        self.stats['discarded'] += 1
+        metrics.speculative_stt.inc(result='discarded')
+        if wasted:
+            self._waste(job)
+
+    def _waste(self, job):
+        wasted = job.end - job.start
+        self.stats['wasted_seconds'] += wasted
+        metrics.speculative_stt_seconds.inc(wasted, result='wasted')
+
+    def _run(self, job, frames):
+        audio = (np.frombuffer(b''.join(frames), dtype=np.int16) / (1 << 15)).astype(np.float32)
+        try:
+            with self._lock:
+                if not job.discarded:
+                    with stt_slots:
+                        job.start = monotonic()
+                        try:
+                            job.text = self.ear._transcribe_trimmed(audio)
+                        finally:
+                            job.end = monotonic()
+        finally:
+            with job.lock:
+                job.done.set()
+                wasted = job.discarded and job.start is not None
+            if wasted:
+                self._waste(job)
+
+    def on_chunk(self, frames, started):
+        '''
+        :param frames: the chunks recorded so far, int16 pcm bytes at 16 kHz
+        :param started: whether record_user heard speech yet
+        Called by record_user after every chunk.
+        '''
+        if not started:
+            return
+        pause_chunks = max(1, int(np.ceil(self.pause_seconds * 16_000 / (len(frames[-1]) // 2))))
+        speaking = self.ear.vad.contains_speech(frames[-pause_chunks:])
+        if speaking:
+            if self._job is not None:
+                self._discard()
+        elif self._job is None and not self._lock.locked() and not stt_slots.backed_up:
+            # a discarded job still running would delay this one, the pause is tried again later
+            self._job = _Job()
+            self._running = threading.Thread(target=self._run, args=(self._job, list(frames)), daemon=True)
+            self._running.start()
+
+    def result(self):
+        '''
+        :return: transcript of the utterance started during its end-of-turn silence,
+                 None if there is none and the caller transcribes itself
+        Called after record_user returned, waits for the job.
+        '''
+        job, self._job = self._job, None
+        if job is None:
+            # the caller's transcribe must not run alongside a discarded job
+            if self._running is not None:
+                self._running.join()
+            return None
+        waited = monotonic()
+        job.done.wait()
+        waited = monotonic() - waited
+        if job.text is None:
+            return None
+        saved = max(0.0, job.end - job.start - waited)
+        self.stats['used'] += 1
+        self.stats['saved_seconds'] += saved
+        metrics.speculative_stt.inc(result='used')
+        metrics.speculative_stt_seconds.inc(saved, result='saved')
+        return job.text
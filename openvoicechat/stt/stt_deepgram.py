@@ -1,83 +1,351 @@
 
 if __name__ == "__main__":
     from base import BaseEar
+    from utils import make_stream, DEFAULT_CHUNK, DEFAULT_RATE
 else:
     from .base import BaseEar
+    from .utils import make_stream, DEFAULT_CHUNK, DEFAULT_RATE
 import os
 from dotenv import load_dotenv
 import websockets
 import json
 import asyncio
 import logging
+import threading
+from threading import Thread
+from time import monotonic
+from urllib.parse import urlencode
 import numpy as np
+from ..capacity import BoundedQueue, CHUNK_QUEUE_SIZE
+from .. import metrics
+
+DEEPGRAM_URL = "wss://api.deepgram.com/v1/listen"
+
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+
+
+def event_loop():
+    '''
+    :return: the event loop shared by the Deepgram connections of this process, started on first use
+    '''
+    global _loop, _loop_thread
+    with _loop_lock:
+        # the thread does not survive a fork (see web/supervisor.py), start a new one then
+        if _loop_thread is None or not _loop_thread.is_alive():
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name='deepgram-loop', daemon=True)
+            _loop_thread.start()
+    return _loop
 
 
 class Ear_deepgram(BaseEar):
-    def __init__(self, silence_seconds=1, api_key=None, listener=None):
+    ends_turns = True
+
+    def __init__(self, silence_seconds=1, api_key=None, listener=None, url=DEEPGRAM_URL,
+                 model='nova-2', endpointing=500, utterance_end_ms=1000, fallback_seconds=None,
+                 on_partial=None, keepalive_interval=5.0, finalize_timeout=3.0):
+        '''
+        :param silence_seconds: silence that ends a turn, see fallback_seconds
+        :param api_key: defaults to the DEEPGRAM_API_KEY environment variable
+        :param listener: e.g. Listener_ws
+        :param url: listen endpoint, e.g. ws://localhost:8765/v1/listen for benchmarks/deepgram_mock.py
+        :param model: Deepgram model
+        :param endpointing: ms of silence after which Deepgram marks a result speech_final
+        :param utterance_end_ms: ms without words after which Deepgram sends UtteranceEnd (at least 1000)
+        :param fallback_seconds: silence after which the local VAD ends the turn if Deepgram did not,
+                                 defaults to silence_seconds + 1
+        :param on_partial: callable(text) getting the transcript of the turn so far, final segments
+                           followed by the latest interim result. Runs on the event loop thread, must not block.
+        :param keepalive_interval: seconds without audio after which a KeepAlive is sent
+        :param finalize_timeout: seconds to wait for the transcript of the end of a turn
+
+        Keeps one websocket to Deepgram open for the whole session, driven by a shared event
+        loop thread. KeepAlive messages keep it open while the bot speaks. A dropped connection
+        is reopened and the audio of the current turn is sent again.
+
+        Deepgram decides when the user stopped talking: the turn ends on a speech_final result
+        or an UtteranceEnd message. Only is_final segments make up the transcript. The local VAD
+        only ends the turn if the server did not within fallback_seconds of silence, the turn
+        is then closed with a Finalize.
+        '''
         super().__init__(silence_seconds, stream=True, listener=listener)
         # Initialize logging
         self.logger = logging.getLogger(__name__)
         if not self.logger.handlers:
             logging.basicConfig(level=logging.INFO)
-        
+
         # Load API key from environment if not provided
         load_dotenv()
         self.api_key = api_key or os.getenv("DEEPGRAM_API_KEY")
-        
+
         if not self.api_key:
             raise ValueError("Deepgram API key is required. Provide it as an argument or set DEEPGRAM_API_KEY environment variable.")
 
-    def transcribe_stream(self, audio_queue, transcription_queue):
-        extra_headers = {"Authorization": f"Token {self.api_key}"}
+        self.params = {'encoding': 'linear16', 'sample_rate': 16000, 'channels': 1, 'model': model,
+                       'endpointing': endpointing, 'interim_results': 'true',
+                       'utterance_end_ms': max(1000, utterance_end_ms)}
+        self.url = url
+        self.fallback_seconds = silence_seconds + 1 if fallback_seconds is None else fallback_seconds
+        self.on_partial = on_partial
+        self.partial = ''
+        self.keepalive_interval = keepalive_interval
+        self.finalize_timeout = finalize_timeout
+        self.reconnects = 0
+        self.endpoints = {'server': 0, 'fallback': 0}
+        self.closing = False
+        # the state below is only touched on the event loop
+        self._turn = None
+        self._cursor = 0.0  # seconds of audio sent over the current connection
+        self._outbox = asyncio.Queue()
+        self._loop = event_loop()
+        # connect now, the first turn should not wait for the handshakes
+        self._task = asyncio.run_coroutine_threadsafe(self._run(), self._loop)
 
-        async def f():
+    def _listen_url(self):
+        return f"{self.url}?{urlencode(self.params)}"
+
+    async def _run(self):
+        backoff = 0.5
+        while not self.closing:
             try:
                 async with websockets.connect(
-                    "wss://api.deepgram.com/v1/listen?encoding=linear16&sample_rate=16000&channels=1&model=nova-2&endpointing=1500",
-                    additional_headers=extra_headers,
+                    self._listen_url(),
+                    additional_headers={"Authorization": f"Token {self.api_key}"},
                 ) as ws:
-
-                    async def sender(ws):
-                        try:
-                            while True:
-                                data = audio_queue.get()
-                                if data is None:
-                                    await ws.send(json.dumps({"type": "CloseStream"}))
-                                    break
-                                # Ensure data is bytes
-                                if not isinstance(data, bytes):
-                                    self.logger.error(f"Invalid data type in audio_queue: {type(data)}")
-                                    continue
-                                await ws.send(data)
-                        except Exception as e:
-                            self.logger.error(f"Error while sending: {str(e)}")
-                            raise
-
-                    async def receiver(ws):
-                        try:
-                            async for msg in ws:
-                                msg = json.loads(msg)
-                                if "channel" not in msg:
-                                    transcription_queue.put(None)
-                                    break
-                                transcript = msg["channel"]["alternatives"][0]["transcript"]
-                                if transcript:
-                                    transcription_queue.put(transcript)
-                        except Exception as e:
-                            self.logger.error(f"Error in receiver: {str(e)}")
-                            transcription_queue.put(None)
-                            raise
-
-                    await asyncio.gather(sender(ws), receiver(ws))
+                    backoff = 0.5
+                    self._on_connect()
+                    sender = asyncio.create_task(self._sender(ws))
+                    try:
+                        async for msg in ws:
+                            self._on_message(json.loads(msg))
+                    finally:
+                        sender.cancel()
+                if not self.closing:
+                    self.logger.info("Deepgram closed the connection, reconnecting")
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 self.logger.error(f"Connection error: {str(e)}")
-                transcription_queue.put(None)
+            if self.closing:
+                break
+            self.reconnects += 1
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 10.0)
+
+    async def _sender(self, ws):
+        while True:
+            try:
+                item = await asyncio.wait_for(self._outbox.get(), self.keepalive_interval)
+            except asyncio.TimeoutError:
+                # Deepgram closes the stream after 10s without audio, e.g. while the bot speaks
+                item = json.dumps({"type": "KeepAlive"})
+            await ws.send(item)
+
+    def _seconds(self, data):
+        return len(data) / (2 * self.params['sample_rate'])
 
-        try:
-            asyncio.run(f())
-        except Exception as e:
-            self.logger.error(f"asyncio error: {str(e)}")
-            transcription_queue.put(None)
+    def _on_connect(self):
+        self._cursor = 0.0
+        if self._turn is None:
+            return
+        # what was sent over the old connection may be lost, send the whole turn again
+        turn = self._turn
+        self._outbox = asyncio.Queue()
+        turn['segments'] = []
+        turn['interim'] = ''
+        turn['offset'] = 0.0
+        for data in turn['audio']:
+            self._outbox.put_nowait(data)
+            self._cursor += self._seconds(data)
+        if turn['finalizing']:
+            self._outbox.put_nowait(json.dumps({"type": "Finalize"}))
+
+    def _on_message(self, msg):
+        turn = self._turn
+        if turn is None:
+            return
+        kind = msg.get("type", "Results")
+        if kind == "UtteranceEnd":
+            if turn['segments']:
+                self._end_of_speech(turn, msg.get("last_word_end"))
+            return
+        if kind != "Results":
+            return
+        alternative = msg["channel"]["alternatives"][0]
+        transcript = alternative["transcript"]
+        if msg.get("is_final", True):
+            if transcript:
+                turn['segments'].append(transcript)
+            turn['interim'] = ''
+        else:
+            turn['interim'] = transcript
+        self._update_partial(turn)
+        if msg.get("from_finalize") and turn['finalizing']:
+            self._finish_turn()
+        elif msg.get("speech_final") and turn['segments']:
+            words = alternative.get("words")
+            last_word_end = words[-1]["end"] if words else msg.get("start", 0) + msg.get("duration", 0)
+            self._end_of_speech(turn, last_word_end)
+
+    def _update_partial(self, turn):
+        partial = ' '.join(turn['segments'] + ([turn['interim']] if turn['interim'] else []))
+        if partial != self.partial:
+            self.partial = partial
+            if self.on_partial is not None:
+                try:
+                    self.on_partial(partial)
+                except Exception:
+                    self.logger.exception("on_partial failed")
+
+    def _end_of_speech(self, turn, last_word_end=None):
+        # Deepgram ended the turn. last_word_end is in seconds of audio on this connection,
+        # the listener delivers audio in real time so it maps onto the clock of the first read
+        if not turn['ends_turn']:
+            # the caller ends the turn by ending its audio, the Finalize then flushes the transcript
+            return
+        now = monotonic()
+        if last_word_end is not None and turn['start'] is not None:
+            self.trace.mark('user_speech_end', turn['start'] + last_word_end - turn['offset'])
+        self.trace.mark('vad_decision', now)
+        turn['decided'] = now
+        self.endpoints['server'] += 1
+        turn['ended'].set()
+        self._finish_turn()
+
+    def _new_turn(self, transcription_queue, ended=None):
+        # created by the recording thread, owned by the event loop once _begin_turn ran
+        return {'queue': transcription_queue, 'audio': [], 'segments': [], 'interim': '',
+                'finalizing': False, 'ended': threading.Event() if ended is None else ended, 'ends_turn': True,
+                'start': None, 'offset': 0.0, 'decided': None}
+
+    def _begin_turn(self, turn):
+        if self.closing:
+            turn['ended'].set()
+            turn['queue'].put(None)
+            return
+        turn['offset'] = self._cursor
+        self.partial = ''
+        self._turn = turn
+
+    def _send_audio(self, turn, data):
+        if self._turn is not turn:
+            # the server already ended the turn
+            return
+        turn['audio'].append(data)
+        self._outbox.put_nowait(data)
+        self._cursor += self._seconds(data)
+
+    def _finalize(self, turn):
+        if self._turn is not turn:
+            return
+        if turn['ends_turn']:
+            # Deepgram did not end the turn, e.g. the connection is down, the local VAD did
+            self.endpoints['fallback'] += 1
+        turn['finalizing'] = True
+        self._outbox.put_nowait(json.dumps({"type": "Finalize"}))
+        self._loop.call_later(self.finalize_timeout, lambda: self._turn is turn and self._finish_turn())
+
+    def _finish_turn(self):
+        turn, self._turn = self._turn, None
+        text = ' '.join(turn['segments'])
+        if text:
+            turn['queue'].put(text)
+        turn['queue'].put(None)
+
+    def _record(self, turn):
+        '''
+        Streams the microphone to Deepgram until the server ends the turn,
+        or the local VAD hears fallback_seconds of silence after speech.
+        '''
+        call = self._loop.call_soon_threadsafe
+        if self.listener is None:
+            stream = make_stream()
+            chunk_size, rate_value = DEFAULT_CHUNK, DEFAULT_RATE
+        else:
+            stream = self.listener.make_stream()
+            chunk_size, rate_value = self.listener.CHUNK, self.listener.RATE
+        window = max(1, int(rate_value / chunk_size * self.fallback_seconds))
+        frames = []
+        started = False
+        while not turn['ended'].is_set():
+            data = stream.read(chunk_size)
+            if turn['start'] is None:
+                turn['start'] = monotonic() - chunk_size / rate_value
+            frames.append(data)
+            frames = frames[-window:]
+            call(self._send_audio, turn, data)
+            if turn['ended'].is_set():
+                break
+            contains_speech = self.vad.contains_speech(frames)
+            if not started and contains_speech:
+                started = True
+            if started and contains_speech is False:
+                vad_decision = monotonic()
+                turn['decided'] = vad_decision
+                self.trace.mark('user_speech_end', vad_decision - self.fallback_seconds)
+                self.trace.mark('vad_decision', vad_decision)
+                call(self._finalize, turn)
+                break
+        stream.close()
+
+    def _listen_stream(self) -> str:
+        '''
+        :return: transcription of the user's turn
+        '''
+        transcription_queue = BoundedQueue(CHUNK_QUEUE_SIZE)
+        turn = self._new_turn(transcription_queue)
+        self._loop.call_soon_threadsafe(self._begin_turn, turn)
+        # the recording thread notices the end of the turn at its next read, don't wait for it
+        Thread(target=self._record, args=(turn,), daemon=True).start()
+        text = ''
+        while True:
+            _ = transcription_queue.get()
+            if _ is None:
+                break
+            text += _ + ' '
+        if turn['decided'] is not None:
+            metrics.stage_latency.observe(monotonic() - turn['decided'], stage='stt')
+        self.trace.mark('stt_final')
+        return text
+
+    def transcribe_stream(self, audio_queue, transcription_queue, ended=None):
+        '''
+        :param ended: set when Deepgram ended the turn, see BaseEar.transcribe_stream. Without it
+                      speech_final and UtteranceEnd are ignored: the turn, and its transcript, only end
+                      with audio_queue, so no words after a pause are lost.
+        '''
+        turn = self._new_turn(transcription_queue, ended)
+        turn['ends_turn'] = ended is not None
+        call = self._loop.call_soon_threadsafe
+        call(self._begin_turn, turn)
+        while True:
+            data = audio_queue.get()
+            if data is None:
+                break
+            # Ensure data is bytes
+            if not isinstance(data, bytes):
+                self.logger.error(f"Invalid data type in audio_queue: {type(data)}")
+                continue
+            call(self._send_audio, turn, data)
+        call(self._finalize, turn)
+
+    def close(self):
+        '''
+        Closes the connection, the ear cannot be used afterwards. The active turn ends with
+        what was transcribed so far, so nothing stays blocked on its transcription queue.
+        '''
+        self.closing = True
+        self._loop.call_soon_threadsafe(self._abandon_turn)
+        self._task.cancel()
+
+    def _abandon_turn(self):
+        turn = self._turn
+        if turn is not None:
+            # also stops the recording thread of _listen_stream
+            turn['ended'].set()
+            self._finish_turn()
 
 
 if __name__ == "__main__":
@@ -88,7 +356,7 @@ if __name__ == "__main__":
     # To test with your API key:
     api_key = os.getenv("DEEPGRAM_API_KEY")
     ear = Ear_deepgram(api_key=api_key)
-    
+
     # Test with microphone
     text = ear.listen()
-    print(text)
\ No newline at end of file
+    print(text)
@@ -0,0 +1,34 @@
+from time import sleep
+import numpy as np
+if __name__ == '__main__':
+    from base import BaseEar
+else:
+    from .base import BaseEar
+
+
+class Ear_scripted(BaseEar):
+    def __init__(self, transcripts=None, latency=0.1, latency_per_second=0.02,
+                 silence_seconds=1, listener=None):
+        '''
+        :param transcripts: texts returned in turn (cycled)
+        :param latency: fixed seconds per transcribe call
+        :param latency_per_second: additional seconds per second of audio
+        :param silence_seconds: silence that ends a turn
+        :param listener: e.g. Listener_file or Listener_ws
+
+        Local stand-in for an STT model. Still records with the real VAD so the
+        turn taking is the same as with a real model.
+        '''
+        super().__init__(silence_seconds, listener=listener)
+        if transcripts is None:
+            transcripts = ['How much is the new model and when does it ship?']
+        self.transcripts = transcripts
+        self.latency = latency
+        self.latency_per_second = latency_per_second
+        self.calls = 0
+
+    def transcribe(self, audio: np.ndarray) -> str:
+        sleep(self.latency + self.latency_per_second * len(audio) / 16_000)
+        text = self.transcripts[self.calls % len(self.transcripts)]
+        self.calls += 1
+        return text
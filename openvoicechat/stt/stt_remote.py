@@ -0,0 +1,29 @@
+import numpy as np
+if __name__ == '__main__':
+    from base import BaseEar
+else:
+    from .base import BaseEar
+
+
+class Ear_remote(BaseEar):
+    def __init__(self, pool=None, model='openvoicechat.stt.stt_hf:Ear_hf', model_kwargs=None, workers=1,
+                 silence_seconds=2, listener=None):
+        '''
+        :param pool: a ModelPool serving transcribe (see openvoicechat/remote.py), shared between sessions
+        :param model: 'module:Class' of the ear, used when no pool is given
+        :param model_kwargs: keyword arguments for the ear class, used when no pool is given
+        :param workers: number of worker processes, used when no pool is given
+        :param silence_seconds: silence that ends a turn
+        :param listener: e.g. Listener_ws
+
+        Records and detects speech locally, transcribes in the pool's worker processes.
+        '''
+        super().__init__(silence_seconds, listener=listener)
+        if pool is None:
+            from ..remote import ModelPool
+            pool = ModelPool(model, 'transcribe', workers=workers, model_kwargs=model_kwargs)
+        self.pool = pool
+
+    def transcribe(self, audio: np.ndarray) -> str:
+        text, _ = self.pool.call(np.asarray(audio, dtype=np.float32))
+        return text
@@ -2,6 +2,7 @@
 
 import numpy as np
 import pyaudio
+from ..utils import ReadCancelled
 
 # Define default chunk and rate for local microphone
 DEFAULT_CHUNK = int(1024 * 2)
@@ -50,7 +51,11 @@ def record_interruption_parallel(vad, listen_queue, streamer=None):
     return None
 
 
-def record_interruption(vad, record_seconds=100, streamer=None):
+def record_interruption(vad, record_seconds=100, streamer=None, stop_event=None):
+    '''
+    :param stop_event: stops recording once set, e.g. when the playback ended
+    :return: fp32 audio from the start of the recording up to the chunk with speech, None if there was none
+    '''
     print("* recording for interruption")
     frames = []
     if streamer is None:
@@ -59,14 +64,24 @@ def record_interruption(vad, record_seconds=100, streamer=None):
         # global RATE # Removed
         chunk_size = DEFAULT_CHUNK
         rate_value = DEFAULT_RATE
-    else:
+    elif stop_event is None:
         stream = streamer.make_stream()
         chunk_size = streamer.CHUNK # Use streamer's CHUNK
         rate_value = streamer.RATE # Use streamer's RATE
+    else:
+        # reads of the websocket listener block while the client sends nothing, the event unblocks them
+        stream = streamer.make_stream(stop_event=stop_event)
+        chunk_size = streamer.CHUNK
+        rate_value = streamer.RATE
 
     # Use local rate_value and chunk_size
     for _ in range(0, int(rate_value / chunk_size * record_seconds)):
-        data = stream.read(chunk_size) # Use local chunk_size
+        if stop_event is not None and stop_event.is_set():
+            break
+        try:
+            data = stream.read(chunk_size) # Use local chunk_size
+        except ReadCancelled:
+            break
         assert len(data) == chunk_size * 2, 'chunk size does not match 2 bytes per sample' # Use local chunk_size
         frames.append(data)
         # Use local rate_value and chunk_size
@@ -80,7 +95,11 @@ def record_interruption(vad, record_seconds=100, streamer=None):
     return None
 
 
-def record_user(silence_seconds, vad, streamer=None):
+def record_user(silence_seconds, vad, streamer=None, on_chunk=None):
+    '''
+    :param on_chunk: callable (frames, started) called after every chunk, e.g. Speculator.on_chunk
+    :return: fp32 audio of the utterance up to the end of the silence that ended it
+    '''
     frames = []
 
     started = False
@@ -109,6 +128,8 @@ def record_user(silence_seconds, vad, streamer=None):
             print("*listening to speech*")
         if started and contains_speech is False:
             break
+        if on_chunk is not None:
+            on_chunk(frames, started)
     stream.close()
 
     print("* done recording")
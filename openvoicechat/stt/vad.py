@@ -1,13 +1,33 @@
+import threading
 import torch
 import numpy as np
 from .utils import record_user
 
+_silero = None
+# the model keeps its recurrent state between calls, every call on it holds this lock
+_silero_lock = threading.Lock()
+
+
+def load_silero():
+    '''
+    :return: (model, utils) of silero vad, loaded once per process.
+    Calling this before forking workers shares the loaded model copy-on-write (see web/supervisor.py).
+    '''
+    global _silero
+    if _silero is None:
+        _silero = torch.hub.load(repo_or_dir='snakers4/silero-vad',
+                                 model='silero_vad',
+                                 force_reload=False)
+    return _silero
+
 
 class VoiceActivityDetection:
     def __init__(self, sampling_rate=16000):
-        self.model, utils = torch.hub.load(repo_or_dir='snakers4/silero-vad',
-                                           model='silero_vad',
-                                           force_reload=False)
+        model, utils = load_silero()
+        # shared by every ear of the process, so its weights stay shared with the other workers too.
+        # get_speech_timestamps resets the state first, nothing carries over from another ear's call.
+        self.model = model
+        self.lock = _silero_lock
 
         (self.get_speech_timestamps,
          self.save_audio,
@@ -24,10 +44,23 @@ class VoiceActivityDetection:
         frames = frames / (1 << 15)
 
         audio = torch.tensor(frames.astype(np.float32))
-        speech_timestamps = self.get_speech_timestamps(audio, self.model,
-                                                       sampling_rate=self.sampling_rate)
+        with self.lock:
+            speech_timestamps = self.get_speech_timestamps(audio, self.model,
+                                                           sampling_rate=self.sampling_rate)
         return len(speech_timestamps) > 0
 
+    def speech_bounds(self, audio: np.ndarray):
+        '''
+        :param audio: fp32 audio at sampling_rate
+        :return: (first, end) sample of the speech, None if there is none
+        '''
+        with self.lock:
+            speech_timestamps = self.get_speech_timestamps(torch.from_numpy(audio.astype(np.float32)), self.model,
+                                                           sampling_rate=self.sampling_rate)
+        if not speech_timestamps:
+            return None
+        return speech_timestamps[0]['start'], speech_timestamps[-1]['end']
+
 
 if __name__ == "__main__":
     vad = VoiceActivityDetection()
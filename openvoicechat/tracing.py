@@ -0,0 +1,189 @@
+'''
+Low overhead per-turn latency tracing.
+
+Every turn of a conversation gets a Turn object. Pipeline components mark named
+points on it with the monotonic clock (a dict store, no I/O). Finished turns go
+into a bounded in-memory ring buffer; a background thread exports them in batches
+to a JSONL file. Nothing on the hot path blocks or allocates more than a small dict.
+
+    TRACE=0             disables tracing
+    TRACE_FILE=x.jsonl  exports finished turns to x.jsonl (TIMING=1 exports to traces.jsonl)
+'''
+import os
+import json
+import threading
+import itertools
+import uuid
+import atexit
+from collections import deque
+from time import monotonic, time
+import numpy as np
+
+TIMING = int(os.environ.get('TIMING', 0))
+TRACE = int(os.environ.get('TRACE', 1))
+TRACE_FILE = os.environ.get('TRACE_FILE', 'traces.jsonl' if TIMING else None)
+
+# the points of a turn, in the order they normally happen
+SPANS = ['user_speech_end', 'vad_decision', 'stt_final', 'filler_start', 'llm_first_token', 'first_sentence',
+         'first_tts_chunk', 'playback_start', 'barge_in', 'interruption', 'playback_stop', 'idle']
+# latencies are reported relative to this point
+REFERENCE = 'user_speech_end'
+
+
+class Turn:
+    __slots__ = ('tracer', 'session', 'turn', 'start', 'marks', 'info')
+
+    def __init__(self, tracer, session, turn):
+        self.tracer = tracer
+        self.session = session
+        self.turn = turn
+        self.start = monotonic()
+        self.marks = {}
+        self.info = {}
+
+    def mark(self, name: str, t: float = None):
+        '''
+        :param name: name of the point, see SPANS
+        :param t: monotonic timestamp, defaults to now
+        Only the first mark of a name counts.
+        '''
+        if name not in self.marks:
+            self.marks[name] = monotonic() if t is None else t
+
+    def set(self, key: str, value):
+        '''
+        Attach a non-timing value (e.g. prompt size) to the turn.
+        '''
+        self.info[key] = value
+
+    def latencies(self) -> dict:
+        '''
+        :return: seconds from the reference point (end of user speech) to every mark
+        '''
+        ref = self.marks.get(REFERENCE, self.start)
+        return {name: t - ref for name, t in self.marks.items()}
+
+    def end(self):
+        self.tracer._record(self)
+
+
+class _NullTurn:
+    '''
+    Stand-in used when tracing is disabled or outside of run_chat.
+    '''
+    session = None
+    turn = -1
+    marks = {}
+    info = {}
+
+    def mark(self, name, t=None):
+        pass
+
+    def set(self, key, value):
+        pass
+
+    def latencies(self):
+        return {}
+
+    def end(self):
+        pass
+
+
+NULL_TURN = _NullTurn()
+
+
+class Tracer:
+    def __init__(self, enabled=TRACE, path=TRACE_FILE, capacity=4096, flush_interval=5.0):
+        '''
+        :param enabled: if False begin_turn returns a no-op turn
+        :param path: JSONL file finished turns are exported to, None to keep them in memory only
+        :param capacity: number of finished turns kept for summaries and waiting for export
+        :param flush_interval: seconds between exports
+        '''
+        self.enabled = enabled
+        self.path = path
+        self.flush_interval = flush_interval
+        self.records = deque(maxlen=capacity)  # recent turns, for summaries
+        self._export = deque(maxlen=capacity)  # turns waiting to be written, oldest dropped if export lags
+        self._turn_ids = itertools.count()
+        self._flusher = None
+        self._lock = threading.Lock()
+
+    def new_session(self) -> str:
+        return uuid.uuid4().hex[:8]
+
+    def begin_turn(self, session=None):
+        '''
+        :param session: id of the conversation
+        :return: a Turn to mark points on
+        '''
+        if not self.enabled:
+            return NULL_TURN
+        return Turn(self, session, next(self._turn_ids))
+
+    def _record(self, turn):
+        record = {'session': turn.session, 'turn': turn.turn, 'time': time(),
+                  'latency': turn.latencies(), **turn.info}
+        self.records.append(record)
+        if self.path is not None:
+            self._export.append(record)
+            if self._flusher is None:
+                self._start_flusher()
+
+    def _start_flusher(self):
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        stop = threading.Event()
+        while not stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the pending turns to the JSONL file.
+        '''
+        if self.path is None:
+            return
+        lines = []
+        while self._export:
+            try:
+                lines.append(json.dumps(self._export.popleft()))
+            except IndexError:
+                break
+        if lines:
+            with self._lock, open(self.path, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+
+    def summary(self, session=None, percentiles=(50, 90, 99)) -> dict:
+        '''
+        :param session: restrict to one conversation, None for the whole process
+        :return: {point: {'count': n, 'p50': seconds, ...}} relative to the end of user speech
+        '''
+        values = {}
+        for record in list(self.records):
+            if session is not None and record['session'] != session:
+                continue
+            for name, latency in record['latency'].items():
+                values.setdefault(name, []).append(latency)
+        summary = {}
+        for name in sorted(values, key=lambda n: SPANS.index(n) if n in SPANS else len(SPANS)):
+            stats = {'count': len(values[name])}
+            for p, v in zip(percentiles, np.percentile(values[name], percentiles)):
+                stats[f'p{p}'] = float(v)
+            summary[name] = stats
+        return summary
+
+    def format_summary(self, session=None) -> str:
+        lines = []
+        for name, stats in self.summary(session).items():
+            parts = ', '.join(f'{k}: {v * 1000:.0f}ms' for k, v in stats.items() if k != 'count')
+            lines.append(f"{name:<16} n={stats['count']:<4} {parts}")
+        return '\n'.join(lines)
+
+
+tracer = Tracer()
+atexit.register(tracer.flush)
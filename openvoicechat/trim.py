@@ -0,0 +1,74 @@
+'''
+Trimming of leading and trailing silence.
+
+record_user returns the utterance with the silence before it and the silence_seconds
+that ended the turn, TTS backends return clips with silence around the speech. Both
+cost time: the STT model transcribes the silence (and whisper hallucinates "you" in
+it), the silence of every clip is dead air between sentences. Trimmer cuts both ends
+down to pad_seconds around the speech, found by frame energy (vectorized) or by the
+speech timestamps of a VoiceActivityDetection.
+'''
+import numpy as np
+from . import metrics
+
+
+class Trimmer:
+    def __init__(self, stage, pad_seconds=0.1, frame_ms=10, threshold_db=-50, relative_db=35, vad=None):
+        '''
+        :param stage: 'stt' or 'tts', the label of the metrics
+        :param pad_seconds: silence kept before and after the speech
+        :param frame_ms: frame of the energy measurement
+        :param threshold_db: frames quieter than this (dBFS) are silence
+        :param relative_db: frames this far below the loudest frame are silence as well
+        :param vad: a VoiceActivityDetection, its speech timestamps are used instead of the energy
+        '''
+        self.stage = stage
+        self.pad_seconds = pad_seconds
+        self.frame_ms = frame_ms
+        self.threshold_db = threshold_db
+        self.relative_db = relative_db
+        self.vad = vad
+        self.stats = {'clips': 0, 'input_seconds': 0.0, 'trimmed_seconds': 0.0}
+
+    def _energy_bounds(self, audio, sample_rate):
+        frame = max(1, int(sample_rate * self.frame_ms / 1000))
+        n = len(audio) // frame
+        if n == 0:
+            return None
+        x = audio[:n * frame]
+        if x.ndim > 1:
+            x = x.mean(axis=1)
+        x = x.astype(np.float32)
+        if np.issubdtype(audio.dtype, np.integer):
+            x /= np.iinfo(audio.dtype).max
+        power = np.mean(x.reshape(n, frame) ** 2, axis=1)
+        db = 10 * np.log10(power + 1e-12)
+        voiced = np.flatnonzero(db > max(self.threshold_db, db.max() - self.relative_db))
+        if voiced.size == 0:
+            return None
+        return voiced[0] * frame, min(len(audio), (voiced[-1] + 1) * frame)
+
+    def bounds(self, audio, sample_rate):
+        '''
+        :return: (first, end) sample of the speech in audio, None if there is none
+        '''
+        if self.vad is not None and sample_rate == self.vad.sampling_rate:
+            return self.vad.speech_bounds(audio)
+        return self._energy_bounds(audio, sample_rate)
+
+    def __call__(self, audio: np.ndarray, sample_rate: int) -> np.ndarray:
+        '''
+        :param audio: mono audio, float or int samples
+        :return: audio without the silence beyond pad_seconds at either end, unchanged if no speech was found
+        '''
+        bounds = self.bounds(audio, sample_rate)
+        if bounds is None:
+            return audio
+        pad = int(self.pad_seconds * sample_rate)
+        start, end = max(0, bounds[0] - pad), min(len(audio), bounds[1] + pad)
+        trimmed = (len(audio) - (end - start)) / sample_rate
+        self.stats['clips'] += 1
+        self.stats['input_seconds'] += len(audio) / sample_rate
+        self.stats['trimmed_seconds'] += trimmed
+        metrics.trimmed_seconds.inc(trimmed, stage=self.stage)
+        return audio[start:end]
@@ -5,3 +5,7 @@ from .tts_parler import Mouth_parler as Mouth_parler
 from .tts_piper import Mouth_piper as Mouth_piper
 from .tts_tortoise import Mouth as Mouth_tortoise
 from .tts_xtts import Mouth_xtts as Mouth_xtts
+from .tts_mock import Mouth_synthetic as Mouth_synthetic
+from .tts_remote import Mouth_remote as Mouth_remote
+from .player import Player_stream as Player_stream
+from .filler import FillerBank as FillerBank
\ No newline at end of file
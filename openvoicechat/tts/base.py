@@ -1,14 +1,17 @@
-import sounddevice as sd
 import re
-from time import monotonic
 import queue
 import threading
 from typing import Callable
 import numpy as np
-import pandas as pd
-import os
-
-TIMING = int(os.environ.get('TIMING', 0))
+from time import monotonic
+from ..tracing import NULL_TURN
+from ..cancel import CancelToken, NULL_TOKEN
+from .. import metrics
+from ..utils import SessionClosed
+from ..capacity import BoundedQueue, AUDIO_QUEUE_SIZE, tts_slots, clear_queue
+from .player import Player_stream
+from .filler import Filler, crossfade
+from ..trim import Trimmer
 
 
 def remove_words_in_brackets_and_spaces(text):
@@ -22,80 +25,286 @@ def remove_words_in_brackets_and_spaces(text):
     return cleaned_text
 
 
+class Playhead:
+    '''
+    What a mouth handed to its player during one response, see BaseMouth.play_chunks and BaseMouth.interrupt.
+    '''
+    def __init__(self):
+        self.chunks = {}  # id returned by the player -> (sentence, first sample of the chunk, samples of the sentence)
+        self.played = None  # the same for the last chunk handed to the player
+        self.fading = None  # the rest of a filler that was cut short, faded into the next sentence
+
+
 class BaseMouth:
-    def __init__(self, sample_rate: int, player=sd):
+    cache = None
+    fillers = None
+    trace = NULL_TURN
+    cancel_token = NULL_TOKEN
+    chunk_seconds = 0.16  # playback chunk, a multiple of the 20 ms Opus frame. None plays whole sentences.
+    monitor_seconds = 600  # longest response the interruption listener waits through
+    fade_seconds = 0.05  # crossfade from a filler into the response
+
+    def __init__(self, sample_rate: int, player=None):
+        '''
+        :param sample_rate: sample rate of the synthesized audio
+        :param player: plays the audio, e.g. Player_ws. Defaults to a Player_stream on the local output device.
+        '''
         self.sample_rate = sample_rate
         self.sentence_stop_pattern = r'[.?](?=\s+\S)'
         self.interrupted = ''
+        if player is None:
+            player = Player_stream() if self.chunk_seconds is None else Player_stream(lead_seconds=2 * self.chunk_seconds)
         self.player = player
+        # silence around each clip is dead air between sentences, keep a short pause
+        self.trimmer = Trimmer('tts', pad_seconds=0.05)
 
     def run_tts(self, text: str) -> np.ndarray:
         '''
         :param text: The text to synthesize speech for
         :return: audio numpy array for sounddevice
+        Backends that synthesize in steps call self.cancel_token.check() between them, backends that read
+        a stream close it with self.cancel_token.on_cancel, to abort cancelled turns.
         '''
         raise NotImplementedError('This method should be implemented by the subclass')
 
+    def use_cache(self, cache):
+        '''
+        :param cache: a SemanticCache (see llm/cache.py) or None to disable caching
+        Sentences that were rendered before are played from the cache instead of calling run_tts.
+        '''
+        self.cache = cache
+
+    def use_fillers(self, fillers):
+        '''
+        :param fillers: a FillerBank (see tts/filler.py) or None to disable fillers
+        A filler is played while the first sentence of a slow response is generated.
+        '''
+        self.fillers = fillers
+
+    def _trim(self, output: np.ndarray) -> np.ndarray:
+        if getattr(self, 'trimmer', None) is None:
+            return output
+        trimmed = self.trimmer(np.asarray(output), self.sample_rate)
+        metrics.trim_saved_seconds.inc((len(output) - len(trimmed)) / self.sample_rate, stage='tts')
+        return trimmed
+
+    def _run_tts_timed(self, text: str) -> np.ndarray:
+        '''
+        :return: the trimmed audio, None if the turn was cancelled before or while it was rendered
+        '''
+        with tts_slots:
+            if self.cancel_token.cancelled:
+                return None
+            start = monotonic()
+            try:
+                output = self.run_tts(text)
+            except Exception:
+                # Cancelled, or the error of a stream that the cancellation closed
+                if self.cancel_token.cancelled:
+                    return None
+                raise
+            metrics.stage_latency.observe(monotonic() - start, stage='tts')
+        if self.cancel_token.cancelled:
+            return None
+        return self._trim(output)
+
+    def _run_tts_cached(self, text: str) -> np.ndarray:
+        if self.cache is None:
+            return self._run_tts_timed(text)
+        item = self.cache.get_audio(text)
+        if item is not None:
+            metrics.tts_cache.inc(result='hit')
+            output, self.sample_rate = item
+            return output
+        metrics.tts_cache.inc(result='miss')
+        output = self._run_tts_timed(text)
+        if output is not None:
+            self.cache.put_audio(text, output, self.sample_rate)
+        return output
+
     def say_text(self, text: str):
         '''
         :param text: The text to synthesize speech for
-        calls run_tts and plays the audio using sounddevice.
+        calls run_tts and plays the audio using the player.
         '''
-        output = self.run_tts(text)
+        output = self._trim(self.run_tts(text))
         self.player.play(output, samplerate=self.sample_rate)
         self.player.wait()
 
+    def play_chunks(self, output: np.ndarray, text, playhead: Playhead, stopped: Callable,
+                    response_ready: Callable = None):
+        '''
+        :param output: the rendered audio of text
+        :param text: the sentence, or the Filler the audio is
+        :param playhead: the Playhead of the response, also crossfades a filler cut short into the output
+        :param stopped: callable () -> bool, playback stops at the next chunk once it returns True
+        :param response_ready: callable () -> bool, a filler is cut short once it returns True
+        Plays the audio in chunks of chunk_seconds and waits for it. Used by say and by the playback stage of
+        the Pipeline (see pipeline.py).
+        '''
+        is_filler = isinstance(text, Filler)
+        if playhead.fading is not None:
+            output = crossfade(playhead.fading, output, self.sample_rate, self.fade_seconds)
+            playhead.fading = None
+        self.trace.mark('filler_start' if is_filler else 'playback_start')
+        step = len(output) if self.chunk_seconds is None else max(1, int(self.chunk_seconds * self.sample_rate))
+        for start in range(0, len(output), step):
+            if stopped():
+                break
+            if is_filler and response_ready is not None and response_ready():
+                playhead.fading = output[start:]
+                break
+            chunk_id = self.player.play(output[start:start + step], samplerate=self.sample_rate)
+            playhead.played = (text, min(start + step, len(output)), len(output))
+            if chunk_id is not None:
+                playhead.chunks[chunk_id] = (text, start, len(output))
+            self.player.wait()
+
+    def interrupt(self, playhead: Playhead, onset: float = None):
+        '''
+        :param playhead: the Playhead of the response
+        :param onset: when the user started speaking, for the stop latency
+        :return: (sentence, its words that were heard) at the playback position, ('', '') if none of the response was
+        Stops the playback right away for an interruption, before anything else cancels the turn.
+        '''
+        self.trace.mark('interruption')
+        heard = self._heard(playhead)
+        self.player.stop()
+        stopped = monotonic() + getattr(self.player, 'latency', 0.0)
+        self.trace.mark('playback_stop', stopped)
+        if onset is not None:
+            metrics.interruption_stop_seconds.observe(stopped - onset)
+        metrics.interruptions.inc()
+        return heard if heard is not None else ('', '')
+
     def say(self, audio_queue: queue.Queue, listen_interruption_func: Callable):
         '''
         :param audio_queue: The queue where the audio is stored for it to be played
-        :param listen_interruption_func: callable function from the ear class.
-        Plays the audios in the queue using sounddevice. Stops if interruption occurred.
+        :param listen_interruption_func: callable(seconds, stop_event) from the ear class, returns the
+                                         transcription of an interruption, '' once stop_event is set.
+        Plays the audios in the queue using the player, in chunks of chunk_seconds. The interruption
+        listener runs in a thread over the whole response, playback stops at the next chunk after an
+        interruption. self.interrupted is then (transcription, sentence, the words of it that were heard).
+        For use without run_chat, whose Pipeline plays with the same play_chunks and interrupt.
         '''
         self.interrupted = ''
-        while True:
+        stop_listening = threading.Event()
+        detected = threading.Event()
+        playhead = Playhead()
+
+        def monitor():
+            try:
+                interruption = listen_interruption_func(self.monitor_seconds, stop_listening)
+            except SessionClosed:
+                self.cancel_token.cancel('session_closed')
+                self.player.stop()
+                detected.set()
+                return
+            if not interruption or stop_listening.is_set():
+                return
+            # act right away, the playback loop may be waiting for the next sentence
+            sentence, heard_words = self.interrupt(playhead, self.trace.marks.get('barge_in'))
+            self.interrupted = (interruption, sentence, heard_words)
+            self.cancel_token.cancel('interruption')
+            detected.set()
+
+        def cancelled():
+            # the turn was cancelled elsewhere, or by the monitor
+            self.player.stop()
+            detected.set()
+
+        cancel_hook = self.cancel_token.on_cancel(cancelled)
+        monitor_thread = threading.Thread(target=monitor, daemon=True)
+        monitor_thread.start()
+        ended = False
+        while not detected.is_set():
             output, text = audio_queue.get()
             if output is None:
+                ended = True
                 break
-            # get the duration of audio
-            duration = len(output) / self.sample_rate
-            self.player.play(output, samplerate=self.sample_rate)
-            interruption = listen_interruption_func(duration)
-            if interruption:
-                self.player.stop()
-                self.interrupted = (interruption, text)
-                break
-            else:
-                self.player.wait()
+            self.play_chunks(output, text, playhead, detected.is_set, lambda: audio_queue.qsize() > 0)
+        self.cancel_token.remove(cancel_hook)
+        if detected.is_set():
+            # a chunk may have been handed to the player while the monitor stopped it
+            self.player.stop()
+            self.cancel_token.stopped('playback')
+            if not ended:
+                self._drain(audio_queue)
+        stop_listening.set()
+        monitor_thread.join()
+
+    def _heard(self, playhead):
+        '''
+        :return: (sentence, its words that were heard) at the playback position, None if nothing was played
+        '''
+        cursor = self.player.cursor() if hasattr(self.player, 'cursor') else None
+        if cursor is not None and cursor[0] in playhead.chunks:
+            sentence, start, total = playhead.chunks[cursor[0]]
+            position = start + cursor[1]
+        elif playhead.played is not None:
+            # the player cannot tell, assume everything handed to it was heard
+            sentence, position, total = playhead.played
+        else:
+            return None
+        if isinstance(sentence, Filler):
+            return '', ''
+        words = sentence.split()
+        return sentence, ' '.join(words[:round(len(words) * position / max(total, 1))])
+
+    @staticmethod
+    def _drain(audio_queue):
+        # the producer may be blocked on the bounded queue, consume until its end marker
+        while audio_queue.get()[0] is not None:
+            pass
 
     def say_multiple(self, text: str, listen_interruption_func: Callable):
         '''
         :param text: Intput text to synthesize
         :param listen_interruption_func: callable function from the ear class
         Splits the text into sentences separated by ['.', '?', '!']. Then plays the sentences one by one
-        using run_tts and say
+        using run_tts and say. Stops rendering once interrupted or the ear closed.
         '''
         pattern = r'[.?!]'
         sentences = re.split(pattern, text)
         sentences = [sentence.strip() for sentence in sentences if sentence.strip()]
         print(sentences)
-        audio_queue = queue.Queue()
+        owns_token = self.cancel_token is NULL_TOKEN
+        if owns_token:
+            # outside run_chat, a token of its own lets say stop the rendering
+            self.cancel_token = CancelToken()
+        audio_queue = BoundedQueue(AUDIO_QUEUE_SIZE)
         say_thread = threading.Thread(target=self.say, args=(audio_queue, listen_interruption_func))
         say_thread.start()
-        for sentence in sentences:
-            output = self.run_tts(sentence)
-            audio_queue.put((output, sentence))
-            if self.interrupted:
-                break
-        audio_queue.put((None, ''))
-        say_thread.join()
+        try:
+            for sentence in sentences:
+                output = self._run_tts_cached(sentence)
+                if output is None or self.cancel_token.cancelled:
+                    break
+                audio_queue.put((output, sentence))
+            self.cancel_token.stopped('tts')
+        finally:
+            audio_queue.put((None, ''))
+            say_thread.join()
+            if owns_token:
+                self.cancel_token = NULL_TOKEN
+
+    @staticmethod
+    def heard_response(sentences, sentence, heard_words) -> list:
+        '''
+        :param sentences: the sentences of the response that were rendered, in order
+        :param sentence: the sentence playing when the user interrupted, see interrupt
+        :param heard_words: its words the user heard
+        :return: the sentences of the response the user heard, to keep in the history
+        '''
+        # nothing of the response was heard if the interruption came during a filler or before the playback
+        idx = sentences.index(sentence) if sentence in sentences else 0
+        # keep the part of the sentence that was played, the history should match what the user heard
+        return sentences[:idx] + [heard_words + '...']
 
     def _handle_interruption(self, responses_list, interrupt_queue):
-        interrupt_transcription, interrupt_text = self.interrupted
-        idx = responses_list.index(interrupt_text)
-        assert idx != -1, "Interrupted text not found in responses list. This should not happen. Raise an issue."
-        responses_list = responses_list[:idx] + ['...']
+        interrupt_transcription, interrupt_text, heard = self.interrupted
         interrupt_queue.put(interrupt_transcription)
-        return responses_list
+        return self.heard_response(responses_list, interrupt_text, heard)
 
     def say_multiple_stream(self, text_queue: queue.Queue,
                             listen_interruption_func: Callable,
@@ -107,21 +316,22 @@ class BaseMouth:
         :param interrupt_queue: The queue where True is put when interruption occurred.
         :param audio_queue: The queue where the audio to be played is placed
         Receives text from the text_queue. As soon as a sentence is made run_tts is called to
-        synthesize its speech.
+        synthesize its speech. Stops rendering once self.cancel_token is cancelled.
         '''
         response = ''
         all_response = []
         interrupt_text_list = []
+        text = ''
 
         if audio_queue is None:
-            audio_queue = queue.Queue()
-
-        first_sentence = True
-        first_audio = True
-        llm_start = monotonic()
+            audio_queue = BoundedQueue(AUDIO_QUEUE_SIZE)
 
         say_thread = threading.Thread(target=self.say, args=(audio_queue, listen_interruption_func))
         say_thread.start()
+        start = monotonic()
+        filler = self.fillers.pick(self.sample_rate) if self.fillers is not None else None
+        if filler is not None:
+            audio_queue.put(filler)
         while True:
             text = text_queue.get()
             if text is None:
@@ -132,29 +342,18 @@ class BaseMouth:
                     sentences = re.split(self.sentence_stop_pattern, response, maxsplit=1)
                     sentence = sentences[0]
                     response = sentences[1]
-                    if first_sentence and TIMING:
-                        llm_end = monotonic()
-                        time_diff = llm_end - llm_start
-                        new_row = {'Model': 'LLM', 'Time Taken': time_diff}
-                        new_row_df = pd.DataFrame([new_row])
-                        new_row_df.to_csv('times.csv', mode='a', header=False, index=False)
-                        first_sentence = False
                 else:
                     continue
             if sentence.strip() == '':
                 break
+            self.trace.mark('first_sentence')
             clean_sentence = remove_words_in_brackets_and_spaces(sentence).strip()
-            if TIMING and first_audio:
-                tts_start = monotonic()
-                output = self.run_tts(clean_sentence)
-                tts_end = monotonic()
-                time_diff = tts_end - tts_start
-                new_row = {'Model': 'TTS', 'Time Taken': time_diff}
-                new_row_df = pd.DataFrame([new_row])
-                new_row_df.to_csv('times.csv', mode='a', header=False, index=False)
-                first_audio = False
-            else:
-                output = self.run_tts(clean_sentence)
+            output = self._run_tts_cached(clean_sentence)
+            if output is None:
+                break
+            self.trace.mark('first_tts_chunk')
+            if self.fillers is not None and not all_response:
+                self.fillers.observe(monotonic() - start)
             audio_queue.put((output, clean_sentence))
             all_response.append(sentence)
             interrupt_text_list.append(clean_sentence)
@@ -164,9 +363,13 @@ class BaseMouth:
                 break
             if text is None:
                 break
+        self.cancel_token.stopped('tts')
         audio_queue.put((None, ''))
         say_thread.join()
         if self.interrupted:
             all_response = self._handle_interruption(interrupt_text_list, interrupt_queue)
-        text_queue.queue.clear()
+        # let the llm finish (it stops early on interruptions) so that it is not left blocked on the bounded queue
+        while text is not None:
+            text = text_queue.get()
+        clear_queue(text_queue)
         text_queue.put('. '.join(all_response))
@@ -0,0 +1,89 @@
+import random
+import threading
+import numpy as np
+
+FILLERS = ['Hmm.', 'Okay.', 'Sure.', 'Got it.', 'Right, let me see.', 'Mhm.']
+
+# rendered fillers of every voice in this process, (voice, phrase) -> (audio, sample_rate)
+_rendered = {}
+_rendered_lock = threading.Lock()
+
+
+class Filler(str):
+    '''
+    Text of a filler in the audio queue, say fades it into the response instead of recording it as spoken.
+    '''
+
+
+class FillerBank:
+    def __init__(self, mouth, phrases=None, voice=None, threshold=0.6, initial_latency=1.0, smoothing=0.3):
+        '''
+        :param mouth: renders the fillers with its run_tts, at construction
+        :param phrases: short fillers and acknowledgements, defaults to FILLERS
+        :param voice: key under which the audio is shared with other banks of the same voice,
+                      defaults to the mouth's class and voice_id
+        :param threshold: a filler is played when the expected seconds until the response starts exceed this
+        :param initial_latency: expected latency until the first response was measured
+        :param smoothing: weight of the latest measurement in the expected latency
+
+        Plays a pre-rendered filler right after the user's turn while the llm and the tts
+        work on the first sentence, see BaseMouth.use_fillers. The audio is rendered once per
+        voice and process, sessions with the same voice share it.
+        '''
+        self.phrases = FILLERS if phrases is None else phrases
+        if voice is None:
+            voice = f'{type(mouth).__name__}:{getattr(mouth, "voice_id", "")}'
+        self.voice = voice
+        self.threshold = threshold
+        self.expected = initial_latency
+        self.smoothing = smoothing
+        self.stats = {'played': 0, 'skipped': 0}
+        self._last = None
+        for phrase in self.phrases:
+            key = (voice, phrase)
+            with _rendered_lock:
+                if key in _rendered:
+                    continue
+            audio = np.asarray(mouth.run_tts(phrase))
+            if getattr(mouth, 'trimmer', None) is not None:
+                # a filler is short, its leading silence would be most of the latency it hides
+                audio = mouth.trimmer(audio, mouth.sample_rate)
+            with _rendered_lock:
+                _rendered[key] = (audio, mouth.sample_rate)
+
+    def observe(self, seconds):
+        '''
+        :param seconds: time from the end of the user's turn to the first sentence of the response
+        '''
+        self.expected += self.smoothing * (seconds - self.expected)
+
+    def pick(self, sample_rate):
+        '''
+        :param sample_rate: rate the mouth plays at, fillers of another rate are not used
+        :return: (audio, Filler) to put in the audio queue, None if the response is expected soon
+        '''
+        if self.expected < self.threshold:
+            self.stats['skipped'] += 1
+            return None
+        choices = [p for p in self.phrases if p != self._last] or self.phrases
+        phrase = random.choice(choices)
+        audio, rate = _rendered[(self.voice, phrase)]
+        if rate != sample_rate:
+            return None
+        self._last = phrase
+        self.stats['played'] += 1
+        return audio, Filler(phrase)
+
+
+def crossfade(head, audio, sample_rate, seconds):
+    '''
+    :param head: the end of the audio playing now
+    :param audio: the audio that follows
+    :return: audio starting with head faded into it over at most seconds
+    '''
+    n = min(len(head), len(audio), int(seconds * sample_rate))
+    if n == 0:
+        return audio
+    ramp = np.linspace(0, 1, n, dtype=np.float32)
+    mixed = head[:n].astype(np.float32) * (1 - ramp) + audio[:n].astype(np.float32) * ramp
+    return np.concatenate([mixed.astype(audio.dtype), audio[n:]])
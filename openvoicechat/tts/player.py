@@ -0,0 +1,168 @@
+import threading
+from collections import deque
+from time import sleep
+import numpy as np
+
+
+class Player_stream:
+    def __init__(self, buffer_seconds=30, blocksize=256, lead_seconds=0.32, device=None):
+        '''
+        :param buffer_seconds: capacity of the ring buffer, play blocks while it is full
+        :param blocksize: samples the audio callback fills per call
+        :param lead_seconds: wait returns when this much audio is left, so that the next play
+                             continues the stream without a gap. Keep it at two chunks of the
+                             mouth (BaseMouth.chunk_seconds): a stall of the thread that plays
+                             longer than the lead underflows the stream. stop drops the queued
+                             audio anyway, a longer lead does not delay interruptions.
+        :param device: sounddevice output device, defaults to the system default
+
+        Plays through one sounddevice OutputStream that stays open between sentences, instead of
+        opening a stream per sentence like sounddevice.play. play appends to a ring buffer that the
+        audio callback reads from. The callback takes no locks: the writer only moves the write index,
+        the callback only moves the read index, and stop asks the callback to skip to the write index.
+        '''
+        self.buffer_seconds = buffer_seconds
+        self.blocksize = blocksize
+        self.lead_seconds = lead_seconds
+        self.device = device
+        self.samplerate = None
+        self.stream = None
+        self.underflows = 0
+        self._ring = None
+        self._write = 0  # samples written since the stream was opened, moved by play
+        self._read = 0  # samples played, moved by the callback
+        self._flush = 0  # the callback skips to here, set by stop
+        self._segments = deque()  # (id, first sample, end sample) of every play
+        self._next_id = 0
+        self._lock = threading.Lock()  # between writers, never taken by the callback
+
+    def _open(self, samplerate):
+        import sounddevice as sd
+        if self.stream is not None:
+            self.wait(lead_seconds=0)
+            self.stream.close()
+        self.samplerate = samplerate
+        self._ring = np.zeros(int(self.buffer_seconds * samplerate), dtype=np.float32)
+        self._write = self._read = self._flush = 0
+        self._segments.clear()
+        self.stream = sd.OutputStream(samplerate=samplerate, channels=1, dtype='float32',
+                                      blocksize=self.blocksize, device=self.device, callback=self._callback)
+        self.stream.start()
+
+    def _callback(self, outdata, frames, time, status):
+        if status.output_underflow:
+            self.underflows += 1
+        if self._flush > self._read:
+            self._read = self._flush
+        n = min(frames, self._write - self._read)
+        start = self._read % len(self._ring)
+        first = min(n, len(self._ring) - start)
+        outdata[:first, 0] = self._ring[start:start + first]
+        outdata[first:n, 0] = self._ring[:n - first]
+        outdata[n:] = 0
+        self._read += n
+
+    @staticmethod
+    def _mono_float32(audio_array):
+        audio = np.asarray(audio_array)
+        if audio.ndim > 1:
+            audio = audio.mean(axis=1)
+        if np.issubdtype(audio.dtype, np.integer):
+            return audio.astype(np.float32) / np.iinfo(audio.dtype).max
+        return audio.astype(np.float32, copy=False)
+
+    def play(self, audio_array, samplerate):
+        '''
+        :param audio_array: audio to append to what is playing
+        :param samplerate: sample rate of the audio, the stream is reopened if it changes
+        :return: id of the audio for cursor
+        '''
+        with self._lock:
+            if samplerate != self.samplerate:
+                self._open(samplerate)
+            audio = self._mono_float32(audio_array)
+            start = self._write
+            capacity = len(self._ring)
+            i = 0
+            while i < len(audio):
+                space = capacity - (self._write - self._read)
+                if space == 0:
+                    sleep(self.blocksize / self.samplerate)
+                    continue
+                n = min(space, len(audio) - i)
+                w = self._write % capacity
+                first = min(n, capacity - w)
+                self._ring[w:w + first] = audio[i:i + first]
+                self._ring[:n - first] = audio[i + first:i + n]
+                i += n
+                # the callback may only read samples once they are in the ring
+                self._write += n
+            segment = self._next_id
+            self._next_id += 1
+            while self._segments and self._segments[0][2] <= self._read - self.samplerate:
+                self._segments.popleft()
+            self._segments.append((segment, start, self._write))
+            return segment
+
+    @property
+    def playing(self) -> bool:
+        return self.stream is not None and self._write > max(self._read, self._flush)
+
+    @property
+    def latency(self) -> float:
+        '''
+        :return: seconds from stop until the output is silent
+        '''
+        if self.stream is None:
+            return 0.0
+        return self.stream.latency + self.blocksize / self.samplerate
+
+    def queued_seconds(self) -> float:
+        '''
+        :return: seconds of audio in the ring that were not played yet
+        '''
+        if self.stream is None:
+            return 0.0
+        return max(0, self._write - max(self._read, self._flush)) / self.samplerate
+
+    def cursor(self):
+        '''
+        :return: (id, sample) of the audio heard right now, the id returned by play and the
+                 sample within it, accounting for the output latency. None when nothing plays.
+        '''
+        if self.stream is None:
+            return None
+        heard = self._read - int(self.stream.latency * self.samplerate)
+        for segment, start, end in list(self._segments):
+            if start <= heard < end:
+                return segment, heard - start
+        return None
+
+    def wait(self, lead_seconds=None):
+        '''
+        :param lead_seconds: returns when this much audio is left, defaults to lead_seconds of the player
+        '''
+        lead = int((self.lead_seconds if lead_seconds is None else lead_seconds) * (self.samplerate or 0))
+        while self.stream is not None:
+            left = self._write - max(self._read, self._flush)
+            if left <= lead:
+                break
+            sleep(min(0.01, (left - lead) / self.samplerate))
+
+    def stop(self):
+        '''
+        Drops what was not played yet, the callback stops at its next block.
+        '''
+        self._flush = self._write
+
+    def close(self):
+        '''
+        Plays what is left, then closes the stream.
+        '''
+        with self._lock:
+            if self.stream is not None:
+                self.wait(lead_seconds=0)
+                sleep(self.stream.latency)
+                self.stream.close()
+                self.stream = None
+                self.samplerate = None
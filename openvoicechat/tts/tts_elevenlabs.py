@@ -6,7 +6,6 @@ from dotenv import load_dotenv
 from pydub import AudioSegment
 import io
 import numpy as np
-import sounddevice as sd
 import requests
 import os
 from dotenv import load_dotenv
@@ -15,7 +14,7 @@ load_dotenv(override=True)
 class Mouth_elevenlabs(BaseMouth):
     def __init__(self, model_id='eleven_turbo_v2',
                  voice_id='IKne3meq5aSn9XLyUdCD',
-                 player=sd):
+                 player=None):
         self.model_id = model_id
         self.voice_id = voice_id
         load_dotenv()
@@ -39,8 +38,14 @@ class Mouth_elevenlabs(BaseMouth):
             }
         }
 
-        response = requests.post(url, json=data, headers=headers)
-        audio_segment = AudioSegment.from_file(io.BytesIO(response.content), format="mp3")
+        response = requests.post(url, json=data, headers=headers, stream=True)
+        # a cancelled turn closes the response instead of downloading the rest
+        close = self.cancel_token.on_cancel(response.close)
+        try:
+            content = b''.join(response.iter_content(chunk_size=4096))
+        finally:
+            self.cancel_token.remove(close)
+        audio_segment = AudioSegment.from_file(io.BytesIO(content), format="mp3")
 
         samples = np.array(audio_segment.get_array_of_samples())
 
@@ -56,5 +61,5 @@ if __name__ == '__main__':
             "efficient. There's no reason why we can't combine the benefits of self-driving cars with the ease of use "
             "of human-driven cars.")
     print(text)
-    mouth.say_multiple(text, lambda x: False)
-    sd.wait()
+    mouth.say_multiple(text, lambda *args: False)
+    mouth.player.close()
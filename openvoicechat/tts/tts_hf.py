@@ -1,4 +1,3 @@
-import sounddevice as sd
 import torch
 if __name__ == '__main__':
     from base import BaseMouth
@@ -8,7 +7,7 @@ else:
 
 class Mouth_hf(BaseMouth):
     def __init__(self, model_id='kakao-enterprise/vits-vctk', device='cpu',
-                 forward_params=None, player=sd):
+                 forward_params=None, player=None):
         from transformers import pipeline
         self.pipe = pipeline('text-to-speech', model=model_id, device=device)
         self.device = device
@@ -33,5 +32,5 @@ if __name__ == '__main__':
             "efficient. There's no reason why we can't combine the benefits of self-driving cars with the ease of use "
             "of human-driven cars.")
     print(text)
-    mouth.say_multiple(text, lambda x: False)
-    sd.wait()
+    mouth.say_multiple(text, lambda *args: False)
+    mouth.player.close()
@@ -0,0 +1,54 @@
+from time import sleep, monotonic
+import numpy as np
+if __name__ == '__main__':
+    from base import BaseMouth
+else:
+    from .base import BaseMouth
+
+
+class Player_null:
+    def __init__(self):
+        '''
+        Plays nothing but takes as long as the audio would, like sounddevice.
+        '''
+        self.end = 0.0
+
+    def play(self, audio_array, samplerate):
+        self.end = monotonic() + len(audio_array) / samplerate
+
+    def stop(self):
+        self.end = 0.0
+
+    def wait(self):
+        delay = self.end - monotonic()
+        if delay > 0:
+            sleep(delay)
+
+
+class Mouth_synthetic(BaseMouth):
+    def __init__(self, sample_rate=16000, latency=0.15, latency_per_char=0.002,
+                 seconds_per_char=0.06, player=None):
+        '''
+        :param sample_rate: sample rate of the generated audio
+        :param latency: fixed seconds per run_tts call
+        :param latency_per_char: additional seconds per character of text
+        :param seconds_per_char: length of the generated audio per character of text
+        :param player: defaults to Player_null
+
+        Local stand-in for a TTS model with synthetic latency and audio length, for benchmarks and load tests.
+        '''
+        super().__init__(sample_rate=sample_rate, player=Player_null() if player is None else player)
+        self.latency = latency
+        self.latency_per_char = latency_per_char
+        self.seconds_per_char = seconds_per_char
+
+    def run_tts(self, text):
+        sleep(self.latency + self.latency_per_char * len(text))
+        n = int(len(text) * self.seconds_per_char * self.sample_rate)
+        t = np.arange(n, dtype=np.float32) / self.sample_rate
+        return (0.1 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+
+
+if __name__ == '__main__':
+    mouth = Mouth_synthetic()
+    mouth.say_multiple('Hello there. This is a synthetic voice.', lambda *args: False)
@@ -1,7 +1,6 @@
 import torch
-from transformers import AutoTokenizer
+from transformers import AutoTokenizer, StoppingCriteria, StoppingCriteriaList
 from transformers.modeling_outputs import BaseModelOutput
-import sounddevice as sd
 if __name__ == '__main__':
     from base import BaseMouth
 else:
@@ -20,11 +19,19 @@ words at a slightly faster-than-average pace in a confined space with very clear
 etc ....
 '''
 
+class _StopWhenCancelled(StoppingCriteria):
+    def __init__(self, mouth):
+        self.mouth = mouth
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.mouth.cancel_token.cancelled
+
+
 class Mouth_parler(BaseMouth):
     def __init__(self, model_id='parler-tts/parler_tts_mini_v0.1',
                  tts_description=None,
                  device='cuda:0' if torch.cuda.is_available() else 'cpu',
-                 temperature=1.0, player=sd):
+                 temperature=1.0, player=None):
         from parler_tts import ParlerTTSForConditionalGeneration
         if tts_description is None:
             tts_description = ('A female speaker with a slightly low-pitched voice delivers her words quite '
@@ -42,8 +49,11 @@ class Mouth_parler(BaseMouth):
         prompt_input_ids = self.tokenizer(text, return_tensors="pt").input_ids.to(self.device)
         generation = self.model.generate(encoder_outputs=self.desc_tensor,
                                          prompt_input_ids=prompt_input_ids,
-                                         temperature=self.temperature
+                                         temperature=self.temperature,
+                                         stopping_criteria=StoppingCriteriaList([_StopWhenCancelled(self)])
                                          )
+        # generation stopped early, the audio is cut off
+        self.cancel_token.check()
         audio_arr = generation.cpu().numpy().squeeze()
         return audio_arr
 
@@ -57,5 +67,5 @@ if __name__ == '__main__':
             "efficient. There's no reason why we can't combine the benefits of self-driving cars with the ease of use "
             "of human-driven cars.")
     print(text)
-    mouth.say_multiple(text, lambda x: False)
-    sd.wait()
+    mouth.say_multiple(text, lambda *args: False)
+    mouth.player.close()
@@ -1,4 +1,3 @@
-import sounddevice as sd
 import numpy as np
 import torch
 if __name__ == '__main__':
@@ -9,7 +8,7 @@ else:
 class Mouth_piper(BaseMouth):
     def __init__(self, device='cpu', model_path='models/en_US-ryan-high.onnx',
                  config_path='models/en_en_US_ryan_high_en_US-ryan-high.onnx.json',
-                 player=sd):
+                 player=None):
         import piper
         self.model = piper.PiperVoice.load(model_path=model_path,
                                            config_path=config_path,
@@ -19,6 +18,7 @@ class Mouth_piper(BaseMouth):
     def run_tts(self, text):
         audio = b''
         for i in self.model.synthesize_stream_raw(text):
+            self.cancel_token.check()
             audio += i
         return np.frombuffer(audio, dtype=np.int16)
 
@@ -33,5 +33,5 @@ if __name__ == '__main__':
             "efficient. There's no reason why we can't combine the benefits of self-driving cars with the ease of use "
             "of human-driven cars.")
     print(text)
-    mouth.say_multiple(text, lambda x: False)
-    sd.wait()
+    mouth.say_multiple(text, lambda *args: False)
+    mouth.player.close()
@@ -1,4 +1,3 @@
-import sounddevice as sd
 import boto3
 import io
 import numpy as np
@@ -14,7 +13,7 @@ load_dotenv(override=True)
 class Mouth_polly(BaseMouth):
     def __init__(self, voice_id='Joanna', engine='neural', language_code='en-US',
                  output_format='mp3', aws_access_key_id=None, aws_secret_access_key=None,
-                 region_name='us-east-1', player=sd):
+                 region_name='us-east-1', player=None):
         """
         Initialize Amazon Polly TTS
         
@@ -25,7 +24,7 @@ class Mouth_polly(BaseMouth):
         :param aws_access_key_id: AWS access key (optional, can use environment variables)
         :param aws_secret_access_key: AWS secret key (optional, can use environment variables)
         :param region_name: AWS region
-        :param player: Audio player (default: sounddevice)
+        :param player: Audio player (default: Player_stream)
         """
         self.voice_id = voice_id
         self.engine = engine
@@ -74,8 +73,13 @@ class Mouth_polly(BaseMouth):
             # Make the request to Polly
             response = self.polly_client.synthesize_speech(**params)
             
-            # Get audio data
-            audio_data = response['AudioStream'].read()
+            # Get audio data, a cancelled turn closes the stream
+            stream = response['AudioStream']
+            close = self.cancel_token.on_cancel(stream.close)
+            try:
+                audio_data = b''.join(stream.iter_chunks())
+            finally:
+                self.cancel_token.remove(close)
             
             if self.output_format == 'pcm':
                 # PCM format - convert directly to numpy array
@@ -131,6 +135,6 @@ if __name__ == '__main__':
             "of human-driven cars.")
     
     print("\nTesting with standard voice (Matthew)...")
-    mouth_standard.say_multiple(text, lambda x: False)
-    sd.wait()
+    mouth_standard.say_multiple(text, lambda *args: False)
+    mouth_standard.player.close()
 
@@ -0,0 +1,28 @@
+import numpy as np
+if __name__ == '__main__':
+    from base import BaseMouth
+else:
+    from .base import BaseMouth
+
+
+class Mouth_remote(BaseMouth):
+    def __init__(self, pool=None, model='openvoicechat.tts.tts_piper:Mouth_piper', model_kwargs=None, workers=1,
+                 player=None):
+        '''
+        :param pool: a ModelPool serving run_tts (see openvoicechat/remote.py), shared between sessions
+        :param model: 'module:Class' of the mouth, used when no pool is given
+        :param model_kwargs: keyword arguments for the mouth class, used when no pool is given
+        :param workers: number of worker processes, used when no pool is given
+        :param player: plays the audio in this process
+
+        Synthesizes in the pool's worker processes, plays and listens for interruptions locally.
+        '''
+        if pool is None:
+            from ..remote import ModelPool
+            pool = ModelPool(model, 'run_tts', workers=workers, model_kwargs=model_kwargs)
+        self.pool = pool
+        super().__init__(sample_rate=pool.sample_rate, player=player)
+
+    def run_tts(self, text: str) -> np.ndarray:
+        output, self.sample_rate = self.pool.call(text)
+        return output
@@ -1,4 +1,3 @@
-import sounddevice as sd
 import torch
 import numpy as np
 if __name__ == '__main__':
@@ -8,7 +7,7 @@ else:
 
 
 class Mouth_xtts(BaseMouth):
-    def __init__(self, model_id='tts_models/en/jenny/jenny', device='cpu', player=sd):
+    def __init__(self, model_id='tts_models/en/jenny/jenny', device='cpu', player=None):
         from TTS.api import TTS
         self.model = TTS(model_id)
         self.device = device
@@ -29,5 +28,5 @@ if __name__ == '__main__':
             "efficient. There's no reason why we can't combine the benefits of self-driving cars with the ease of use "
             "of human-driven cars.")
     print(text)
-    mouth.say_multiple(text, lambda x: False)
-    sd.wait()
+    mouth.say_multiple(text, lambda *args: False)
+    mouth.player.close()
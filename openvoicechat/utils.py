@@ -4,8 +4,12 @@ import librosa
 import numpy as np
 import os
 import logging
-
-import pandas as pd
+from time import monotonic, sleep
+from .tracing import tracer
+from . import metrics
+from .capacity import clear_queue
+from .codec import OpusEncoder, OpusDecoder
+from .jitter import JitterBuffer, FRAME
 
 # Configure basic logging for the module
 logger = logging.getLogger(__name__)
@@ -14,11 +18,20 @@ if not logger.hasHandlers():
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 
-TIMING = int(os.environ.get('TIMING', 0))
+class SessionClosed(Exception):
+    '''
+    Raised by the websocket listener when its session was closed, unwinds run_chat.
+    '''
+
+
+class ReadCancelled(Exception):
+    '''
+    Raised by the websocket listener when the stop_event of its stream was set, see record_interruption.
+    '''
 
 
 def run_chat(mouth, ear, chatbot, verbose=True, enable_interruptions=True,
-             stopping_criteria=lambda x: False):
+             stopping_criteria=lambda x: False, session_id=None, stop_event=None):
     """
     Runs a chat session between a user and a bot.
 
@@ -31,58 +44,50 @@ def run_chat(mouth, ear, chatbot, verbose=True, enable_interruptions=True,
         stopping_criteria (function, optional): A function that determines when the chat should stop.
                                                 It takes the bot's response as input and returns a boolean.
                                                 Defaults to a function that always returns False.
-
-    The function works by continuously listening to the user's input and generating the bot's responses in separate
-    threads. If the user interrupts the bot's speech (and interruptions are enabled), the remaining part of the bot's
-    response is saved and prepended to the user's next input. The chat stops when the stopping_criteria function
-    returns True for a bot's response.
+        session_id (str, optional): Id under which the turns of this chat are traced (see tracing.py).
+        stop_event (threading.Event, optional): The chat stops before the next turn once this is set.
+
+    The function runs a Pipeline (see pipeline.py): one thread per stage (capture, endpointing, STT, LLM,
+    sentence segmentation, TTS, playback) for the whole session, connected by bounded channels. If the user
+    interrupts the bot's speech (and interruptions are enabled), the turn's CancelToken is cancelled, which
+    stops the llm, the tts and the playback (see cancel.py), and the part of the bot's response the user heard
+    is kept in the history. The interruption is prepended to the user's next input. The chat stops when the
+    stopping_criteria function returns True for a bot's response.
     """
-    if TIMING:
-        pd.DataFrame(columns=['Model', 'Time Taken']).to_csv('times.csv', index=False)
-
-    pre_interruption_text = ''
-    while True:
-        user_input = pre_interruption_text + ' ' + ear.listen()
-
-        if verbose:
-            print("USER: ", user_input)
-
-        llm_output_queue = queue.Queue()
-        interrupt_queue = queue.Queue()
-        llm_thread = threading.Thread(target=chatbot.generate_response_stream,
-                                      args=(user_input, llm_output_queue, interrupt_queue))
-        
-        def no_interrupt_listener(duration): # duration is unused but part of the expected signature
-            return False
-
-        active_interrupt_listener = ear.interrupt_listen if enable_interruptions else no_interrupt_listener
-        
-        tts_thread = threading.Thread(target=mouth.say_multiple_stream,
-                                      args=(llm_output_queue, active_interrupt_listener, interrupt_queue))
-
-        llm_thread.start()
-        tts_thread.start()
-
-        tts_thread.join()
-        llm_thread.join()
-        if not interrupt_queue.empty():
-            pre_interruption_text = interrupt_queue.get()
-
-        res = llm_output_queue.get()
-        if stopping_criteria(res):
-            break
-        if verbose:
-            print('BOT: ', res)
+    from .pipeline import Pipeline
+    if session_id is None:
+        session_id = tracer.new_session()
+
+    pipeline = Pipeline(mouth, ear, chatbot, session_id=session_id, enable_interruptions=enable_interruptions,
+                        verbose=verbose).start()
+    try:
+        for turn in pipeline.turns(stop_event):
+            turn.trace.end()
+            if stopping_criteria(turn.response):
+                break
+            if verbose:
+                print('BOT: ', turn.response)
+    finally:
+        pipeline.stop()
+    if verbose:
+        print(tracer.format_summary(session_id))
 
 
 class Player_ws:
     def __init__(self, q):
         self.output_queue = q
         self.playing = False
+        self.encoder = None
         logger.info("Player_ws initialized.")
 
+    def configure(self, codec='pcm'):
+        '''
+        :param codec: 'pcm' sends float32, 'opus' sends Opus packets (see codec.py)
+        '''
+        self.encoder = OpusEncoder(16000) if codec == 'opus' else None
+
     def play(self, audio_array, samplerate):
-        logger.info(f"Player_ws: Play method called. Input audio array type: {type(audio_array)}, dtype: {audio_array.dtype}, shape: {audio_array.shape}, samplerate: {samplerate}")
+        logger.debug(f"Player_ws: Play method called. Input audio array type: {type(audio_array)}, dtype: {audio_array.dtype}, shape: {audio_array.shape}, samplerate: {samplerate}")
         
         # Ensure audio_array is float32 and normalized
         if audio_array.dtype == np.int16:
@@ -96,12 +101,14 @@ class Player_ws:
 
         if samplerate == target_sr_frontend:
             processed_audio = audio_array
-            logger.info(f"Player_ws: Input samplerate ({samplerate} Hz) matches target frontend samplerate ({target_sr_frontend} Hz). No resampling needed.")
+            logger.debug(f"Player_ws: Input samplerate ({samplerate} Hz) matches target frontend samplerate ({target_sr_frontend} Hz). No resampling needed.")
         else:
-            logger.info(f"Player_ws: Input samplerate ({samplerate} Hz) differs from target frontend samplerate ({target_sr_frontend} Hz). Resampling audio from {samplerate} Hz to {target_sr_frontend} Hz...")
+            logger.debug(f"Player_ws: Input samplerate ({samplerate} Hz) differs from target frontend samplerate ({target_sr_frontend} Hz). Resampling audio from {samplerate} Hz to {target_sr_frontend} Hz...")
             try:
+                resample_start = monotonic()
                 processed_audio = librosa.resample(y=audio_array, orig_sr=samplerate, target_sr=target_sr_frontend)
-                logger.info(f"Player_ws: Resampled to {target_sr_frontend} Hz float32. New shape: {processed_audio.shape}")
+                metrics.resample_seconds.observe(monotonic() - resample_start, direction='out')
+                logger.debug(f"Player_ws: Resampled to {target_sr_frontend} Hz float32. New shape: {processed_audio.shape}")
             except Exception as e:
                 logger.error(f"Player_ws: Error during resampling: {e}. Sending audio with original samplerate {samplerate} Hz instead.", exc_info=True)
                 processed_audio = audio_array # Fallback to original audio if resampling fails
@@ -112,10 +119,13 @@ class Player_ws:
         # Ensure processed_audio is C-contiguous for tobytes() if librosa output isn't guaranteed to be,
         # or if the no-resampling path resulted in a non-contiguous view (less likely for direct assignment).
         if not processed_audio.flags['C_CONTIGUOUS']:
-            logger.info("Player_ws: Processed audio is not C-contiguous. Making a contiguous copy.")
+            logger.debug("Player_ws: Processed audio is not C-contiguous. Making a contiguous copy.")
             processed_audio = np.ascontiguousarray(processed_audio)
 
-        audio_bytes = processed_audio.tobytes()
+        if self.encoder is not None:
+            audio_bytes = self.encoder.encode(processed_audio)
+        else:
+            audio_bytes = processed_audio.tobytes()
         
         # Determine the actual sample rate of the data being sent
         # This is crucial for accurate logging, especially if resampling failed.
@@ -125,53 +135,166 @@ class Player_ws:
                 final_samplerate_being_sent = samplerate
 
 
-        logger.info(f"Player_ws: Putting audio to output queue. Actual Sample Rate of Data: {final_samplerate_being_sent} Hz, Data type: {processed_audio.dtype}, Shape: {processed_audio.shape}, Bytes length: {len(audio_bytes)}")
+        logger.debug(f"Player_ws: Putting audio to output queue. Actual Sample Rate of Data: {final_samplerate_being_sent} Hz, Data type: {processed_audio.dtype}, Shape: {processed_audio.shape}, Bytes length: {len(audio_bytes)}")
+        metrics.audio_bytes.inc(len(audio_bytes), direction='out')
         self.output_queue.put(audio_bytes)
 
     def stop(self):
         logger.info("Player_ws: Stop called.")
         self.playing = False
-        self.output_queue.queue.clear()
+        clear_queue(self.output_queue)
+        if self.encoder is not None:
+            self.encoder.reset()
         self.output_queue.put('stop'.encode())
 
     def wait(self):
-        logger.info("Player_ws: wait() called, doing nothing for WebSocket player.")
+        logger.debug("Player_ws: wait() called, doing nothing for WebSocket player.")
         pass
 
 
 class Listener_ws:
-    def __init__(self, q):
+    def __init__(self, q, closed=None):
+        '''
+        :param q: queue the websocket handler puts the client's packets in
+        :param closed: threading.Event set when the session closes, reads then raise SessionClosed
+        '''
         self.input_queue = q
+        self.closed = threading.Event() if closed is None else closed
         self.listening = False
-        self.CHUNK = 5945 # This seems to be unused in current read logic, consider removal if not needed elsewhere
+        self.CHUNK = 4 * FRAME # samples per read, whole jitter buffer frames, like DEFAULT_CHUNK of the local mic
         self.RATE = 16_000
+        self.client_rate = 44100  # createScriptProcessor clients send int16 at the context's rate
+        self.decoder = None
+        self.jitter = JitterBuffer(self._packet, rate=self.RATE)
+        self._buffer = b''
+        self._stop_event = None
         logger.info("Listener_ws initialized.")
 
-    def read(self, x): # x is unused, consider removing if not planned for future use
-        data = self.input_queue.get()
-        logger.info(f"Listener_ws: Received raw data from queue. Type: {type(data)}, Length: {len(data)}")
-        
-        data_int16 = np.frombuffer(data, dtype=np.int16)
-        logger.info(f"Listener_ws: Converted to int16. Shape: {data_int16.shape}, dtype: {data_int16.dtype}")
+    def configure(self, codec='pcm', sample_rate=44100):
+        '''
+        :param codec: 'pcm' for int16 packets, 'opus' for Opus packets (see codec.py)
+        :param sample_rate: rate of the client's pcm packets
+        '''
+        self.decoder = OpusDecoder(self.RATE) if codec == 'opus' else None
+        self.client_rate = self.RATE if codec == 'opus' else sample_rate
+
+    def _get(self, timeout=None):
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            wait = 0.1 if deadline is None else min(0.1, deadline - monotonic())
+            try:
+                return self.input_queue.get(timeout=max(0, wait))
+            except queue.Empty:
+                if self.closed.is_set():
+                    raise SessionClosed()
+                if self._stop_event is not None and self._stop_event.is_set():
+                    raise ReadCancelled()
+                if deadline is not None and monotonic() >= deadline:
+                    raise
+
+    def _packet(self, timeout=None) -> bytes:
+        data = self._get(timeout)
+        metrics.audio_bytes.inc(len(data), direction='in')
+        logger.debug(f"Listener_ws: Received raw data from queue. Type: {type(data)}, Length: {len(data)}")
+
+        if self.decoder is not None:
+            # Opus is decoded straight to 16 kHz
+            return self.decoder.decode(data)
+        if self.client_rate == self.RATE:
+            return data
 
+        data_int16 = np.frombuffer(data, dtype=np.int16)
         data_float32 = data_int16.astype(np.float32) / (1 << 15)
 
-        # Assuming input sample rate from client is 44100 Hz (common browser default)
-        resampled_float32 = librosa.resample(y=data_float32, orig_sr=44100, target_sr=self.RATE)
-        logger.info(f"Listener_ws: Resampled to float32. Shape: {resampled_float32.shape}")
+        resample_start = monotonic()
+        resampled_float32 = librosa.resample(y=data_float32, orig_sr=self.client_rate, target_sr=self.RATE)
+        metrics.resample_seconds.observe(monotonic() - resample_start, direction='in')
+        logger.debug(f"Listener_ws: Resampled to float32. Shape: {resampled_float32.shape}")
 
         resampled_int16 = (resampled_float32 * (1 << 15)).astype(np.int16)
-        
-        output_bytes = resampled_int16.tobytes()
-        logger.info(f"Listener_ws: Returning processed int16 bytes. Length: {len(output_bytes)}")
+        return resampled_int16.tobytes()
+
+    def read(self, x):
+        '''
+        :param x: samples to return
+        :return: exactly x int16 samples at 16 kHz, whatever the size and timing of the client's packets
+        '''
+        while len(self._buffer) < 2 * x:
+            self._buffer += self.jitter.read()
+        output_bytes, self._buffer = self._buffer[:2 * x], self._buffer[2 * x:]
+        logger.debug(f"Listener_ws: Returning processed int16 bytes. Length: {len(output_bytes)}")
         return output_bytes
 
     def close(self):
         logger.info("Listener_ws: Close called.")
         pass
 
-    def make_stream(self):
+    def make_stream(self, stop_event=None):
+        '''
+        :param stop_event: reads raise ReadCancelled once this is set
+        '''
         logger.info("Listener_ws: make_stream called, setting listening to True and clearing input queue.")
         self.listening = True
-        self.input_queue.queue.clear()
+        clear_queue(self.input_queue)
+        self.jitter.reset()
+        self._buffer = b''
+        self._stop_event = stop_event
+        return self
+
+
+class Listener_file:
+    def __init__(self, files, speed=1.0, gap_seconds=2.0, chunk=1024, rate=16_000):
+        '''
+        :param files: wav files, one per user turn
+        :param speed: replay speed relative to real time, 0 to replay as fast as possible.
+                      Use 1 when measuring latencies, the end of speech is derived from wall time.
+        :param gap_seconds: silence appended after every file so that the turn ends
+        :param chunk: samples per read
+        :param rate: sample rate the files are resampled to
+
+        Replays wav files as if they were spoken into the microphone. Used by the offline
+        benchmarks in place of the local microphone or Listener_ws. The replay clock only
+        runs while the ear is listening, like a user waiting for the bot to finish.
+        '''
+        self.CHUNK = chunk
+        self.RATE = rate
+        self.speed = speed
+        audio = []
+        for file in files:
+            y, _ = librosa.load(file, sr=rate, mono=True)
+            audio.append(y)
+            audio.append(np.zeros(int(gap_seconds * rate), dtype=np.float32))
+        audio = np.concatenate(audio) if audio else np.zeros(0, dtype=np.float32)
+        self.audio = (np.clip(audio, -1, 1) * 32767).astype(np.int16)
+        self.position = 0
+        self.listening = False
+        self._clock = None
+
+    @property
+    def exhausted(self):
+        return self.position >= len(self.audio)
+
+    def read(self, x):
+        if self.speed > 0:
+            if self._clock is None:
+                self._clock = monotonic()
+                self._clock_position = self.position
+            due = self._clock + (self.position + x - self._clock_position) / (self.RATE * self.speed)
+            delay = due - monotonic()
+            if delay > 0:
+                sleep(delay)
+        data = self.audio[self.position:self.position + x]
+        if len(data) < x:
+            data = np.concatenate([data, np.zeros(x - len(data), dtype=np.int16)])
+        self.position += x
+        return data.tobytes()
+
+    def close(self):
+        self.listening = False
+        self._clock = None
+
+    def make_stream(self, stop_event=None):
+        # reads only wait for the replay clock, record_interruption checks stop_event between them
+        self.listening = True
+        self._clock = None
         return self
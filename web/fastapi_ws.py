@@ -1,19 +1,22 @@
 import uvicorn
 from openvoicechat.tts.tts_polly import Mouth_polly
+from openvoicechat.tts.filler import FillerBank
 # from openvoicechat.tts.tts_gtts import Mouth_gtts as Mouth
 from openvoicechat.llm.llm_gpt import Chatbot_gpt as Chatbot
 from openvoicechat.stt.stt_deepgram import Ear_deepgram as Ear
 from openvoicechat.llm.prompts import llama_sales
-from openvoicechat.utils import run_chat
+from openvoicechat.session import SessionManager
+from openvoicechat.capacity import AtCapacity
 from dotenv import load_dotenv
-import threading
-import queue
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi.responses import FileResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
-from openvoicechat.utils import Listener_ws, Player_ws
+from starlette.concurrency import run_in_threadpool
+from starlette.websockets import WebSocketState
+from openvoicechat import metrics
 import torch
 import os
+import json
 import logging
 
 # Configure basic logging
@@ -26,19 +29,34 @@ app.mount("/static", StaticFiles(directory="web/static"), name="static")
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-
-@app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    logger.info(f"WebSocket connection accepted from: {websocket.client}")
-
-    input_queue = queue.Queue()
-    output_queue = queue.Queue()
-    listener = Listener_ws(input_queue)
-    player = Player_ws(output_queue)
+# OVC_MOCK=1 runs the server with local stand-ins for STT/LLM/TTS, e.g. for benchmarks/ws_load.py
+MOCK = int(os.environ.get('OVC_MOCK', 0))
+# OVC_FILLERS=1 plays a short filler ("Okay.") while slow responses are generated (see openvoicechat/tts/filler.py)
+FILLERS = int(os.environ.get('OVC_FILLERS', 0))
+# OVC_SPECULATIVE_STT=0.3 transcribes after 0.3s of silence instead of at the end of the turn
+# (see openvoicechat/stt/speculative.py), for ears that transcribe whole utterances
+SPECULATIVE_STT = float(os.environ.get('OVC_SPECULATIVE_STT', 0))
+
+# local models can run in worker processes shared by all sessions (see openvoicechat/remote.py)
+# from openvoicechat.remote import ModelPool
+# from openvoicechat.stt.stt_remote import Ear_remote
+# stt_pool = ModelPool('openvoicechat.stt.stt_hf:Ear_hf', 'transcribe', workers=2,
+#                      model_kwargs={'model_id': 'openai/whisper-tiny.en', 'device': device})
+
+
+def make_pipeline(listener, player):
+    if MOCK:
+        from openvoicechat.stt.stt_mock import Ear_scripted
+        from openvoicechat.llm.llm_mock import Chatbot_scripted
+        from openvoicechat.tts.tts_mock import Mouth_synthetic
+        ear = Ear_scripted(silence_seconds=1.0, listener=listener)
+        if SPECULATIVE_STT:
+            ear.use_speculation(SPECULATIVE_STT)
+        return ear, Chatbot_scripted(), Mouth_synthetic(player=player)
 
     api_key = os.getenv("DEEPGRAM_API_KEY")
     ear = Ear(silence_seconds=1.0, api_key=api_key,listener=listener)
+    # ear = Ear_remote(stt_pool, silence_seconds=1.0, listener=listener)
     # ear = Ear_hf(
     #     model_id="openai/whisper-tiny.en",
     #     silence_seconds=1.5,
@@ -58,34 +76,95 @@ async def websocket_endpoint(websocket: WebSocket):
         region_name=os.getenv("REGION_NAME"),
         player=player
     )
-    # Update the call to run_chat to include enable_interruptions=True
-    # Assuming the order in run_chat is: verbose, enable_interruptions
-    threading.Thread(target=run_chat, args=(mouth, ear, chatbot, True, False)).start()
+    if SPECULATIVE_STT:
+        ear.use_speculation(SPECULATIVE_STT)
+    if FILLERS:
+        # rendered once per process, the sessions share the audio
+        mouth.use_fillers(FillerBank(mouth))
+    return ear, chatbot, mouth
+
+
+def preload():
+    '''
+    Loads what every session shares before web/supervisor.py forks the workers,
+    so that the workers share it copy-on-write instead of loading it once each.
+    '''
+    import numpy as np
+    import librosa
+    from openvoicechat.stt.vad import load_silero
+    load_silero()
+    # the first resample call imports and initialises the resampler
+    librosa.resample(np.zeros(16384, dtype=np.float32), orig_sr=44100, target_sr=16000)
+
+
+manager = SessionManager(make_pipeline,
+                         idle_timeout=int(os.environ.get('OVC_IDLE_TIMEOUT', 300)),
+                         run_kwargs={'verbose': True, 'enable_interruptions': False})
+
+
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    await websocket.accept()
+    logger.info(f"WebSocket connection accepted from: {websocket.client}")
 
+    # loading the models blocks, keep it off the event loop
     try:
-        while True:
-            data = await websocket.receive_bytes()
-            logger.info(f"Received bytes from client {websocket.client}: {len(data)}")
+        session = await run_in_threadpool(manager.create, str(websocket.client))
+    except AtCapacity as e:
+        # 1013 "try again later", the client reconnects after retry_after seconds
+        await websocket.close(code=1013, reason=f"at capacity, retry after {e.retry_after}s")
+        return
+    listener, input_queue, output_queue = session.listener, session.input_queue, session.output_queue
+
+    try:
+        while not session.closed.is_set():
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            session.touch()
+            if message.get("text") is not None:
+                # the hello that picks the codec (see openvoicechat/codec.py)
+                hello = json.loads(message["text"])
+                if hello.get("type") == "hello":
+                    await websocket.send_text(json.dumps(session.configure(hello)))
+                continue
+            data = message["bytes"]
+            logger.debug(f"Received bytes from client {websocket.client}: {len(data)}")
             if listener.listening:
                 input_queue.put(data)
             
             if not output_queue.empty():
                 response_data = output_queue.get_nowait()
-                logger.info(f"Sending bytes to client {websocket.client}: {len(response_data)}")
+                logger.debug(f"Sending bytes to client {websocket.client}: {len(response_data)}")
             else:
                 response_data = 'none'.encode()
-                logger.info(f"Sending 'none' to client {websocket.client}")
+                logger.debug(f"Sending 'none' to client {websocket.client}")
             await websocket.send_bytes(response_data)
     except WebSocketDisconnect:
         logger.info(f"WebSocket disconnected for client: {websocket.client}")
-        del mouth
-        del ear
-        #clear cuda cache
-        import torch
-        torch.cuda.empty_cache()
     finally:
+        # joining the pipeline thread can take a moment, keep it off the event loop
+        await run_in_threadpool(manager.close, session.id)
         logger.info(f"WebSocket connection closed for client: {websocket.client}")
-        await websocket.close()
+        if websocket.client_state == WebSocketState.CONNECTED:
+            await websocket.close()
+
+
+@app.get("/sessions")
+def list_sessions():
+    return manager.list()
+
+
+@app.delete("/sessions/{session_id}")
+def close_session(session_id: str):
+    if not manager.close(session_id):
+        raise HTTPException(status_code=404, detail="No such session")
+    return {"closed": session_id}
+
+
+@app.get("/metrics")
+def read_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/")
@@ -93,6 +172,12 @@ def read_root():
     return FileResponse('web/static/simple_audio.html')
 
 
+@app.get("/worklet")
+def read_worklet_client():
+    # AudioWorklet capture, 20 ms frames of 16 kHz int16
+    return FileResponse('web/static/worklet_audio.html')
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host='0.0.0.0', port=8000,
                 ssl_keyfile="web/localhost+2-key.pem", ssl_certfile="web/localhost+2.pem")
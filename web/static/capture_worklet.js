@@ -0,0 +1,62 @@
+// AudioWorklet that turns the microphone into 20 ms frames of 16 kHz int16,
+// the format Listener_ws reads without resampling. Runs on the audio thread,
+// frames are posted to the page as transferable ArrayBuffers.
+
+const TARGET_RATE = 16000;
+const FRAME_SAMPLES = 320; // 20 ms at 16 kHz
+
+class CaptureProcessor extends AudioWorkletProcessor {
+    constructor() {
+        super();
+        this.ratio = sampleRate / TARGET_RATE; // input samples per output sample
+        this.pending = new Float32Array(0); // input not yet resampled
+        this.position = 0; // of the next output sample in pending, fractional
+        this.frame = new Int16Array(FRAME_SAMPLES);
+        this.filled = 0;
+        this.enabled = true;
+        this.port.onmessage = (event) => {
+            if (event.data.type === 'enable') {
+                this.enabled = event.data.enabled;
+                // a frame started before muting would join audio from two moments
+                this.filled = 0;
+            }
+        };
+    }
+
+    process(inputs) {
+        const input = inputs[0][0];
+        if (!input || !this.enabled) {
+            return true;
+        }
+        const pending = new Float32Array(this.pending.length + input.length);
+        pending.set(this.pending);
+        pending.set(input, this.pending.length);
+
+        // averaging the input samples each output sample covers is the anti aliasing filter,
+        // good enough for speech and cheap enough for the audio thread
+        let position = this.position;
+        while (position + this.ratio <= pending.length) {
+            const start = Math.floor(position);
+            const end = Math.floor(position + this.ratio);
+            let sum = 0;
+            for (let i = start; i < end; i++) {
+                sum += pending[i];
+            }
+            const s = Math.max(-1, Math.min(1, sum / Math.max(1, end - start)));
+            this.frame[this.filled++] = s < 0 ? s * 0x8000 : s * 0x7FFF;
+            if (this.filled === FRAME_SAMPLES) {
+                const frame = this.frame;
+                this.port.postMessage(frame.buffer, [frame.buffer]);
+                this.frame = new Int16Array(FRAME_SAMPLES);
+                this.filled = 0;
+            }
+            position += this.ratio;
+        }
+        const consumed = Math.floor(position);
+        this.pending = pending.slice(consumed);
+        this.position = position - consumed;
+        return true;
+    }
+}
+
+registerProcessor('capture-16k', CaptureProcessor);
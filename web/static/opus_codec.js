@@ -0,0 +1,102 @@
+// Opus transport for the websocket clients, the browser side of openvoicechat/codec.py.
+// Uses WebCodecs. Messages are one or more Opus packets, each prefixed with its
+// length as a big endian uint16.
+
+const OPUS_FRAME_US = 20000;
+
+function opusSupported() {
+    return typeof AudioEncoder !== 'undefined' && typeof AudioDecoder !== 'undefined';
+}
+
+class OpusTransport {
+    // sampleRate: rate of the microphone audio passed to encode
+    // onPacket(Uint8Array): an encoded message ready to send
+    // onAudio(Float32Array, sampleRate): the decoded audio of one server message
+    constructor(sampleRate, onPacket, onAudio, onError) {
+        this.sampleRate = sampleRate;
+        this.onAudio = onAudio;
+        this.onError = onError || ((e) => console.error('Opus error:', e));
+        this.inputTimestamp = 0;
+        this.outputTimestamp = 0;
+        this.decoded = [];
+        this.decodeChain = Promise.resolve();
+
+        this.encoder = new AudioEncoder({
+            output: (chunk) => {
+                const message = new Uint8Array(2 + chunk.byteLength);
+                new DataView(message.buffer).setUint16(0, chunk.byteLength);
+                chunk.copyTo(message.subarray(2));
+                onPacket(message);
+            },
+            error: this.onError,
+        });
+        this.encoder.configure({
+            codec: 'opus', sampleRate: sampleRate, numberOfChannels: 1, bitrate: 24000,
+            opus: { frameDuration: OPUS_FRAME_US },
+        });
+        this.makeDecoder();
+    }
+
+    makeDecoder() {
+        this.decoder = new AudioDecoder({
+            output: (audioData) => {
+                const samples = new Float32Array(audioData.numberOfFrames);
+                audioData.copyTo(samples, { planeIndex: 0, format: 'f32-planar' });
+                this.decoded.push({ samples: samples, sampleRate: audioData.sampleRate });
+                audioData.close();
+            },
+            error: this.onError,
+        });
+        // Opus always decodes at 48 kHz here, AudioBuffers are resampled by the AudioContext
+        this.decoder.configure({ codec: 'opus', sampleRate: 48000, numberOfChannels: 1 });
+    }
+
+    encode(float32) {
+        const data = new AudioData({
+            format: 'f32', sampleRate: this.sampleRate, numberOfFrames: float32.length,
+            numberOfChannels: 1, timestamp: this.inputTimestamp, data: float32,
+        });
+        this.inputTimestamp += Math.round(float32.length * 1e6 / this.sampleRate);
+        this.encoder.encode(data);
+        data.close();
+    }
+
+    // decodes one server message, messages are handed to onAudio in order
+    decodeMessage(arrayBuffer) {
+        const view = new DataView(arrayBuffer);
+        const bytes = new Uint8Array(arrayBuffer);
+        this.decodeChain = this.decodeChain.then(async () => {
+            let i = 0;
+            while (i + 2 <= bytes.length) {
+                const n = view.getUint16(i);
+                this.decoder.decode(new EncodedAudioChunk({
+                    type: 'key', timestamp: this.outputTimestamp, data: bytes.subarray(i + 2, i + 2 + n),
+                }));
+                this.outputTimestamp += OPUS_FRAME_US;
+                i += 2 + n;
+            }
+            await this.decoder.flush();
+            const parts = this.decoded;
+            this.decoded = [];
+            if (parts.length === 0) {
+                return;
+            }
+            const total = parts.reduce((sum, p) => sum + p.samples.length, 0);
+            const audio = new Float32Array(total);
+            let offset = 0;
+            for (const p of parts) {
+                audio.set(p.samples, offset);
+                offset += p.samples.length;
+            }
+            this.onAudio(audio, parts[0].sampleRate);
+        }).catch(this.onError);
+    }
+
+    // drops what is being decoded, e.g. when the server stops the playback
+    reset() {
+        this.decoder.close();
+        this.decoded = [];
+        this.decodeChain = Promise.resolve();
+        this.makeDecoder();
+    }
+}
@@ -0,0 +1,234 @@
+'''
+Runs web/fastapi_ws.py in several worker processes.
+
+One Python process runs every session on one GIL, so VAD, resampling and local
+models of concurrent sessions compete for a single core. The supervisor loads the
+shared models once (fastapi_ws.preload), then forks the workers so that they share
+them copy-on-write. Every worker listens on the same port with SO_REUSEPORT and
+the kernel spreads new connections across them (without SO_REUSEPORT the workers
+accept from one inherited socket). Each worker enforces its own capacity limits
+(see openvoicechat/capacity.py), so a rejected client retries and usually lands on
+another worker.
+
+    python web/supervisor.py --workers 4 --port 8000 --status-port 8001
+
+    GET :8001/         per-worker load as JSON
+    kill -HUP <pid>    rolling restart: start a replacement, then drain the old worker
+    kill -TERM <pid>   drain all workers and exit (Ctrl-C stops the workers right away)
+
+Draining a worker closes its listening socket and waits (up to --drain-timeout)
+for its sessions to end before it exits. /metrics is served by whichever worker
+takes the request, use the status port for a view over all of them.
+'''
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep, time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+logger = logging.getLogger('supervisor')
+
+REUSEPORT = hasattr(socket, 'SO_REUSEPORT')
+
+
+def make_socket(host, port, backlog=2048):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if REUSEPORT:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Worker:
+    def __init__(self, index, generation):
+        '''
+        :param index: slot of the worker, kept by its replacements
+        :param generation: number of times the slot was (re)started
+        '''
+        self.index = index
+        self.generation = generation
+        self.sessions = multiprocessing.Value('i', 0, lock=False)
+        self.heartbeat = multiprocessing.Value('d', 0.0, lock=False)
+        self.draining = multiprocessing.Value('b', 0, lock=False)
+        self.process = None
+        self.drain_started = None
+
+    def info(self) -> dict:
+        return {'worker': self.index, 'generation': self.generation,
+                'pid': self.process.pid if self.process else None,
+                'alive': bool(self.process and self.process.is_alive()),
+                'sessions': self.sessions.value, 'draining': bool(self.draining.value),
+                'heartbeat_age': time() - self.heartbeat.value if self.heartbeat.value else None}
+
+
+def worker_main(worker, args, shared_sock):
+    '''
+    Entry point of a forked worker. Serves the app until it is drained or terminated.
+    '''
+    import uvicorn
+    from web import fastapi_ws as server
+
+    if args.threads:
+        import torch
+        torch.set_num_threads(args.threads)
+    sock = shared_sock if shared_sock is not None else make_socket(args.host, args.port)
+    drain = threading.Event()
+    signal.signal(signal.SIGUSR1, lambda *_: drain.set())
+
+    config = uvicorn.Config(server.app, ssl_keyfile=args.ssl_keyfile, ssl_certfile=args.ssl_certfile,
+                            log_level=args.log_level)
+    uv = uvicorn.Server(config)
+
+    async def serve():
+        task = asyncio.create_task(uv.serve(sockets=[sock]))
+        drain_deadline = None
+        while not task.done():
+            await asyncio.sleep(0.5)
+            worker.sessions.value = len(server.manager.sessions)
+            worker.heartbeat.value = time()
+            if drain.is_set() and drain_deadline is None and uv.started:
+                # stop accepting, the kernel routes new connections to the other workers
+                worker.draining.value = 1
+                drain_deadline = monotonic() + args.drain_timeout
+                for s in uv.servers:
+                    s.close()
+                logger.info(f'worker {worker.index} ({os.getpid()}) draining '
+                            f'{worker.sessions.value} sessions')
+            if drain_deadline is not None and (not server.manager.sessions or monotonic() > drain_deadline):
+                server.manager.close_all()
+                uv.should_exit = True
+        await task
+
+    asyncio.run(serve())
+
+
+class Supervisor:
+    def __init__(self, args):
+        self.args = args
+        self.workers = []
+        self.generations = {}
+        self.shared_sock = None if REUSEPORT else make_socket(args.host, args.port)
+        self.stopping = False
+        self.restart_requested = False
+
+    def spawn(self, index):
+        generation = self.generations.get(index, -1) + 1
+        self.generations[index] = generation
+        worker = Worker(index, generation)
+        ctx = multiprocessing.get_context('fork')
+        worker.process = ctx.Process(target=worker_main, args=(worker, self.args, self.shared_sock),
+                                     name=f'ovc-worker-{index}', daemon=False)
+        worker.process.start()
+        self.workers.append(worker)
+        logger.info(f'started worker {index} (pid {worker.process.pid})')
+        return worker
+
+    def drain(self, worker):
+        if worker.drain_started is None and worker.process.is_alive():
+            worker.drain_started = monotonic()
+            os.kill(worker.process.pid, signal.SIGUSR1)
+
+    def rolling_restart(self):
+        for old in [w for w in self.workers if w.drain_started is None]:
+            new = self.spawn(old.index)
+            # let the replacement start listening before the old worker stops
+            deadline = monotonic() + 60
+            while not new.heartbeat.value and new.process.is_alive() and monotonic() < deadline:
+                sleep(0.2)
+            self.drain(old)
+
+    def reap(self):
+        for worker in list(self.workers):
+            if worker.process.is_alive():
+                # the worker drains itself, terminate it if it overstays
+                if worker.drain_started is not None and \
+                        monotonic() - worker.drain_started > self.args.drain_timeout + 10:
+                    worker.process.terminate()
+                continue
+            self.workers.remove(worker)
+            worker.process.join()
+            if worker.drain_started is None and not self.stopping:
+                logger.warning(f'worker {worker.index} exited with {worker.process.exitcode}, restarting')
+                self.spawn(worker.index)
+
+    def status(self) -> list:
+        return [w.info() for w in sorted(self.workers, key=lambda w: (w.index, w.generation))]
+
+    def serve_status(self, port):
+        supervisor = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(supervisor.status(), indent=2).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        httpd = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda *_: setattr(self, 'restart_requested', True))
+        signal.signal(signal.SIGTERM, lambda *_: setattr(self, 'stopping', True))
+        signal.signal(signal.SIGINT, lambda *_: setattr(self, 'stopping', True))
+
+        for index in range(self.args.workers):
+            self.spawn(index)
+        if self.args.status_port:
+            self.serve_status(self.args.status_port)
+
+        last_report = monotonic()
+        while self.workers:
+            sleep(0.5)
+            if self.stopping:
+                for worker in self.workers:
+                    self.drain(worker)
+            elif self.restart_requested:
+                self.restart_requested = False
+                self.rolling_restart()
+            self.reap()
+            if self.args.report_interval and monotonic() - last_report > self.args.report_interval:
+                last_report = monotonic()
+                load = ' '.join(f"w{w['worker']}:{w['sessions']}{'(d)' if w['draining'] else ''}"
+                                for w in self.status())
+                logger.info(f'sessions per worker: {load}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--ssl-keyfile', default=None)
+    parser.add_argument('--ssl-certfile', default=None)
+    parser.add_argument('--threads', type=int, default=1, help='torch threads per worker, 0 to keep the default')
+    parser.add_argument('--drain-timeout', type=float, default=300.0,
+                        help='seconds a draining worker waits for its sessions to end')
+    parser.add_argument('--status-port', type=int, default=None)
+    parser.add_argument('--report-interval', type=float, default=30.0)
+    parser.add_argument('--log-level', default='info')
+    parser.add_argument('--no-preload', action='store_true', help='let every worker load its own models')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    from web import fastapi_ws
+    if not args.no_preload:
+        fastapi_ws.preload()
+    Supervisor(args).run()